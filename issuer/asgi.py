@@ -0,0 +1,17 @@
+"""
+ASGI config for issuer project.
+
+It exposes the ASGI callable of the webhooks as a module-level variable named ``application``. Django 2.1 has no ASGI
+handler, so the application in issuerapp.asgi runs the webhooks in a thread pool. It can be served with any ASGI
+server, for example ``uvicorn issuer.asgi:application``.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'issuer.settings')
+
+django.setup()
+
+from issuerapp.asgi import application
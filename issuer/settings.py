@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that the recorded wall time includes the other middleware.
+    'issuerapp.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,9 +81,80 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'TEST': {
+            # file based test database can be shared with worker processes of concurrency tests.
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
     }
 }
 
+# Cache of accounts in front of Accounts.get_account. CACHE_ALIAS can name a cache in CACHES setting which is
+# shared by several worker processes. Changed accounts are removed only from the in-process cache of the process
+# which changed them, so with a shared cache, accounts are kept in process for LOCAL_TIMEOUT seconds, by default not
+# at all.
+ISSUER_ACCOUNT_CACHE = {
+    'SIZE': 1024,
+    'TIMEOUT': 300,
+    'CACHE_ALIAS': None,
+    'LOCAL_TIMEOUT': 0,
+}
+
+# Store each posting as a single Postings row instead of two Transfers rows and a Transactions row. Existing
+# transactions are copied with compact_ledger command.
+ISSUER_COMPACT_LEDGER = False
+
+# Responses of webhook messages are replayed to retried messages for TTL seconds. SIZE responses are cached in
+# memory in front of the database.
+ISSUER_WEBHOOK_RESPONSES = {
+    'SIZE': 10000,
+    'TTL': 86400,
+}
+
+# Exchange rates for authorizations. FILE is a local JSON file like {"base": "EUR", "rates": {"USD": "1.16"}}. If it
+# is set, available funds of all currencies are converted to the main currency of the account. The file is read
+# again if it has changed, at most every TIMEOUT seconds.
+ISSUER_FX_RATES = {
+    'FILE': None,
+    'TIMEOUT': 60,
+}
+
+# Balances of the issuer and scheme accounts are split into this many rows per currency. Postings pick a row by a
+# hash of the card, so they don't all wait for the same row lock. Balance reads add the rows up.
+ISSUER_SYSTEM_ACCOUNT_SHARDS = 1
+
+# Authorization holds of the webhooks expire after this many days, and expire_holds command releases them from the
+# available balance. Holds of other authorizations, e.g. load_money, don't expire.
+ISSUER_HOLD_DAYS = 7
+
+# The number of threads which run the database work of the ASGI webhooks, see issuer/asgi.py.
+ISSUER_ASGI_THREADS = 32
+
+# Production profile of the SQLite database. PRAGMAS are set on each new connection: WAL journal lets readers go on
+# while a write is committed, and busy_timeout is in milliseconds. With SERIALIZE_WRITES, ledger writes of the threads
+# of a process are run one at a time by a writer thread, see issuerapp/sqlite.py, and callers wait for their write at
+# most TIMEOUT seconds. With GROUP_COMMIT, the writer commits writes queued within WINDOW seconds of each other, at
+# most SIZE of them, in one database transaction.
+ISSUER_SQLITE_PRODUCTION = {
+    'PRAGMAS': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+    },
+    'SERIALIZE_WRITES': True,
+    'TIMEOUT': 30,
+    'GROUP_COMMIT': {
+        'ENABLED': False,
+        'WINDOW': 0.002,
+        'SIZE': 64,
+    },
+}
+
+# The profile is opt-in with ISSUER_SQLITE_PROFILE=production environment variable. Otherwise SQLite defaults are
+# used and writes are not serialized.
+ISSUER_SQLITE = ISSUER_SQLITE_PRODUCTION if os.environ.get('ISSUER_SQLITE_PROFILE') == 'production' else {}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
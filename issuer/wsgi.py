@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'issuer.settings')
 
 application = get_wsgi_application()
+
+# load the system accounts before the first request.
+from issuerapp.models import account_cache
+account_cache.warm()
@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class IssuerappConfig(AppConfig):
     name = 'issuerapp'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_save, post_delete
+        from .models import Accounts, account_cache
+        from .sqlite import apply_pragmas
+        connection_created.connect(apply_pragmas)
+        post_save.connect(account_cache.invalidate_instance, sender=Accounts)
+        post_delete.connect(account_cache.invalidate_instance, sender=Accounts)
@@ -0,0 +1,95 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import QueryDict
+
+from .webhooks import authorize_message, present_message
+
+executor = ThreadPoolExecutor(max_workers=getattr(settings, "ISSUER_ASGI_THREADS", 32),
+                              thread_name_prefix="issuer-asgi")
+
+def _run_in_thread(func, *args):
+    # database connections are per thread, so they are closed like at the end of a WSGI request.
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+async def database_sync_to_async(func, *args):
+    """
+    Runs blocking ORM code in the executor, so the event loop can serve other requests meanwhile.
+    :param func: The function to run.
+    :param args: Arguments of the function.
+    :return: Returns the return value of the function.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(_run_in_thread, func, *args))
+
+async def read_body(receive):
+    """
+    Reads the whole request body.
+    :param receive: ASGI receive callable.
+    :return: The body as bytes.
+    """
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+async def send_response(send, status, content, content_type="text/html; charset=utf-8"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(content)).encode())],
+    })
+    await send({"type": "http.response.body", "body": content})
+
+async def authorization(message):
+    return await database_sync_to_async(authorize_message, message)
+
+async def presentment(message):
+    return await database_sync_to_async(present_message, message)
+
+routes = {
+    "/api/authorization": authorization,
+    "/api/presentment": presentment,
+}
+
+async def application(scope, receive, send):
+    """
+    ASGI application of the authorization and presentment webhooks. The webhooks take form encoded POST requests
+    like their WSGI versions. Other URLs are only served by the WSGI application.
+    :param scope: ASGI connection scope.
+    :param receive: ASGI receive callable.
+    :param send: ASGI send callable.
+    :return: None
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                from .models import account_cache
+                await database_sync_to_async(account_cache.warm)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    handler = routes.get(scope["path"])
+    if handler is None:
+        await send_response(send, 404, b"Not Found")
+        return
+    if scope["method"] != "POST":
+        await send_response(send, 405, b"Method Not Allowed")
+        return
+    message = QueryDict(await read_body(receive))
+    response = await handler(message)
+    await send_response(send, response.status_code, response.content, response["Content-Type"])
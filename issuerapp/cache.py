@@ -0,0 +1,310 @@
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal, ROUND_FLOOR
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, DatabaseError
+from .currencies import currency_exponent
+
+class AccountCache:
+    """
+    Bounded LRU cache of accounts used by Accounts.get_account. Pinned accounts are never evicted. If a Django cache
+    alias is given, it is used as a second level which can be shared by several worker processes.
+    Only committed accounts are cached, so accounts read inside an atomic block are not stored.
+    A saved or deleted account is removed from the shared cache, but only from the in-process cache of the process 
+    which changed it. Other processes may use their copy until local_timeout, so with a shared cache the in-process 
+    cache is skipped unless local_timeout is set.
+    """
+
+    def __init__(self, size=1024, timeout=300, pinned=(), cache_alias=None, local_timeout=0):
+        """
+        :param size: The maximum number of accounts in the in-process cache, not counting pinned accounts.
+        :param timeout: Seconds after which a cached account is read again from the database.
+        :param pinned: Names of accounts which are never evicted.
+        :param cache_alias: Optional alias of a Django cache in CACHES setting.
+        :param local_timeout: Seconds after which an account in the in-process cache is read again from the shared 
+        cache. Only used with cache_alias, 0 skips the in-process cache.
+        """
+        self.size = size
+        self.timeout = timeout
+        self.local_timeout = timeout if cache_alias is None else local_timeout
+        self.pinned = frozenset(pinned)
+        self.cache_alias = cache_alias
+        self.hits = 0
+        self.misses = 0
+        self._accounts = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(cardholder_name):
+        return "issuerapp.account.{}".format(cardholder_name)
+
+    def get(self, cardholder_name):
+        """
+        Gets a cached account.
+        :param cardholder_name: The name of the account owner.
+        :return: Returns a copy of the cached account, or None if it is not cached.
+        """
+        with self._lock:
+            entry = self._accounts.get(cardholder_name)
+            if entry is not None and entry[1] > time.monotonic():
+                self._accounts.move_to_end(cardholder_name)
+                self.hits += 1
+                return copy.copy(entry[0])
+        account = None
+        if self.cache_alias is not None:
+            account = caches[self.cache_alias].get(self._key(cardholder_name))
+        if account is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        self._store(account)
+        return copy.copy(account)
+
+    def set(self, account):
+        """
+        Caches an account unless it is read inside an atomic block, where it might not be committed yet.
+        :param account: The account model.
+        :return: None
+        """
+        if connection.in_atomic_block:
+            return
+        if self.cache_alias is not None:
+            caches[self.cache_alias].set(self._key(account.pk), account, self.timeout)
+        self._store(account)
+
+    def _store(self, account):
+        if self.local_timeout <= 0:
+            return
+        with self._lock:
+            self._accounts[account.pk] = (copy.copy(account), time.monotonic() + self.local_timeout)
+            self._accounts.move_to_end(account.pk)
+            unpinned = len(self._accounts) - len(self.pinned.intersection(self._accounts))
+            for cardholder_name in list(self._accounts):
+                if unpinned <= self.size:
+                    break
+                if cardholder_name not in self.pinned:
+                    del self._accounts[cardholder_name]
+                    unpinned -= 1
+
+    def invalidate(self, cardholder_name):
+        """
+        Removes an account from the cache.
+        :param cardholder_name: The name of the account owner.
+        :return: None
+        """
+        with self._lock:
+            self._accounts.pop(cardholder_name, None)
+        if self.cache_alias is not None:
+            caches[self.cache_alias].delete(self._key(cardholder_name))
+
+    def clear(self):
+        """
+        Removes all accounts from the cache and resets the counters.
+        :return: None
+        """
+        with self._lock:
+            cardholder_names = list(self._accounts)
+            self._accounts.clear()
+            self.hits = self.misses = 0
+        if self.cache_alias is not None:
+            caches[self.cache_alias].delete_many([self._key(name) for name in cardholder_names])
+
+    def warm(self):
+        """
+        Loads the pinned accounts into the cache. Accounts which don't exist yet are skipped.
+        :return: None
+        """
+        from .models import Accounts
+        try:
+            for account in Accounts.objects.filter(pk__in=self.pinned):
+                self.set(account)
+        except DatabaseError:
+            pass
+
+    def invalidate_instance(self, sender, instance, **kwargs):
+        """
+        Signal receiver which removes a saved or deleted account from the cache.
+        """
+        self.invalidate(instance.pk)
+
+    def stats(self):
+        """
+        :return: Returns a dictionary of hit and miss counters and the number of cached accounts.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._accounts)}
+
+    @staticmethod
+    def from_settings(pinned=()):
+        """
+        Creates a cache configured by ISSUER_ACCOUNT_CACHE setting, which is a dictionary with optional "SIZE", 
+        "TIMEOUT", "CACHE_ALIAS" and "LOCAL_TIMEOUT" keys.
+        :param pinned: Names of accounts which are never evicted.
+        :return: Returns the created cache.
+        """
+        options = getattr(settings, "ISSUER_ACCOUNT_CACHE", {})
+        return AccountCache(size=options.get("SIZE", 1024), timeout=options.get("TIMEOUT", 300), pinned=pinned,
+                            cache_alias=options.get("CACHE_ALIAS"), local_timeout=options.get("LOCAL_TIMEOUT", 0))
+
+class ResponseCache:
+    """
+    Bounded LRU cache of stored webhook responses in front of WebhookResponses table. Stored responses never change,
+    so entries are only removed when they expire or are evicted.
+    """
+
+    def __init__(self, size=10000, timeout=86400):
+        """
+        :param size: The maximum number of cached responses.
+        :param timeout: Seconds after which a cached response expires.
+        """
+        self.size = size
+        self.timeout = timeout
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Gets a cached response.
+        :param key: Tuple of message type and transaction_id.
+        :return: Returns a tuple of status and content, or None if the response is not cached.
+        """
+        with self._lock:
+            entry = self._responses.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._responses[key]
+                return None
+            self._responses.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, response, timeout=None):
+        """
+        Caches a response.
+        :param key: Tuple of message type and transaction_id.
+        :param response: Tuple of status and content.
+        :param timeout: Optional seconds after which the response expires, if it is less than the default.
+        :return: None
+        """
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        with self._lock:
+            self._responses[key] = (response, time.monotonic() + timeout)
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.size:
+                self._responses.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all responses from the cache.
+        :return: None
+        """
+        with self._lock:
+            self._responses.clear()
+
+    @staticmethod
+    def from_settings():
+        """
+        Creates a cache configured by ISSUER_WEBHOOK_RESPONSES setting, which is a dictionary with optional "SIZE" 
+        and "TTL" keys. TTL is also the time the responses are kept in the database.
+        :return: Returns the created cache.
+        """
+        options = getattr(settings, "ISSUER_WEBHOOK_RESPONSES", {})
+        return ResponseCache(size=options.get("SIZE", 10000), timeout=options.get("TTL", 86400))
+
+class FxRates:
+    """
+    Exchange rates loaded from a local JSON file into memory, e.g. {"base": "EUR", "rates": {"USD": "1.16"}}, where 
+    a rate is the price of one unit of the base currency. The file is read again if it has changed, at most once per 
+    timeout. If a changed file can't be read, the previous rates are kept.
+    """
+
+    def __init__(self, file_name=None, timeout=60):
+        """
+        :param file_name: The path of the rate file. Without it, there aren't any rates.
+        :param timeout: Seconds after which the file is checked for changes.
+        """
+        self.file_name = file_name
+        self.timeout = timeout
+        self._rates = {}
+        self._modified = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        """
+        :return: Returns True if a rate file is configured.
+        """
+        return self.file_name is not None
+
+    def rates(self):
+        """
+        :return: Returns a dictionary of currency codes and Decimal rates. The base currency has rate 1.
+        """
+        if not self.enabled():
+            return {}
+        with self._lock:
+            if self._checked is None or self._checked <= time.monotonic():
+                self._load()
+            return self._rates
+
+    def _load(self):
+        self._checked = time.monotonic() + self.timeout
+        try:
+            modified = os.stat(self.file_name).st_mtime_ns
+            if modified == self._modified:
+                return
+            with open(self.file_name) as file:
+                table = json.load(file)
+            rates = {currency.upper(): Decimal(str(rate)) for currency, rate in table["rates"].items()}
+            rates[table["base"].upper()] = Decimal(1)
+            if any(not rate.is_finite() or rate <= 0 for rate in rates.values()):
+                raise ValueError("Rates must be positive numbers.")
+        except (OSError, ArithmeticError, ValueError, KeyError, AttributeError) as error:
+            if self._rates:
+                return
+            raise ValueError("Exchange rates can't be read from \"{0}\": {1}".format(self.file_name, error))
+        self._rates, self._modified = rates, modified
+
+    def convert(self, units, currency, to_currency, rounding=ROUND_FLOOR):
+        """
+        Converts an amount between currencies.
+        :param units: The amount in minor units of currency.
+        :param currency: Currency of the amount in ISO character format.
+        :param to_currency: Currency of the result in ISO character format.
+        :param rounding: Rounding of the result to minor units, a rounding mode of decimal module.
+        :return: Returns the amount in minor units of to_currency. Raises ValueError if either currency doesn't 
+        have a rate.
+        """
+        if currency == to_currency:
+            return units
+        rates = self.rates()
+        for code in (currency, to_currency):
+            if code not in rates:
+                raise ValueError("There is no exchange rate for {}.".format(code))
+        amount = Decimal(units).scaleb(currency_exponent(to_currency) - currency_exponent(currency))
+        return int((amount * rates[to_currency] / rates[currency]).to_integral_value(rounding))
+
+    def clear(self):
+        """
+        Removes the loaded rates, so they are read again from the file.
+        :return: None
+        """
+        with self._lock:
+            self._rates, self._modified, self._checked = {}, None, None
+
+    @staticmethod
+    def from_settings():
+        """
+        Creates a rate table configured by ISSUER_FX_RATES setting, which is a dictionary with optional "FILE" and 
+        "TIMEOUT" keys.
+        :return: Returns the created rate table.
+        """
+        options = getattr(settings, "ISSUER_FX_RATES", {})
+        return FxRates(file_name=options.get("FILE"), timeout=options.get("TIMEOUT", 60))
@@ -0,0 +1,65 @@
+from decimal import Decimal, ROUND_FLOOR
+from moneyed import CURRENCIES
+
+# ISO 4217 minor unit exponents of currencies which don't have two decimal places. Newer moneyed versions know the
+# sub unit of each currency, but this one doesn't.
+EXPONENTS = {
+    "BIF": 0, "BYR": 0, "CLP": 0, "DJF": 0, "GNF": 0, "ISK": 0, "JPY": 0, "KMF": 0, "KRW": 0, "PYG": 0, "RWF": 0,
+    "UGX": 0, "UYI": 0, "VND": 0, "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+    "BHD": 3, "IQD": 3, "JOD": 3, "KWD": 3, "LYD": 3, "OMR": 3, "TND": 3,
+    "CLF": 4,
+}
+DEFAULT_EXPONENT = 2
+
+def currency_exponent(currency):
+    """
+    Gets the number of decimal places of currency, e.g. 2 for EUR and 0 for JPY.
+    :param currency: Currency in ISO character format.
+    :return: Returns the exponent of the minor unit.
+    """
+    sub_unit = getattr(CURRENCIES.get(currency), "sub_unit", None)
+    if sub_unit:
+        return len(str(sub_unit)) - 1
+    return EXPONENTS.get(currency, DEFAULT_EXPONENT)
+
+def to_minor_units(amount, currency):
+    """
+    Converts an amount to integer minor units of currency, e.g. "12.34" EUR to 1234 cents.
+    :param amount: The amount as Decimal, string or number. Floats are converted through their string form.
+    :param currency: Currency in ISO character format.
+    :return: Returns the amount in minor units. Raises ValueError if the amount is not a number or it has more
+    decimal places than the currency.
+    """
+    try:
+        amount = Decimal(str(amount))
+    except ArithmeticError:
+        raise ValueError("Value {!r} must be a decimal number.".format(amount))
+    if not amount.is_finite():
+        raise ValueError("Value {!r} must be a decimal number.".format(amount))
+    units = amount.scaleb(currency_exponent(currency))
+    if units != units.to_integral_value():
+        raise ValueError("Ensure that there are no more than {} decimal places.".format(currency_exponent(currency)))
+    return int(units)
+
+def from_minor_units(units, currency):
+    """
+    Converts integer minor units of currency to an amount, e.g. 1234 EUR cents to Decimal("12.34").
+    :param units: The amount in minor units.
+    :param currency: Currency in ISO character format.
+    :return: Returns the amount as Decimal with the decimal places of currency.
+    """
+    exponent = currency_exponent(currency)
+    return Decimal(units).scaleb(-exponent).quantize(Decimal(1).scaleb(-exponent))
+
+def rescale_units(units, currency, to_currency, rounding=ROUND_FLOOR):
+    """
+    Converts integer minor units of currency to minor units of another currency with the same major unit value, e.g. 
+    100 JPY to 10000 EUR cents. Exchange rates are not used.
+    :param units: The amount in minor units of currency.
+    :param currency: Currency of the amount in ISO character format.
+    :param to_currency: Currency of the result in ISO character format.
+    :param rounding: Rounding of the result to minor units, a rounding mode of decimal module.
+    :return: Returns the amount in minor units of to_currency.
+    """
+    amount = Decimal(units).scaleb(currency_exponent(to_currency) - currency_exponent(currency))
+    return int(amount.to_integral_value(rounding))
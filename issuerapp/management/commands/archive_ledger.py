@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from issuerapp.models import ArchivedPostings
+
+class Command(BaseCommand):
+    help = 'Moves settled presentments and settlements older than the retention window from the ledger to the ' \
+           'archive in chunks. Their effect on balances is carried forward, so balances stay the same.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365,
+                            help='Retention window. Postings created this many days ago or earlier are archived.')
+        parser.add_argument('--before', type=str, help='The cutoff as ISO datetime instead of the retention window.')
+        parser.add_argument('--chunk-size', type=int, default=400,
+                            help='The number of postings moved in one database transaction.')
+
+    def handle(self, *args, **options):
+        if options['before']:
+            cutoff = parse_datetime(options['before'])
+            if cutoff is None:
+                raise CommandError("\"{}\" is not a valid datetime.".format(options['before']))
+            if timezone.is_naive(cutoff):
+                cutoff = timezone.make_aware(cutoff)
+        else:
+            cutoff = timezone.now() - timezone.timedelta(days=options['days'])
+        if options['chunk_size'] < 1:
+            raise CommandError("Chunk size must be positive.")
+
+        archived = 0
+        while True:
+            moved = ArchivedPostings.archive(cutoff, options['chunk_size'])
+            if not moved:
+                break
+            archived += moved
+            self.stdout.write("Archived {0} postings.".format(archived))
+        self.stdout.write(self.style.SUCCESS("Archived {0} postings created before {1}.".format(archived, cutoff)))
@@ -0,0 +1,201 @@
+import multiprocessing
+import os
+import time
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Min, Max
+from issuerapp.currencies import from_minor_units
+from issuerapp.models import Accounts, Balances, CarriedBalances, Postings, Transactions, Transfers, \
+    compact_ledger, CURRENCY_CODES, LEDGER_TYPES, AVAILABLE_TYPES
+
+CURRENCY_LIST = sorted(CURRENCY_CODES)
+CURRENCY_INDEX = {currency: index for index, currency in enumerate(CURRENCY_LIST)}
+LEDGER_TYPE_INDEX = {transaction_type: 1 for transaction_type in LEDGER_TYPES}
+AVAILABLE_TYPE_INDEX = {transaction_type: 1 for transaction_type in AVAILABLE_TYPES}
+# rows fetched from the database at a time.
+FETCH_SIZE = 10000
+# account indexes of cardholder names. It is set before the worker processes are forked, so they share it.
+account_index = {}
+
+def audit_shard(shard):
+    """
+    Audits one id range of the ledger in a worker process.
+    :param shard: Tuple of shard kind, "entries" or "transfers", first id, end id and the number of sampled problems.
+    :return: Returns a dictionary of row count, orphan and mismatch counts and sampled ids, totals of accounts as
+    (keys, ledger totals, available totals) arrays and per-currency totals of all transfers.
+    """
+    kind, start, end, samples = shard
+    result = {"rows": 0, "orphans": 0, "mismatches": 0, "sampled_orphans": [], "sampled_mismatches": [],
+              "keys": np.zeros(0, np.int64), "ledger": np.zeros(0, np.int64), "available": np.zeros(0, np.int64),
+              "currencies": np.zeros(len(CURRENCY_LIST), np.int64)}
+    with connection.cursor() as cursor:
+        if kind == "transfers":
+            cursor.execute(
+                "SELECT tr.id FROM {transfers} tr WHERE tr.id >= %s AND tr.id < %s "
+                "AND NOT EXISTS (SELECT 1 FROM {transactions} t WHERE t.transfer_from_id = tr.id) "
+                "AND NOT EXISTS (SELECT 1 FROM {transactions} t WHERE t.transfer_to_id = tr.id)"
+                .format(transfers=Transfers._meta.db_table, transactions=Transactions._meta.db_table), [start, end])
+            orphans = [row[0] for row in cursor.fetchall()]
+            result.update(orphans=len(orphans), sampled_orphans=orphans[:samples])
+            return result
+        if compact_ledger():
+            cursor.execute(
+                "SELECT id, transaction_type, debit_account_id, currency, amount, 'debit', credit_account_id, "
+                "currency, amount, 'credit' FROM {postings} WHERE id >= %s AND id < %s"
+                .format(postings=Postings._meta.db_table), [start, end])
+        else:
+            # transfers are left joined, so transactions without them are found.
+            cursor.execute(
+                "SELECT t.id, t.transaction_type, d.account_id, d.currency, d.amount, d.transfer_type, c.account_id, "
+                "c.currency, c.amount, c.transfer_type FROM {transactions} t "
+                "LEFT JOIN {transfers} d ON d.id = t.transfer_from_id "
+                "LEFT JOIN {transfers} c ON c.id = t.transfer_to_id WHERE t.id >= %s AND t.id < %s"
+                .format(transactions=Transactions._meta.db_table, transfers=Transfers._meta.db_table), [start, end])
+        batches = []
+        for rows in iter(lambda: cursor.fetchmany(FETCH_SIZE), []):
+            batches.append(load_rows(rows))
+    if not batches:
+        return result
+    (ids, ledger_flags, available_flags, debit_accounts, debit_currencies, debit_amounts, debit_types,
+     credit_accounts, credit_currencies, credit_amounts, credit_types) = (np.concatenate(column)
+                                                                          for column in zip(*batches))
+
+    # a transaction must have a debit and a credit transfer of the same positive amount in a known currency.
+    mismatches = ((debit_accounts < 0) | (credit_accounts < 0) | (debit_currencies < 0) |
+                  (debit_currencies != credit_currencies) | (debit_amounts != credit_amounts) |
+                  (debit_amounts <= 0) | (debit_types != 0) | (credit_types != 1))
+    result.update(rows=len(ids), mismatches=int(mismatches.sum()),
+                  sampled_mismatches=ids[mismatches][:samples].tolist())
+
+    # both transfers of each transaction as signed amounts. Missing transfers are left out.
+    accounts = np.concatenate((debit_accounts, credit_accounts))
+    currencies = np.concatenate((debit_currencies, credit_currencies))
+    amounts = np.concatenate((-debit_amounts, credit_amounts))
+    ledger_flags = np.concatenate((ledger_flags, ledger_flags))
+    available_flags = np.concatenate((available_flags, available_flags))
+    known = (accounts >= 0) & (currencies >= 0)
+    accounts, currencies, amounts = accounts[known], currencies[known], amounts[known]
+    ledger_flags, available_flags = ledger_flags[known], available_flags[known]
+
+    np.add.at(result["currencies"], currencies, amounts)
+    keys, inverse = np.unique(accounts * len(CURRENCY_LIST) + currencies, return_inverse=True)
+    result["keys"] = keys
+    result["ledger"] = np.zeros(len(keys), np.int64)
+    result["available"] = np.zeros(len(keys), np.int64)
+    np.add.at(result["ledger"], inverse[ledger_flags], amounts[ledger_flags])
+    np.add.at(result["available"], inverse[available_flags], amounts[available_flags])
+    return result
+
+def load_rows(rows):
+    """
+    Loads fetched ledger rows into integer arrays. Unknown accounts and currencies and missing transfers are -1.
+    :return: Returns a tuple of ids, ledger flags and available flags, and accounts, currencies, amounts and
+    transfer types of the debit side and then of the credit side.
+    """
+    columns = list(zip(*rows))
+    ids = np.array(columns[0], np.int64)
+    ledger_flags = np.array([LEDGER_TYPE_INDEX.get(value, 0) for value in columns[1]], np.bool_)
+    available_flags = np.array([AVAILABLE_TYPE_INDEX.get(value, 0) for value in columns[1]], np.bool_)
+    transfer_types = {"debit": 0, "credit": 1}
+    arrays = [ids, ledger_flags, available_flags]
+    for offset in (2, 6):
+        arrays += [
+            np.array([account_index.get(value, -1) for value in columns[offset]], np.int64),
+            np.array([CURRENCY_INDEX.get(value, -1) for value in columns[offset + 1]], np.int64),
+            np.array([value or 0 for value in columns[offset + 2]], np.int64),
+            np.array([transfer_types.get(value, -1) for value in columns[offset + 3]], np.int8),
+        ]
+    return arrays
+
+def id_shards(model, kind, shard_size, samples):
+    """
+    :return: Returns a list of audit_shard arguments which cover the ids of model.
+    """
+    ids = model.objects.aggregate(first=Min("id"), last=Max("id"))
+    if ids["first"] is None:
+        return []
+    return [(kind, start, start + shard_size, samples) for start in range(ids["first"], ids["last"] + 1, shard_size)]
+
+class Command(BaseCommand):
+    help = 'Checks the integrity of the ledger in id range shards with a pool of worker processes. Reports ' \
+           'transactions whose transfers are missing or don\'t match, transfers without a transaction, currencies ' \
+           'whose transfers don\'t sum to zero and stored balances which differ from the ledger. Postings made ' \
+           'during the audit can show up as differences, so run it on a quiet database or a copy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='The number of worker processes. With 1, the audit is run in this process.')
+        parser.add_argument('--shard-size', type=int, default=1000000, help='The number of ids in one shard.')
+        parser.add_argument('--samples', type=int, default=20, help='The number of reported ids of each problem.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['shard_size'] < 1:
+            raise CommandError("Workers and shard size must be positive.")
+        started = time.perf_counter()
+        account_names = list(Accounts.objects.order_by("pk").values_list("pk", flat=True))
+        account_index.clear()
+        account_index.update((name, index) for index, name in enumerate(account_names))
+        model = Postings if compact_ledger() else Transactions
+        shards = id_shards(model, "entries", options['shard_size'], options['samples'])
+        if not compact_ledger():
+            shards += id_shards(Transfers, "transfers", options['shard_size'], options['samples'])
+
+        if options['workers'] == 1:
+            results = [audit_shard(shard) for shard in shards]
+        else:
+            # forked workers must open their own database connections.
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(options['workers']) as pool:
+                results = pool.map(audit_shard, shards, chunksize=1)
+        problems = self.report(results, account_names, options['samples'])
+
+        elapsed = time.perf_counter() - started
+        rows = sum(result["rows"] for result in results)
+        self.stdout.write("Audited {0} ledger rows in {1} shards with {2} workers, {3:.1f} s, {4:.0f} rows/s."
+                          .format(rows, len(shards), options['workers'], elapsed, rows / elapsed if elapsed else 0))
+        if problems:
+            raise CommandError("The ledger has {0} problems.".format(problems))
+        self.stdout.write(self.style.SUCCESS("The ledger is consistent."))
+
+    def report(self, results, account_names, samples):
+        """
+        Merges the results of shards and writes the problems.
+        :return: Returns the number of problems.
+        """
+        problems = 0
+        for name in ("orphans", "mismatches"):
+            count = sum(result[name] for result in results)
+            if count:
+                problems += count
+                ids = sorted(id for result in results for id in result["sampled_" + name])[:samples]
+                self.stdout.write("{0} {1}{2}: {3}".format(
+                    count, "transfers without a transaction" if name == "orphans" else "transactions with missing "
+                    "or mismatching transfers", ", e.g." if count > len(ids) else "", ", ".join(map(str, ids))))
+
+        for index, total in enumerate(sum((result["currencies"] for result in results),
+                                          np.zeros(len(CURRENCY_LIST), np.int64))):
+            if total:
+                problems += 1
+                self.stdout.write("Transfers in {0} sum to {1} instead of zero."
+                                  .format(CURRENCY_LIST[index], from_minor_units(int(total), CURRENCY_LIST[index])))
+
+        keys, inverse = np.unique(np.concatenate([result["keys"] for result in results] or [[]]).astype(np.int64),
+                                  return_inverse=True)
+        totals = np.zeros((len(keys), 2), np.int64)
+        for column, name in enumerate(("ledger", "available")):
+            np.add.at(totals[:, column], inverse, np.concatenate([result[name] for result in results] or [[]])
+                      .astype(np.int64))
+        calculated = {(account_names[key // len(CURRENCY_LIST)], CURRENCY_LIST[key % len(CURRENCY_LIST)]):
+                      [int(ledger), int(available)] for key, (ledger, available) in zip(keys.tolist(), totals)}
+        CarriedBalances.add_to(calculated)
+        stored = {key: list(balance) for key, balance in Balances.stored_balances().items()}
+        for key in sorted(set(calculated) | set(stored)):
+            expected = calculated.get(key, [0, 0])
+            actual = stored.get(key, [0, 0])
+            if expected != actual:
+                problems += 1
+                self.stdout.write("{0} {1}: stored ledger {2} available {3}, ledger has {4} available {5}."
+                                  .format(key[0], key[1], *(from_minor_units(amount, key[1])
+                                                            for amount in actual + expected)))
+        return problems
@@ -0,0 +1,146 @@
+import json
+import random
+import statistics
+import time
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from issuerapp.models import Accounts, account_cache, SCHEME_NAME
+
+class Command(BaseCommand):
+    help = 'Benchmarks the authorization and presentment webhooks through the Django test client in a separate ' \
+           'test database. Prints throughput, latency percentiles and SQL queries per request of each endpoint. ' \
+           'Results can be saved as JSON and compared to a saved baseline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', type=int, default=100, help='The number of seeded accounts.')
+        parser.add_argument('--requests', type=int, default=2000, help='The number of webhook requests.')
+        parser.add_argument('--presentments', type=float, default=0.5,
+                            help='The share of presentments among the requests, between 0 and 1.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random request mix.')
+        parser.add_argument('--output', help='Save the results to a JSON file.')
+        parser.add_argument('--baseline', help='Fail if the results regressed from the results in a JSON file.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed relative drop of throughput and growth of p95 latency from the baseline.')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        account_cache.clear()
+        try:
+            cards = self.seed(options['accounts'])
+            with override_settings(ALLOWED_HOSTS=["testserver"]):
+                results = self.run(cards, options['requests'], options['presentments'], options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            account_cache.clear()
+
+        for endpoint, result in sorted(results.items()):
+            self.stdout.write("{0}: {1} requests, {2:.0f} requests/s, p50 {3:.2f} ms, p95 {4:.2f} ms, p99 {5:.2f} ms, "
+                              "{6:.1f} queries/request, statuses {7}"
+                              .format(endpoint, result["requests"], result["throughput"], result["p50_ms"],
+                                      result["p95_ms"], result["p99_ms"], result["queries_per_request"],
+                                      result["statuses"]))
+        if options['output']:
+            with open(options['output'], "w") as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        if options['baseline']:
+            with open(options['baseline']) as baseline:
+                regressions = self.compare(json.load(baseline), results, options['tolerance'])
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(regression))
+            if regressions:
+                raise CommandError("{0} regressions from the baseline.".format(len(regressions)))
+            self.stdout.write(self.style.SUCCESS("No regressions from the baseline."))
+
+    def seed(self, account_count):
+        """
+        Loads money into accounts with load_money command.
+        :return: List of card ids.
+        """
+        cards = ["card{0}".format(i) for i in range(account_count)]
+        for card in cards:
+            call_command("load_money", card, 1000000, "EUR", stdout=StringIO())
+        # presentments are settled to the scheme account.
+        Accounts.get_account(SCHEME_NAME, can_create_new_account=True)
+        return cards
+
+    def run(self, cards, request_count, presentment_share, seed):
+        """
+        Sends a random mix of authorizations and presentments of earlier authorizations.
+        :return: Dictionary of results by endpoint.
+        """
+        random.seed(seed)
+        client = Client()
+        authorized = []
+        measurements = {}
+        for i in range(request_count):
+            if authorized and random.random() < presentment_share:
+                endpoint = "/api/presentment"
+                data = {"transaction_id": authorized.pop(random.randrange(len(authorized))),
+                        "settlement_amount": "0.90", "settlement_currency": "EUR"}
+            else:
+                endpoint = "/api/authorization"
+                data = {"card_id": random.choice(cards), "transaction_id": "T{0}".format(i),
+                        "billing_amount": "1.00", "billing_currency": "EUR"}
+
+            queries = []
+            with connection.execute_wrapper(lambda execute, sql, params, many, context:
+                                            queries.append(sql) or execute(sql, params, many, context)):
+                started = time.perf_counter()
+                response = client.post(endpoint, data)
+                elapsed = time.perf_counter() - started
+            if endpoint == "/api/authorization" and response.status_code == 200:
+                authorized.append(data["transaction_id"])
+            measurements.setdefault(endpoint, []).append((elapsed, len(queries), response.status_code))
+        return {endpoint: self.summarize(measurement) for endpoint, measurement in measurements.items()}
+
+    @staticmethod
+    def summarize(measurements):
+        """
+        :param measurements: List of (seconds, query count, status) tuples of requests.
+        :return: Dictionary of throughput, latency percentiles, queries per request and status counts.
+        """
+        latencies = sorted(seconds for seconds, queries, status in measurements)
+        percentile = lambda p: latencies[max(int(round(len(latencies) * p)) - 1, 0)] * 1000
+        statuses = {}
+        for seconds, queries, status in measurements:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return {
+            "requests": len(measurements),
+            "throughput": len(latencies) / sum(latencies),
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "queries_per_request": sum(queries for seconds, queries, status in measurements) / len(measurements),
+            "statuses": statuses,
+        }
+
+    @staticmethod
+    def compare(baseline, results, tolerance):
+        """
+        Compares results to baseline. Query and error counts may not grow at all.
+        :return: List of regression descriptions.
+        """
+        regressions = []
+        for endpoint, expected in sorted(baseline.items()):
+            actual = results.get(endpoint)
+            if actual is None:
+                regressions.append("{0}: no requests.".format(endpoint))
+                continue
+            if actual["throughput"] < expected["throughput"] * (1 - tolerance):
+                regressions.append("{0}: throughput {1:.0f} requests/s, baseline {2:.0f} requests/s."
+                                   .format(endpoint, actual["throughput"], expected["throughput"]))
+            if actual["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+                regressions.append("{0}: p95 latency {1:.2f} ms, baseline {2:.2f} ms."
+                                   .format(endpoint, actual["p95_ms"], expected["p95_ms"]))
+            if actual["statuses"].get("400", 0) > expected["statuses"].get("400", 0):
+                regressions.append("{0}: {1} errors, baseline {2} errors."
+                                   .format(endpoint, actual["statuses"].get("400", 0),
+                                           expected["statuses"].get("400", 0)))
+            if actual["queries_per_request"] > expected["queries_per_request"]:
+                regressions.append("{0}: {1:.2f} queries/request, baseline {2:.2f} queries/request."
+                                   .format(endpoint, actual["queries_per_request"], expected["queries_per_request"]))
+        return regressions
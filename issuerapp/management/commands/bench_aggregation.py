@@ -0,0 +1,102 @@
+import statistics
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
+from django.db.models import Sum
+from django.db.models.expressions import RawSQL
+from issuerapp.currencies import currency_exponent, from_minor_units
+from issuerapp.models import Balances, Postings, Transfers, compact_ledger, LEDGER_TYPES, AVAILABLE_TYPES
+from .explain_queries import Command as ExplainQueriesCommand
+
+# the column of decimal amounts, which the ledger had before amounts were stored as minor units.
+DECIMAL_COLUMN = "decimal_amount"
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic ledger into a separate test database and compares the time of calculating balances ' \
+           'of all accounts with integer SUM of minor units and with SUM of decimal amounts in the database, like ' \
+           'before amounts were stored as minor units.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=100000, help='The number of seeded transactions.')
+        parser.add_argument('--accounts', type=int, default=1000, help='The number of seeded accounts.')
+        parser.add_argument('--repeat', type=int, default=3, help='How many times each calculation is timed.')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            ExplainQueriesCommand(stdout=self.stdout).seed(options['accounts'], options['transactions'])
+            self.add_decimal_amounts()
+            timings = {}
+            results = {}
+            for name, calculate in (("database integer SUM", Balances.calculate_from_ledger),
+                                    ("database decimal SUM", self.sum_decimals)):
+                timings[name] = []
+                for _ in range(options['repeat']):
+                    started = time.perf_counter()
+                    results[name] = calculate()
+                    timings[name].append(time.perf_counter() - started)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name, seconds in timings.items():
+            self.stdout.write("{0}: {1:.1f} ms, {2:.0f} transactions/s".format(
+                name, statistics.median(seconds) * 1000, options['transactions'] / statistics.median(seconds)))
+        expected = {key: tuple(from_minor_units(amount, key[1]) for amount in value)
+                    for key, value in results["database integer SUM"].items()}
+        if expected != results["database decimal SUM"]:
+            raise CommandError("The calculations have different balances.")
+        self.stdout.write(self.style.SUCCESS("Integer SUM is {0:.1f} times faster than decimal SUM.".format(
+            statistics.median(timings["database decimal SUM"]) / statistics.median(timings["database integer SUM"]))))
+
+    @staticmethod
+    def ledger_model():
+        """
+        :return: Returns the model whose rows have the amounts of the ledger.
+        """
+        return Postings if compact_ledger() else Transfers
+
+    def add_decimal_amounts(self):
+        """
+        Adds a column of decimal amounts to the seeded ledger, and copies the minor unit amounts into it.
+        """
+        field = models.DecimalField(max_digits=16, decimal_places=2, null=True)
+        table = connection.ops.quote_name(self.ledger_model()._meta.db_table)
+        with connection.cursor() as cursor:
+            # the table isn't rebuilt like with the schema editor, so foreign keys to it are kept.
+            cursor.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                table, connection.ops.quote_name(DECIMAL_COLUMN), field.db_type(connection)))
+            for currency in self.ledger_model().objects.values_list("currency", flat=True).distinct():
+                cursor.execute("UPDATE {0} SET {1} = amount / {2} WHERE currency = %s".format(
+                    table, connection.ops.quote_name(DECIMAL_COLUMN), 10.0 ** currency_exponent(currency)),
+                    [currency])
+
+    def sum_decimals(self):
+        """
+        Calculates balances of all accounts like Balances.calculate_from_ledger did before amounts were stored as 
+        minor units, with SUM of the decimal amounts in the database.
+        :return: Dictionary of (account_id, currency) keys and (ledger_balance, available_balance) Decimal values.
+        """
+        model = self.ledger_model()
+        amount = RawSQL("{0}.{1}".format(connection.ops.quote_name(model._meta.db_table),
+                                         connection.ops.quote_name(DECIMAL_COLUMN)), [])
+        balances = {}
+        for transaction_types, index in ((LEDGER_TYPES, 0), (AVAILABLE_TYPES, 1)):
+            for transfer_type, related_name, sign in (("debit", "transfer_from", -1), ("credit", "transfer_to", 1)):
+                if model is Postings:
+                    account_field = transfer_type + "_account_id"
+                    entries = Postings.objects.filter(transaction_type__in=transaction_types)
+                else:
+                    account_field = "account_id"
+                    entries = Transfers.objects.filter(**{"transfer_type": transfer_type,
+                                                          related_name + "__transaction_type__in": transaction_types})
+                totals = entries.values(account_field, "currency")\
+                    .annotate(total=Sum(amount, output_field=models.DecimalField(max_digits=16, decimal_places=2)))
+                for row in totals:
+                    key = (row[account_field], row["currency"])
+                    balance = balances.setdefault(key, [Decimal(0), Decimal(0)])
+                    balance[index] += sign * row["total"]
+        # SQLite sums decimals as floats, so the totals are rounded back to the decimal places of the currency.
+        return {key: tuple(Decimal(amount).quantize(Decimal(1).scaleb(-currency_exponent(key[1])))
+                           for amount in value)
+                for key, value in balances.items()}
@@ -0,0 +1,94 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from issuerapp.models import Accounts, Balances, Transactions, account_cache, ISSUER_NAME
+
+class Command(BaseCommand):
+    help = 'Measures how authorization throughput scales with the number of balance shards of the system accounts. ' \
+           'For each shard count, seeds a separate test database and runs authorizations from concurrent threads. ' \
+           'Every authorization credits the issuer account, so its balance rows are the contended ones. SQLite has ' \
+           'one write lock for the whole database, so shards only pay off on databases with row locks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                            help='The shard counts which are measured.')
+        parser.add_argument('--threads', type=int, default=16, help='The number of concurrent threads.')
+        parser.add_argument('--authorizations', type=int, default=2000,
+                            help='The number of authorizations per shard count.')
+        parser.add_argument('--accounts', type=int, default=64, help='The number of seeded accounts.')
+
+    def handle(self, *args, **options):
+        if min(options['shards']) < 1 or options['threads'] < 1 or options['accounts'] < options['threads']:
+            raise CommandError("Shards and threads must be positive and there must be an account for each thread.")
+        for shards in options['shards']:
+            with override_settings(ISSUER_SYSTEM_ACCOUNT_SHARDS=shards):
+                result = self.measure(options['threads'], options['authorizations'], options['accounts'])
+            self.stdout.write("{0} shards: {1:.0f} authorizations/s, p50 {2:.2f} ms, p95 {3:.2f} ms, {4} failed, "
+                              "{5} issuer balance rows".format(shards, *result))
+
+    def measure(self, thread_count, authorization_count, account_count):
+        """
+        Runs the authorizations against a new test database.
+        :return: Returns a tuple of throughput, p50 and p95 latency in milliseconds, the number of failed
+        authorizations and the number of balance rows of the issuer account.
+        """
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        account_cache.clear()
+        try:
+            cards = ["card{0}".format(i) for i in range(account_count)]
+            for card in cards:
+                call_command("load_money", card, 1000000, "EUR", stdout=StringIO())
+            # each thread has its own cards, so only the balances of the issuer account are shared.
+            counts = [authorization_count // thread_count + (i < authorization_count % thread_count)
+                      for i in range(thread_count)]
+            work = [(cards[i::thread_count], counts[i], i) for i in range(thread_count)]
+            with ThreadPoolExecutor(max_workers=thread_count) as executor:
+                started = time.perf_counter()
+                results = list(executor.map(lambda args: self.authorize(*args), work))
+                elapsed = time.perf_counter() - started
+            call_command("rebuild_balances", verify=True, stdout=StringIO())
+            rows = Balances.objects.filter(account_id=ISSUER_NAME).count()
+        finally:
+            connection.close()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            account_cache.clear()
+
+        latencies = sorted(latency for thread_latencies, failures in results for latency in thread_latencies)
+        failed = sum(failures for thread_latencies, failures in results)
+        if not latencies:
+            return 0.0, 0.0, 0.0, failed, rows
+        return (len(latencies) / elapsed, statistics.median(latencies) * 1000,
+                latencies[max(int(round(len(latencies) * 0.95)) - 1, 0)] * 1000, failed, rows)
+
+    @staticmethod
+    def authorize(cards, count, thread_number):
+        """
+        Runs authorizations of cards one after another in a thread.
+        :return: Returns a tuple of latencies of successful authorizations in seconds and the number of failures.
+        """
+        latencies = []
+        failures = 0
+        try:
+            issuer_account = Accounts.get_account(ISSUER_NAME)
+            accounts = [Accounts.get_account(card) for card in cards]
+            for i in range(count):
+                started = time.perf_counter()
+                try:
+                    transaction, balance = Transactions.authorize(accounts[i % len(accounts)], issuer_account, "EUR",
+                                                                  "1.00", "T{0}-{1}".format(thread_number, i))
+                except Exception:
+                    failures += 1
+                    continue
+                if transaction is None:
+                    failures += 1
+                else:
+                    latencies.append(time.perf_counter() - started)
+        finally:
+            # each thread has its own database connection.
+            connection.close()
+        return latencies, failures
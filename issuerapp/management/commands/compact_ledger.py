@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from issuerapp.models import Postings
+
+class Command(BaseCommand):
+    help = 'Copies the transactions and transfers of the ledger into the compact ledger. Run it before setting ' \
+           'ISSUER_COMPACT_LEDGER to True, if postings were made after the compact ledger was migrated.'
+
+    def handle(self, *args, **options):
+        copied = Postings.copy_from_transactions()
+        self.stdout.write(self.style.SUCCESS("Copied {0} transactions into postings.".format(copied)))
@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from issuerapp.models import Transactions
+
+class Command(BaseCommand):
+    help = 'Releases authorization holds which have expired without a presentment, so they don\'t reduce available ' \
+           'balances anymore. Holds are released in small batches, each in its own short database transaction, so ' \
+           'the command can be run every minute next to the webhooks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='The number of holds released in one database transaction.')
+        parser.add_argument('--time-limit', type=float, default=50,
+                            help='Seconds after which no more batches are started, so runs don\'t overlap.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("Batch size must be positive.")
+        started = time.perf_counter()
+        # holds which expire during the run are left to the next run.
+        now = timezone.now()
+        released = 0
+        while time.perf_counter() - started < options['time_limit']:
+            batch = Transactions.expire_holds(now, options['batch_size'])
+            if batch is None:
+                break
+            released += batch
+        self.stdout.write(self.style.SUCCESS("Released {0} expired holds in {1:.1f} s."
+                                             .format(released, time.perf_counter() - started)))
@@ -0,0 +1,144 @@
+import random
+import statistics
+import time
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.db.transaction import atomic
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from issuerapp.models import Accounts, Transfers, Transactions, Postings, OpenAuthorizations, compact_ledger
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic ledger into a separate test database and prints query plans and timings of the ' \
+           'ledger queries. Fails if any of the queries scans a whole table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=100000, help='The number of seeded transactions.')
+        parser.add_argument('--accounts', type=int, default=1000, help='The number of seeded accounts.')
+        parser.add_argument('--repeat', type=int, default=5, help='How many times each query is timed.')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the seeded database, and reuse it if it already exists.')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False,
+                                                      keepdb=options['keepdb'])
+        try:
+            if not Transactions.ledger_entries().exists():
+                self.seed(options['accounts'], options['transactions'])
+            scans = self.explain(options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+        if scans:
+            raise CommandError("{0} queries scan a whole table.".format(scans))
+        self.stdout.write(self.style.SUCCESS("All queries use indexes."))
+
+    def seed(self, account_count, transaction_count, batch_size=10000):
+        """
+        Inserts accounts and transactions, or postings if the compact ledger is used, with raw bulk inserts, and 
+        calculates their balances.
+        """
+        random.seed(0)
+        types = ["authorization"] * 1 + ["presentment"] * 6 + ["settlement"] * 3
+        now = timezone.now()
+        amount = 1234
+        transfers_sql = "INSERT INTO {0} (id, transfer_type, currency, amount, account_id) " \
+                        "VALUES (%s, %s, %s, %s, %s)".format(Transfers._meta.db_table)
+        transactions_sql = "INSERT INTO {0} (id, transaction_id, transfer_from_id, transfer_to_id, " \
+                           "transaction_type, created) VALUES (%s, %s, %s, %s, %s, %s)"\
+            .format(Transactions._meta.db_table)
+        postings_sql = "INSERT INTO {0} (id, transaction_id, debit_account_id, credit_account_id, transaction_type, " \
+                       "currency, amount, created) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"\
+            .format(Postings._meta.db_table)
+
+        Accounts.objects.bulk_create(Accounts(cardholder="card{0}".format(i)) for i in range(account_count))
+        started = time.perf_counter()
+        for first in range(1, transaction_count + 1, batch_size):
+            transfers = []
+            transactions = []
+            for i in range(first, min(first + batch_size, transaction_count + 1)):
+                debit, credit = random.sample(range(account_count), 2)
+                created = now - timezone.timedelta(seconds=random.randrange(2 * 365 * 24 * 3600))
+                transfers.append((2 * i - 1, "debit", "EUR", amount, "card{0}".format(debit)))
+                transfers.append((2 * i, "credit", "EUR", amount, "card{0}".format(credit)))
+                transactions.append((i, "T{0}".format(i), 2 * i - 1, 2 * i, random.choice(types),
+                                     connection.ops.adapt_datetimefield_value(created)))
+            with atomic(), connection.cursor() as cursor:
+                if compact_ledger():
+                    cursor.executemany(postings_sql, [
+                        (i, transaction_id, transfers[2 * index][4], transfers[2 * index + 1][4], transaction_type,
+                         "EUR", amount, created)
+                        for index, (i, transaction_id, _, _, transaction_type, created) in enumerate(transactions)])
+                else:
+                    cursor.executemany(transfers_sql, transfers)
+                    cursor.executemany(transactions_sql, transactions)
+            self.stdout.write("Seeded {0} transactions, {1:.0f} transactions/s."
+                              .format(transactions[-1][0], transactions[-1][0] / (time.perf_counter() - started)))
+        call_command("rebuild_balances", stdout=StringIO())
+        # like the migration of the account history indexes, so the query planner knows how selective they are.
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+    def explain(self, repeat):
+        """
+        Runs the ledger queries, and prints their timings and query plans.
+        :return: The number of queries which scan a whole table.
+        """
+        account = Accounts.objects.order_by("pk").first()
+        entries = Transactions.ledger_entries()
+        transaction_ids = list(entries.order_by("-pk").values_list("transaction_id", flat=True)[:500])
+        now = timezone.now()
+        month_ago = now - timezone.timedelta(days=30)
+        year_ago = now - timezone.timedelta(days=365)
+        operations = [
+            ("presentment lookup", lambda: list(entries.filter(transaction_id=transaction_ids[0]))),
+            ("presentment matching", lambda: list(entries.filter(transaction_id__in=transaction_ids,
+                                                                 transaction_type="authorization"))),
+            ("open authorization matching", lambda: list(OpenAuthorizations.objects
+                                                         .filter(transaction_id__in=transaction_ids))),
+            ("current balances", lambda: Transactions.show_balances(account.pk)),
+            ("balances at time threshold", lambda: Transactions.show_balances(account.pk, month_ago)),
+            ("transactions of last month", lambda: list(Transactions.get_transactions(account.pk, month_ago, now))),
+            ("transaction history page", lambda: list(Transactions.get_transactions(account.pk, month_ago, now)
+                                                      .order_by("created", "id")
+                                                      .filter(Q(created__gt=month_ago) | Q(created=month_ago,
+                                                                                           id__gt=0))[:101])),
+            ("transaction history export", lambda: list(Transactions.get_transactions(account.pk, year_ago, now)
+                                                        .order_by("created", "id").iterator(chunk_size=1000))),
+            ("expired holds", lambda: list(entries.filter(transaction_type="authorization", expires_at__lte=now)
+                                           .order_by("expires_at").values_list("id", flat=True)[:200])),
+        ]
+
+        scans = 0
+        for name, operation in operations:
+            with CaptureQueriesContext(connection) as queries:
+                operation()
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                operation()
+                timings.append((time.perf_counter() - started) * 1000)
+            self.stdout.write(self.style.MIGRATE_HEADING("{0}: {1:.2f} ms".format(name, statistics.median(timings))))
+            for query in queries.captured_queries:
+                self.stdout.write("  " + query["sql"][:200])
+                for plan in self.query_plan(query["sql"]):
+                    full_scan = plan.startswith("SCAN")
+                    scans += full_scan
+                    self.stdout.write("    " + (self.style.ERROR(plan) if full_scan else plan))
+        return scans
+
+    def query_plan(self, sql):
+        """
+        Gets query plan of a query.
+        :param sql: SQL query with parameters.
+        :return: List of query plan lines.
+        """
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                return [row[-1] for row in cursor.fetchall()]
+            cursor.execute("EXPLAIN " + sql)
+            return [" ".join(str(column) for column in row) for row in cursor.fetchall()]
@@ -0,0 +1,115 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic
+from django.utils import timezone
+from issuerapp.models import Accounts, Transactions, ClearingFiles, ISSUER_NAME, SCHEME_NAME
+from issuerapp.webhooks import presentment_of
+
+def read_records(file_name, file_format, offset):
+    """
+    Reads records of a clearing file one at a time.
+    :param file_name: The path of clearing file.
+    :param file_format: "csv" or "ndjson". CSV files must have a header line.
+    :param offset: Byte offset where reading is started.
+    :return: Generator of (byte offset after record, record) tuples. Records which can't be parsed are None.
+    """
+    with open(file_name, "rb") as file:
+        if file_format == "csv":
+            header = next(csv.reader([file.readline().decode("utf-8")]))
+            offset = max(offset, file.tell())
+        file.seek(offset)
+        for line in iter(file.readline, b""):
+            offset += len(line)
+            text = line.decode("utf-8").strip()
+            if not text:
+                continue
+            try:
+                if file_format == "csv":
+                    record = dict(zip(header, next(csv.reader([text]))))
+                else:
+                    record = json.loads(text)
+            except ValueError:
+                record = None
+            yield offset, record
+
+class Command(BaseCommand):
+    help = 'Applies presentments of a clearing file in chunks. An interrupted ingestion continues from the last ' \
+           'committed chunk. Records can clear a part of an authorization with clearing_amount and final_clearing ' \
+           'fields like the presentment webhook.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', type=str)
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='File format. By default it is guessed from the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='The number of records applied in one database transaction.')
+        parser.add_argument('--restart', action='store_true', help='Ignore the stored offset and start from the '
+                                                                   'beginning of the file.')
+
+    def handle(self, *args, **options):
+        file_name = os.path.abspath(options['file'])
+        file_format = options['format'] or ('csv' if file_name.lower().endswith('.csv') else 'ndjson')
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError("Chunk size must be positive.")
+        if not os.path.isfile(file_name):
+            raise CommandError("The file \"{}\" does not exist.".format(file_name))
+
+        issuer_account = Accounts.get_account(ISSUER_NAME)
+        scheme_account = Accounts.get_account(SCHEME_NAME)
+        clearing_file, _ = ClearingFiles.objects.get_or_create(file_name=file_name)
+        if options['restart']:
+            clearing_file.offset = clearing_file.records = 0
+        elif clearing_file.offset:
+            self.stdout.write("Continuing from offset {0} after {1} records."
+                              .format(clearing_file.offset, clearing_file.records))
+
+        records = read_records(file_name, file_format, clearing_file.offset)
+        started = time.perf_counter()
+        totals = {"records": 0, "presented": 0, "unmatched": 0, "rejected": 0}
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            chunk_started = time.perf_counter()
+            presentments = []
+            for _, record in chunk:
+                try:
+                    presentment = presentment_of(record)
+                    Transactions.validate_posting({"debit_account": issuer_account, "credit_account": scheme_account,
+                                                   "transaction_type": "settlement",
+                                                   "currency": presentment["currency"],
+                                                   "amount": presentment["amount"]})
+                    presentments.append(presentment)
+                except Exception as e:
+                    totals["rejected"] += 1
+                    self.stderr.write("Rejected record {0}: {1}".format(record, e))
+
+            with atomic():
+                # the offset is written first, so it is committed together with the chunk.
+                clearing_file.offset = chunk[-1][0]
+                clearing_file.records += len(chunk)
+                clearing_file.updated = timezone.now()
+                ClearingFiles.objects.filter(pk=clearing_file.pk).update(offset=clearing_file.offset,
+                                                                         records=clearing_file.records,
+                                                                         updated=clearing_file.updated)
+                presented = Transactions.present_many(presentments)
+
+            matched = sum(transaction is not None for transaction in presented)
+            totals["records"] += len(chunk)
+            totals["presented"] += matched
+            totals["unmatched"] += len(presented) - matched
+            elapsed = time.perf_counter() - chunk_started
+            self.stdout.write("Committed {0} records up to offset {1}: {2} presented, {3} unmatched, "
+                              "{4:.0f} records/s.".format(len(chunk), clearing_file.offset, matched,
+                                                          len(presented) - matched, len(chunk) / elapsed))
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            "Ingested {records} records: {presented} presented, {unmatched} unmatched, {rejected} rejected."
+            .format(**totals) + " {0:.1f} s, {1:.0f} records/s.".format(elapsed, totals["records"] / elapsed
+                                                                        if elapsed else 0)))
@@ -1,20 +1,45 @@
-from django.core.management.base import BaseCommand
+import json
+import os
+import time
+from itertools import islice
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+from django.db.transaction import atomic
 from issuerapp.models import Accounts, Transactions, ISSUER_NAME
+from .ingest_clearing import read_records
 
 class Command(BaseCommand):
-    help = 'Load money into cardholder\'s account. Creates new account if needed.'
+    help = 'Load money into cardholder\'s account. Creates new account if needed. With --file, loads money into ' \
+           'the accounts of a CSV or NDJSON file of cardholder, amount and currency records in chunks.'
 
     def add_arguments(self, parser):
-        parser.add_argument('cardholder', type=str)
-        parser.add_argument('amount', type=float)
-        parser.add_argument('currency', type=str)
+        parser.add_argument('cardholder', type=str, nargs='?')
+        # amount is kept as a string, so it is converted to minor units without float rounding.
+        parser.add_argument('amount', type=str, nargs='?')
+        parser.add_argument('currency', type=str, nargs='?')
+        parser.add_argument('--file', type=str, help='CSV or NDJSON file of records with cardholder, amount and '
+                                                     'currency. CSV files must have a header line.')
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='File format. By default it is guessed from the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='The number of records loaded in one database transaction.')
+        parser.add_argument('--rejects', type=str, help='NDJSON file where invalid records are written. By default '
+                                                        'it is the file name with .rejects.ndjson suffix.')
 
     def handle(self, *args, **options):
+        if options['file']:
+            if options['cardholder'] is not None:
+                raise CommandError("Give either a cardholder, amount and currency or --file.")
+            self.load_file(options)
+            return
+        if options['currency'] is None:
+            raise CommandError("Give a cardholder, amount and currency, or --file.")
         cardholder = options['cardholder']
         amount = options['amount']
         currency = options['currency']
         #TODO: should check arguments here
-        
+
         issuer_account = Accounts.get_account(ISSUER_NAME, can_create_new_account=True)
         cardholder_account = Accounts.get_account(cardholder, can_create_new_account=True)
 
@@ -24,4 +49,108 @@ class Command(BaseCommand):
             self.stdout.write(self.style.SUCCESS("Successfully transferred {0} {1} to {2}."
                                                  .format(amount, currency, cardholder_account.cardholder)))
         except Exception as e:
-            self.stdout.write(self.style.ERROR("Transfer FAILED! Error: {0}".format(e)))
\ No newline at end of file
+            self.stdout.write(self.style.ERROR("Transfer FAILED! Error: {0}".format(e)))
+
+    def load_file(self, options):
+        """
+        Loads money into the accounts of a file. Each chunk creates its missing accounts with one bulk insert and
+        posts its loads with bulk inserts in one database transaction. Invalid records, and records which the 
+        database refuses, are written to the reject file.
+        :param options: Options of the command.
+        :return: None
+        """
+        file_name = os.path.abspath(options['file'])
+        file_format = options['format'] or ('csv' if file_name.lower().endswith('.csv') else 'ndjson')
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError("Chunk size must be positive.")
+        if not os.path.isfile(file_name):
+            raise CommandError("The file \"{}\" does not exist.".format(file_name))
+        rejects_name = options['rejects'] or os.path.splitext(file_name)[0] + '.rejects.ndjson'
+
+        issuer_account = Accounts.get_account(ISSUER_NAME, can_create_new_account=True)
+        records = read_records(file_name, file_format, 0)
+        started = time.perf_counter()
+        totals = {"records": 0, "loaded": 0, "created": 0, "rejected": 0}
+        with open(rejects_name, 'w') as rejects:
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                chunk_started = time.perf_counter()
+                postings = []
+                for _, record in chunk:
+                    try:
+                        postings.append((record, self.validate_record(record, issuer_account)))
+                    except Exception as e:
+                        totals["rejected"] += 1
+                        rejects.write(json.dumps({"record": record, "error": str(e)}) + "\n")
+
+                loaded, created, rejected = self.load_chunk(postings, rejects)
+
+                totals["records"] += len(chunk)
+                totals["loaded"] += loaded
+                totals["created"] += created
+                totals["rejected"] += rejected
+                elapsed = time.perf_counter() - chunk_started
+                self.stdout.write("Committed {0} records: {1} loaded, {2} accounts created, {3:.0f} records/s."
+                                  .format(len(chunk), loaded, created, len(chunk) / elapsed))
+
+        elapsed = time.perf_counter() - started
+        if not totals["rejected"]:
+            os.remove(rejects_name)
+        self.stdout.write(self.style.SUCCESS(
+            "Loaded {loaded} of {records} records, created {created} accounts, rejected {rejected}.".format(**totals)
+            + " {0:.1f} s, {1:.0f} records/s.".format(elapsed, totals["records"] / elapsed if elapsed else 0)))
+
+    def load_chunk(self, postings, rejects):
+        """
+        Loads the postings of a chunk in one database transaction. If the database refuses the chunk, e.g. an 
+        account was created concurrently, the postings are loaded one by one and the refused ones are rejected.
+        :param postings: List of (record, posting) tuples.
+        :param rejects: The reject file.
+        :return: Returns a tuple of the number of loaded postings, created accounts and rejected records.
+        """
+        try:
+            return len(postings), self.post([posting for _, posting in postings]), 0
+        except (IntegrityError, ValidationError):
+            pass
+        loaded, created, rejected = 0, 0, 0
+        for record, posting in postings:
+            try:
+                created += self.post([posting])
+                loaded += 1
+            except (IntegrityError, ValidationError) as e:
+                rejected += 1
+                rejects.write(json.dumps({"record": record, "error": str(e)}) + "\n")
+        return loaded, created, rejected
+
+    @staticmethod
+    def post(postings):
+        """
+        Creates the missing accounts of postings and posts them in one database transaction.
+        :param postings: Postings for Transactions.bulk_create_transactions.
+        :return: Returns the number of created accounts.
+        """
+        with atomic():
+            created = Accounts.create_missing([posting["credit_account"].pk for posting in postings])
+            Transactions.bulk_create_transactions(postings)
+        return created
+
+    @staticmethod
+    def validate_record(record, issuer_account):
+        """
+        Validates a record without database queries.
+        :param record: Dictionary with "cardholder", "amount" and "currency" keys.
+        :param issuer_account: The account where the money is taken.
+        :return: Returns the posting of the load for Transactions.bulk_create_transactions.
+        """
+        if not isinstance(record, dict):
+            raise ValueError("The record can't be parsed.")
+        # the account is created later if it doesn't exist, so only its fields are validated here.
+        account = Accounts(cardholder=record["cardholder"])
+        account.clean_fields()
+        posting = {"debit_account": issuer_account, "credit_account": account, "transaction_type": "authorization",
+                   "currency": record["currency"], "amount": record["amount"]}
+        Transactions.validate_posting(posting)
+        return posting
@@ -0,0 +1,144 @@
+import asyncio
+import statistics
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from issuerapp import asgi
+from issuerapp.models import Accounts, account_cache, SCHEME_NAME
+
+class Command(BaseCommand):
+    help = 'Compares the WSGI and ASGI deployments of the authorization and presentment webhooks. Seeds accounts ' \
+           'into a separate test database, sends the requests from concurrent clients and prints requests/s and ' \
+           'latency percentiles of both.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='The number of authorizations, and the number of presentments, per deployment.')
+        parser.add_argument('--concurrency', type=int, default=256, help='The number of concurrent clients.')
+        parser.add_argument('--accounts', type=int, default=100, help='The number of seeded accounts.')
+        parser.add_argument('--sqlite-defaults', action='store_true',
+                            help='Use SQLite without the pragmas and serialized writes of ISSUER_SQLITE_PRODUCTION '
+                                 'setting.')
+
+    def handle(self, *args, **options):
+        profile = {} if options['sqlite_defaults'] else getattr(settings, "ISSUER_SQLITE_PRODUCTION", {})
+        with override_settings(ISSUER_SQLITE=profile):
+            self.compare(options)
+
+    def compare(self, options):
+        """
+        Runs the deployments one after another against the same seeded test database.
+        """
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        account_cache.clear()
+        try:
+            cards = self.seed(options['accounts'])
+            # both deployments have the same number of threads for the database work.
+            wsgi_executor = ThreadPoolExecutor(max_workers=getattr(settings, "ISSUER_ASGI_THREADS", 32))
+            wsgi_application = WSGIHandler()
+            deployments = [
+                ("wsgi", lambda path, body: self.call_wsgi(wsgi_executor, wsgi_application, path, body)),
+                ("asgi", self.call_asgi),
+            ]
+            with override_settings(ALLOWED_HOSTS=["*"]):
+                for name, call in deployments:
+                    self.run_deployment(name, call, cards, options['requests'], options['concurrency'])
+            wsgi_executor.shutdown()
+        finally:
+            connection.close()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            account_cache.clear()
+
+    def seed(self, account_count):
+        """
+        Loads money into accounts with load_money command.
+        :return: List of card ids.
+        """
+        cards = ["card{0}".format(i) for i in range(account_count)]
+        for card in cards:
+            call_command("load_money", card, 1000000, "EUR", stdout=StringIO())
+        # presentments are settled to the scheme account.
+        Accounts.get_account(SCHEME_NAME, can_create_new_account=True)
+        return cards
+
+    def run_deployment(self, name, call, cards, request_count, concurrency):
+        """
+        Sends authorizations and then presentments of the same transactions, and prints the results.
+        """
+        authorizations = [("/api/authorization", {
+            "card_id": cards[i % len(cards)], "transaction_id": "{0}{1}".format(name, i),
+            "billing_amount": "1.00", "billing_currency": "EUR"
+        }) for i in range(request_count)]
+        presentments = [("/api/presentment", {
+            "transaction_id": "{0}{1}".format(name, i), "settlement_amount": "0.90", "settlement_currency": "EUR"
+        }) for i in range(request_count)]
+
+        for requests in (authorizations, presentments):
+            elapsed, latencies, statuses = asyncio.run(self.drive(call, requests, concurrency))
+            latencies.sort()
+            self.stdout.write("{0} {1}: {2:.0f} requests/s, p50 {3:.1f} ms, p99 {4:.1f} ms, statuses {5}".format(
+                name, requests[0][0], len(requests) / elapsed, statistics.median(latencies) * 1000,
+                latencies[int(len(latencies) * 0.99) - 1] * 1000, dict(sorted(statuses.items()))))
+
+    async def drive(self, call, requests, concurrency):
+        """
+        Sends the requests from concurrent clients, each sending its next request after the previous response.
+        :return: Tuple of elapsed seconds, list of latencies in seconds and Counter of response statuses.
+        """
+        pending = iter(requests)
+        latencies = []
+        statuses = Counter()
+
+        async def client():
+            for path, data in pending:
+                started = time.perf_counter()
+                status = await call(path, urlencode(data).encode())
+                latencies.append(time.perf_counter() - started)
+                statuses[status] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return time.perf_counter() - started, latencies, statuses
+
+    @staticmethod
+    async def call_wsgi(executor, application, path, body):
+        def request():
+            environ = {
+                "REQUEST_METHOD": "POST", "PATH_INFO": path, "SCRIPT_NAME": "", "QUERY_STRING": "",
+                "SERVER_NAME": "localhost", "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1",
+                "CONTENT_TYPE": "application/x-www-form-urlencoded", "CONTENT_LENGTH": str(len(body)),
+                "wsgi.input": BytesIO(body), "wsgi.errors": sys.stderr, "wsgi.url_scheme": "http",
+                "wsgi.version": (1, 0), "wsgi.multithread": True, "wsgi.multiprocess": False,
+                "wsgi.run_once": False,
+            }
+            status = []
+            response = application(environ, lambda response_status, headers: status.append(response_status))
+            b"".join(response)
+            response.close()
+            return int(status[0].split()[0])
+        return await asyncio.get_event_loop().run_in_executor(executor, request)
+
+    @staticmethod
+    async def call_asgi(path, body):
+        scope = {"type": "http", "method": "POST", "path": path, "query_string": b"",
+                 "headers": [(b"content-type", b"application/x-www-form-urlencoded")]}
+        status = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+
+        await asgi.application(scope, receive, send)
+        return status[0]
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from issuerapp.models import WebhookResponses
+
+class Command(BaseCommand):
+    help = 'Deletes stored webhook responses which have expired.'
+
+    def handle(self, *args, **options):
+        deleted = WebhookResponses.purge()
+        self.stdout.write(self.style.SUCCESS("Deleted {0} expired responses.".format(deleted)))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic
+from issuerapp.currencies import from_minor_units
+from issuerapp.models import Balances
+
+class Command(BaseCommand):
+    help = 'Recalculates account balances from the ledger. With --verify, only reports balances which differ.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Compare stored balances to the ledger without changing them.')
+
+    def handle(self, *args, **options):
+        with atomic():
+            calculated = Balances.calculate_from_ledger()
+            stored = Balances.stored_balances()
+
+            mismatches = 0
+            for key in sorted(set(calculated) | set(stored)):
+                expected = calculated.get(key, (0, 0))
+                actual = stored.get(key, (0, 0))
+                if expected != actual:
+                    mismatches += 1
+                    self.stdout.write("{0} {1}: stored ledger {2} available {3}, ledger has {4} available {5}."
+                                      .format(key[0], key[1], *(from_minor_units(amount, key[1])
+                                                                for amount in actual + expected)))
+
+            if options['verify']:
+                if mismatches:
+                    raise CommandError("{0} balances differ from the ledger.".format(mismatches))
+                self.stdout.write(self.style.SUCCESS("All {0} balances match the ledger.".format(len(stored))))
+                return
+
+            # shards of the system accounts are merged into one row, and later postings spread them again.
+            Balances.objects.all().delete()
+            Balances.objects.bulk_create(
+                Balances(account_id=account_id, currency=currency, ledger_balance=ledger, available_balance=available)
+                for (account_id, currency), (ledger, available) in calculated.items()
+            )
+            self.stdout.write(self.style.SUCCESS("Rebuilt {0} balances, {1} of them were wrong."
+                                                 .format(len(calculated), mismatches)))
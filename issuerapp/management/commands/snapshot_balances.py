@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from issuerapp.models import Balances, BalanceSnapshots
+
+class Command(BaseCommand):
+    help = 'Writes ledger balance snapshots of all accounts at daily checkpoints. By default the checkpoint is the ' \
+           'start of the current day. Existing snapshots of the checkpoints are recalculated.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--at', type=str, help='The last checkpoint as ISO datetime instead of start of the day.')
+        parser.add_argument('--days', type=int, default=1,
+                            help='The number of daily checkpoints which are written, ending at the last checkpoint.')
+
+    def handle(self, *args, **options):
+        if options['at']:
+            checkpoint = parse_datetime(options['at'])
+            if checkpoint is None:
+                raise CommandError("\"{}\" is not a valid datetime.".format(options['at']))
+            if timezone.is_naive(checkpoint):
+                checkpoint = timezone.make_aware(checkpoint)
+        else:
+            checkpoint = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+        if checkpoint > timezone.now():
+            raise CommandError("Snapshots can't be taken in the future.")
+
+        for day in reversed(range(options['days'])):
+            taken_at = checkpoint - timezone.timedelta(days=day)
+            with atomic():
+                balances = Balances.calculate_from_ledger(taken_at)
+                BalanceSnapshots.objects.filter(taken_at=taken_at).delete()
+                BalanceSnapshots.objects.bulk_create(
+                    BalanceSnapshots(account_id=account_id, currency=currency, taken_at=taken_at,
+                                     ledger_balance=ledger_balance)
+                    for (account_id, currency), (ledger_balance, _) in balances.items()
+                )
+            self.stdout.write(self.style.SUCCESS("Wrote {0} snapshots at {1}.".format(len(balances), taken_at)))
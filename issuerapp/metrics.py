@@ -0,0 +1,135 @@
+import threading
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class Metrics:
+    """
+    Thread-safe in-process registry of counters and histograms, rendered in Prometheus text format. Each worker
+    process has its own registry, so it has to be scraped per process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._buckets = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def counter(self, name, help_text):
+        """
+        Registers a counter.
+        :param name: The metric name.
+        :param help_text: The description of the metric.
+        :return: None
+        """
+        self._help[name] = ("counter", help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        """
+        Registers a histogram.
+        :param name: The metric name.
+        :param help_text: The description of the metric.
+        :param buckets: Sorted upper bounds of the buckets. The +Inf bucket is added.
+        :return: None
+        """
+        self._help[name] = ("histogram", help_text)
+        self._buckets[name] = tuple(buckets)
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increments a counter.
+        :param name: The registered counter name.
+        :param amount: The increment.
+        :param labels: Label values of the time series.
+        :return: None
+        """
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        Adds an observation to a histogram.
+        :param name: The registered histogram name.
+        :param value: The observed value.
+        :param labels: Label values of the time series.
+        :return: None
+        """
+        buckets = self._buckets[name]
+        key = (name, self._labels(labels))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [[0] * len(buckets), 0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    def clear(self):
+        """
+        Resets all counters and histograms.
+        :return: None
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                              for name, value in labels) + "}"
+
+    def render(self):
+        """
+        :return: Returns all metrics in Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(series[0]), series[1], series[2]) for key, series in self._histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text) in sorted(self._help.items()):
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, metric_type))
+            if metric_type == "counter":
+                for (series_name, labels), value in sorted(counters.items()):
+                    if series_name == name:
+                        lines.append("{0}{1} {2}".format(name, self._format_labels(labels), value))
+                continue
+            for (series_name, labels), (counts, count, total) in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets[name], counts):
+                    cumulative += bucket_count
+                    lines.append("{0}_bucket{1} {2}".format(name, self._format_labels(labels + (("le", bound),)),
+                                                            cumulative))
+                lines.append("{0}_bucket{1} {2}".format(name, self._format_labels(labels + (("le", "+Inf"),)), count))
+                lines.append("{0}_sum{1} {2}".format(name, self._format_labels(labels), total))
+                lines.append("{0}_count{1} {2}".format(name, self._format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("issuer_request_duration_seconds", "Wall time of requests.")
+metrics.histogram("issuer_request_db_duration_seconds", "Time spent in SQL queries per request.")
+metrics.histogram("issuer_request_db_queries", "SQL queries per request.", buckets=QUERY_BUCKETS)
+metrics.counter("issuer_authorizations_total", "Results of authorization messages.")
+metrics.counter("issuer_presentments_total", "Results of presentment messages.")
+metrics.counter("issuer_webhook_replays_total", "Retried webhook messages answered with a stored response.")
+metrics.histogram("issuer_writer_batch_size", "Writes committed together by the serialized writer.",
+                  buckets=BATCH_BUCKETS)
+metrics.histogram("issuer_writer_added_latency_seconds", "Time writes waited for the serialized writer and the "
+                                                         "commit of their group.")
+metrics.counter("issuer_writer_group_failures_total", "Groups of writes which were committed one by one after "
+                                                      "their group commit failed.")
@@ -0,0 +1,44 @@
+import time
+from django.db import connection
+
+from .metrics import metrics
+
+class QueryTimer:
+    """
+    Database execute wrapper which counts queries and their total time.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.queries += 1
+
+class MetricsMiddleware:
+    """
+    Records wall time, the number of SQL queries and database time of requests to issuerapp views. Queries are
+    counted with an execute wrapper, so DEBUG query logging is not needed.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        if match is not None and match.func.__module__.startswith("issuerapp.") and match.url_name != "metrics":
+            metrics.observe("issuer_request_duration_seconds", duration, endpoint=match.url_name)
+            metrics.observe("issuer_request_db_duration_seconds", timer.duration, endpoint=match.url_name)
+            metrics.observe("issuer_request_db_queries", timer.queries, endpoint=match.url_name)
+        return response
@@ -0,0 +1,24 @@
+# Generated by Django 2.1.2 on 2026-10-17 00:32
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0006_balances'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClearingFiles',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255, unique=True)),
+                ('offset', models.BigIntegerField(default=0)),
+                ('records', models.BigIntegerField(default=0)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
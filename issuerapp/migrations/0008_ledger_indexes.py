@@ -0,0 +1,25 @@
+# Generated by Django 2.1.2 on 2026-10-17 00:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0007_clearingfiles'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transactions',
+            index=models.Index(fields=['transaction_id', 'transaction_type'], name='issuerapp_t_transac_48ae95_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactions',
+            index=models.Index(fields=['transaction_type', 'created'], name='issuerapp_t_transac_a5c239_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfers',
+            index=models.Index(fields=['account', 'currency'], name='issuerapp_t_account_44a411_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.1.2 on 2026-10-17 00:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0009_balancesnapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookResponses',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_type', models.CharField(choices=[('authorization', 'authorization'), ('presentment', 'presentment')], max_length=13)),
+                ('transaction_id', models.CharField(max_length=20)),
+                ('status', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('content', models.TextField(blank=True)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='webhookresponses',
+            index=models.Index(fields=['expires_at'], name='issuerapp_w_expires_b339f1_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='webhookresponses',
+            unique_together={('message_type', 'transaction_id')},
+        ),
+    ]
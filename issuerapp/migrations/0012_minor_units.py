@@ -0,0 +1,181 @@
+import django.core.validators
+from django.db import migrations, models
+
+# ISO 4217 minor unit exponents of currencies which don't have two decimal places, as they were when the amounts
+# were converted. They are frozen here, so later changes of issuerapp.currencies don't change the migration.
+EXPONENTS = {
+    'BIF': 0, 'BYR': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'ISK': 0, 'JPY': 0, 'KMF': 0, 'KRW': 0, 'PYG': 0, 'RWF': 0,
+    'UGX': 0, 'UYI': 0, 'VND': 0, 'VUV': 0, 'XAF': 0, 'XOF': 0, 'XPF': 0,
+    'BHD': 3, 'IQD': 3, 'JOD': 3, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'TND': 3,
+    'CLF': 4,
+}
+DEFAULT_EXPONENT = 2
+
+# decimal amount columns of the models, which are converted to integer minor units.
+AMOUNT_FIELDS = (
+    ('Transfers', ('amount',)),
+    ('Postings', ('amount',)),
+    ('Balances', ('ledger_balance', 'available_balance')),
+    ('BalanceSnapshots', ('ledger_balance',)),
+)
+
+
+def set_legacy_alter_table(enabled):
+    """
+    SQLite 3.26 and newer rewrite foreign keys of other tables when a table is renamed, so rebuilding transfers
+    table for the new columns would point the foreign keys of transactions to a dropped table.
+    """
+    def set_pragma(apps, schema_editor):
+        if schema_editor.connection.vendor == 'sqlite':
+            schema_editor.execute('PRAGMA legacy_alter_table = {}'.format('ON' if enabled else 'OFF'))
+    return set_pragma
+
+
+def currency_exponents(model):
+    """
+    :return: Returns a sorted list of (exponent, currencies) tuples of the currencies in the rows of model.
+    """
+    exponents = {}
+    for currency in model.objects.values_list('currency', flat=True).distinct():
+        exponents.setdefault(EXPONENTS.get(currency, DEFAULT_EXPONENT), []).append(currency)
+    return sorted(exponents.items())
+
+
+def convert_amounts(apps, schema_editor):
+    """
+    Copies decimal amounts into the minor unit columns with one UPDATE per currency exponent. Amounts have at most
+    two decimal places and 14 digits, so they are exact even where the database multiplies them as floats. Amounts
+    which have more decimal places than their currency can't be converted, and the migration fails on them.
+    """
+    for model_name, columns in AMOUNT_FIELDS:
+        model = apps.get_model('issuerapp', model_name)
+        for exponent, currencies in currency_exponents(model):
+            condition = 'currency IN ({})'.format(', '.join(['%s'] * len(currencies)))
+            for column in columns:
+                if exponent < DEFAULT_EXPONENT:
+                    with schema_editor.connection.cursor() as cursor:
+                        cursor.execute('SELECT COUNT(*) FROM {0} WHERE {1} AND {2} <> ROUND({2}, {3})'
+                                       .format(model._meta.db_table, condition, column, exponent), currencies)
+                        fractional = cursor.fetchone()[0]
+                    if fractional:
+                        raise ValueError('{} {} rows of {} have more decimal places than their currency.'
+                                         .format(fractional, column, model_name))
+                schema_editor.execute('UPDATE {0} SET {1}_units = ROUND({1} * {2}) WHERE {3}'
+                                      .format(model._meta.db_table, column, 10 ** exponent, condition), currencies)
+
+
+def convert_units(apps, schema_editor):
+    """
+    Copies minor unit amounts back into the decimal columns when the migration is unapplied. The amounts have at 
+    most 14 digits, so they are exact even where the database divides them as floats.
+    """
+    for model_name, columns in AMOUNT_FIELDS:
+        model = apps.get_model('issuerapp', model_name)
+        for exponent, currencies in currency_exponents(model):
+            condition = 'currency IN ({})'.format(', '.join(['%s'] * len(currencies)))
+            for column in columns:
+                schema_editor.execute('UPDATE {0} SET {1} = {1}_units / {2}.0 WHERE {3}'
+                                      .format(model._meta.db_table, column, 10 ** exponent, condition), currencies)
+
+
+class RemoveDecimalField(migrations.RemoveField):
+    """
+    Removes a decimal amount column. When the migration is unapplied, the column is added back with a zero default
+    like AddField with preserve_default=False, because the rows need a value before convert_units copies the
+    amounts into it.
+    """
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        to_model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, to_model):
+            from_model = from_state.apps.get_model(app_label, self.model_name)
+            field = to_model._meta.get_field(self.name)
+            default = field.default
+            field.default = 0
+            schema_editor.add_field(from_model, field)
+            field.default = default
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0011_postings'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_legacy_alter_table(True), set_legacy_alter_table(False)),
+        migrations.AddField(
+            model_name='transfers',
+            name='amount_units',
+            field=models.BigIntegerField(default=0, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(99999999999999)]),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='postings',
+            name='amount_units',
+            field=models.BigIntegerField(default=0, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(99999999999999)]),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='balances',
+            name='ledger_balance_units',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='balances',
+            name='available_balance_units',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='balancesnapshots',
+            name='ledger_balance_units',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(convert_amounts, convert_units),
+        RemoveDecimalField(
+            model_name='transfers',
+            name='amount',
+        ),
+        migrations.RenameField(
+            model_name='transfers',
+            old_name='amount_units',
+            new_name='amount',
+        ),
+        RemoveDecimalField(
+            model_name='postings',
+            name='amount',
+        ),
+        migrations.RenameField(
+            model_name='postings',
+            old_name='amount_units',
+            new_name='amount',
+        ),
+        RemoveDecimalField(
+            model_name='balances',
+            name='ledger_balance',
+        ),
+        migrations.RenameField(
+            model_name='balances',
+            old_name='ledger_balance_units',
+            new_name='ledger_balance',
+        ),
+        RemoveDecimalField(
+            model_name='balances',
+            name='available_balance',
+        ),
+        migrations.RenameField(
+            model_name='balances',
+            old_name='available_balance_units',
+            new_name='available_balance',
+        ),
+        RemoveDecimalField(
+            model_name='balancesnapshots',
+            name='ledger_balance',
+        ),
+        migrations.RenameField(
+            model_name='balancesnapshots',
+            old_name='ledger_balance_units',
+            new_name='ledger_balance',
+        ),
+        migrations.RunPython(set_legacy_alter_table(False), set_legacy_alter_table(True)),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.1.2 on 2026-10-17 01:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0013_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balances',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='balances',
+            unique_together={('account', 'currency', 'shard')},
+        ),
+    ]
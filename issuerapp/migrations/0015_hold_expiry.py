@@ -0,0 +1,46 @@
+# Generated by Django 2.1.2 on 2026-10-17 01:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0014_balance_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postings',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='transactions',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='archivedpostings',
+            name='transaction_type',
+            field=models.CharField(choices=[('authorization', 'authorization'), ('presentment', 'presentment'), ('settlement', 'settlement'), ('expired', 'expired')], max_length=13),
+        ),
+        migrations.AlterField(
+            model_name='postings',
+            name='transaction_type',
+            field=models.CharField(choices=[('authorization', 'authorization'), ('presentment', 'presentment'), ('settlement', 'settlement'), ('expired', 'expired')], max_length=13),
+        ),
+        migrations.AlterField(
+            model_name='transactions',
+            name='transaction_type',
+            field=models.CharField(choices=[('authorization', 'authorization'), ('presentment', 'presentment'), ('settlement', 'settlement'), ('expired', 'expired')], max_length=13),
+        ),
+        migrations.AddIndex(
+            model_name='postings',
+            index=models.Index(fields=['transaction_type', 'expires_at'], name='issuerapp_p_transac_906ccb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactions',
+            index=models.Index(fields=['transaction_type', 'expires_at'], name='issuerapp_t_transac_b192a0_idx'),
+        ),
+    ]
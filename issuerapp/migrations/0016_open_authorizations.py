@@ -0,0 +1,41 @@
+# Generated by Django 2.1.2 on 2026-10-17 01:45
+
+import django.core.validators
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_authorizations(apps, schema_editor):
+    """
+    Adds the authorizations of the ledger which have a transaction_id to the book of open authorizations.
+    """
+    OpenAuthorizations = apps.get_model('issuerapp', 'OpenAuthorizations')
+    if getattr(settings, 'ISSUER_COMPACT_LEDGER', False):
+        entries = apps.get_model('issuerapp', 'Postings').objects.values_list('id', 'transaction_id', 'amount')
+    else:
+        entries = apps.get_model('issuerapp', 'Transactions').objects\
+            .values_list('id', 'transaction_id', 'transfer_from__amount')
+    OpenAuthorizations.objects.bulk_create(
+        (OpenAuthorizations(entry_id=entry_id, transaction_id=transaction_id, remaining_amount=amount)
+         for entry_id, transaction_id, amount in entries.filter(transaction_type='authorization')
+         .exclude(transaction_id='').iterator()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0015_hold_expiry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpenAuthorizations',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_id', models.CharField(db_index=True, max_length=20)),
+                ('entry_id', models.IntegerField(unique=True)),
+                ('remaining_amount', models.BigIntegerField(validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(99999999999999)])),
+            ],
+        ),
+        migrations.RunPython(open_authorizations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.1.2 on 2026-10-17 01:53
+
+from django.db import migrations, models
+
+
+def analyze(apps, schema_editor):
+    """
+    Gathers index statistics on SQLite. Without them, SQLite walks the index of transaction type and created to
+    order the transactions of an account, instead of finding them by the indexes which start with the account.
+    """
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('ANALYZE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0016_open_authorizations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='postings',
+            index=models.Index(fields=['debit_account', 'created', 'id'], name='issuerapp_p_debit_a_8b4102_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='postings',
+            index=models.Index(fields=['credit_account', 'created', 'id'], name='issuerapp_p_credit__ee0d2f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transfers',
+            index=models.Index(fields=['account', 'id'], name='issuerapp_t_account_a45791_idx'),
+        ),
+        # the statistics are not needed to unapply the indexes.
+        migrations.RunPython(analyze, migrations.RunPython.noop),
+    ]
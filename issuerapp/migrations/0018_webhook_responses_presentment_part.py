@@ -0,0 +1,18 @@
+# Generated by Django 2.1.2 on 2026-10-17 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('issuerapp', '0017_account_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='webhookresponses',
+            name='message_type',
+            field=models.CharField(choices=[('authorization', 'authorization'), ('presentment', 'presentment'), ('presentment_part', 'presentment part')], max_length=16),
+        ),
+    ]
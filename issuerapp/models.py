@@ -1,9 +1,17 @@
-from django.db import models
+import zlib
+from django.db import models, connection, IntegrityError
+from django.core.management.color import no_style
+from django.db.transaction import atomic, on_commit
 from django.utils import timezone
-from django.db.models import Q
-from django.core.validators import MinValueValidator
+from django.db.models import Q, F, Sum
+from django.core.validators import MinValueValidator, MaxValueValidator
+from django.core.exceptions import ValidationError
 from moneyed import CURRENCIES_BY_ISO
-from decimal import Decimal
+from django.conf import settings
+from decimal import ROUND_CEILING
+from .cache import AccountCache, ResponseCache, FxRates
+from .currencies import to_minor_units, from_minor_units, rescale_units
+from .sqlite import serialized, writer
 
 #create currency tuples for validating database fields.
 CURRENCIES = [ (value.code, value.code) for value in CURRENCIES_BY_ISO.values()]
@@ -15,11 +23,60 @@ TRANSFER_TYPES = (
 TRANSACTION_TYPES = (
     ("authorization", "authorization"),
     ("presentment", "presentment"),
-    ("settlement", "settlement")
+    ("settlement", "settlement"),
+    ("expired", "expired")
 )
+# precomputed choice values and amount limits, so trusted ledger writes don't scan the choice lists.
+CURRENCY_CODES = frozenset(code for code, name in CURRENCIES)
+TRANSACTION_TYPE_CODES = frozenset(code for code, name in TRANSACTION_TYPES)
+# amounts are stored as integer minor units of their currency, e.g. cents.
+MAX_UNITS = 99999999999999
+# transaction types which are counted in ledger and available balances.
+LEDGER_TYPES = ("presentment",)
+AVAILABLE_TYPES = ("presentment", "authorization")
+# settled transaction types which are moved out of the ledger by archive_ledger command. Authorizations stay in the
+# ledger until they are presented or expire.
+ARCHIVED_TYPES = ("presentment", "settlement", "expired")
 
 ISSUER_NAME = "issuer"
 SCHEME_NAME = "scheme"
+# accounts whose balances are split into shards, because nearly every posting changes them.
+SHARDED_ACCOUNTS = (ISSUER_NAME, SCHEME_NAME)
+
+# accounts fetched by Accounts.get_account. System accounts are used on every webhook call, so they are never evicted.
+account_cache = AccountCache.from_settings(pinned=(ISSUER_NAME, SCHEME_NAME))
+
+def compact_ledger():
+    """
+    :return: Returns True if postings are stored as single Postings rows instead of Transfers and Transactions rows. 
+    It is set with ISSUER_COMPACT_LEDGER setting.
+    """
+    return getattr(settings, "ISSUER_COMPACT_LEDGER", False)
+
+def system_account_shards():
+    """
+    :return: Returns the number of balance rows per currency which postings of the system accounts are spread over. 
+    It is set with ISSUER_SYSTEM_ACCOUNT_SHARDS setting.
+    """
+    return max(1, getattr(settings, "ISSUER_SYSTEM_ACCOUNT_SHARDS", 1))
+
+def hold_expiry():
+    """
+    :return: Returns the time after which authorization holds of the webhooks expire. It is set with 
+    ISSUER_HOLD_DAYS setting.
+    """
+    return timezone.timedelta(days=getattr(settings, "ISSUER_HOLD_DAYS", 7))
+
+MESSAGE_TYPES = (
+    ("authorization", "authorization"),
+    ("presentment", "presentment"),
+    # presentments identified by presentment_id, whose ids are not transaction_ids.
+    ("presentment_part", "presentment part"),
+)
+# stored webhook responses are replayed to retried messages until they expire.
+response_cache = ResponseCache.from_settings()
+# exchange rates of authorizations in other currencies than the main currency of account.
+fx_rates = FxRates.from_settings()
 
 class Accounts(models.Model):
     """
@@ -38,8 +95,12 @@ class Accounts(models.Model):
         determines if a new account can be created. The default currency is applied.
         :return: Returns created or existing account.
         """
-        if Accounts.objects.filter(pk=cardholder_name).exists():
-            account = Accounts.objects.get(pk=cardholder_name)
+        account = account_cache.get(cardholder_name)
+        if account is not None:
+            return account
+        account = Accounts.objects.filter(pk=cardholder_name).first()
+        if account is not None:
+            account_cache.set(account)
             return account
         elif can_create_new_account:
             # create a new account and save it.
@@ -49,6 +110,20 @@ class Accounts(models.Model):
         else:
             raise Accounts.DoesNotExist("The account \"{}\" does not exist.".format(cardholder_name))
 
+    @staticmethod
+    def create_missing(cardholder_names):
+        """
+        Creates the accounts which don't exist yet with one bulk insert. The default currency is applied. Django 2.1
+        can't ignore conflicts in bulk inserts, so existing accounts are queried first, and an account created 
+        concurrently in between fails the insert with IntegrityError.
+        :param cardholder_names: Names of the account owners. They are not validated.
+        :return: Returns the number of created accounts.
+        """
+        cardholder_names = set(cardholder_names)
+        existing = set(Accounts.objects.filter(pk__in=cardholder_names).values_list("pk", flat=True))
+        Accounts.objects.bulk_create(Accounts(cardholder=name) for name in sorted(cardholder_names - existing))
+        return len(cardholder_names - existing)
+
     def save(self, *args, **kwargs):
         self.full_clean()
         return super(Accounts, self).save(*args, **kwargs)
@@ -62,21 +137,31 @@ class Transfers(models.Model):
         Fields:
         - transfer_type: credit or debit
         - currency: ISO standard char sequence.
-        - amount: Transfer amount.
+        - amount: Transfer amount in minor units of currency.
         - account: A reference to related account where transfer was performed.
     """
     transfer_type = models.CharField(choices=TRANSFER_TYPES, blank=False, max_length=6)
     currency = models.CharField(choices=CURRENCIES, max_length=3, blank=False)
-    amount = models.DecimalField(decimal_places=2, max_digits=14, blank=False,
-                                 validators=[MinValueValidator(Decimal('0.01'))]) # could use django-money
+    amount = models.BigIntegerField(blank=False, validators=[MinValueValidator(1), MaxValueValidator(MAX_UNITS)])
     account = models.ForeignKey(Accounts, on_delete=models.PROTECT, blank=False)
 
-    def save(self, *args, **kwargs):
-        self.full_clean()
+    class Meta:
+        indexes = [
+            # balance calculation
+            models.Index(fields=["account", "currency"]),
+            # get_transactions
+            models.Index(fields=["account", "id"]),
+        ]
+
+    def save(self, *args, clean=True, **kwargs):
+        # ledger writes are validated beforehand by Transactions.validate_posting, which doesn't query accounts.
+        if clean:
+            self.full_clean()
         return super(Transfers, self).save(*args, **kwargs)
 
     def __str__(self):
-        return "{} {} {} {}".format(self.transfer_type, self.amount,  self.currency, self.account)
+        return "{} {} {} {}".format(self.transfer_type, from_minor_units(self.amount, self.currency), self.currency,
+                                    self.account)
 
 class Transactions(models.Model):
     """
@@ -85,17 +170,32 @@ class Transactions(models.Model):
         - transaction_id: It is used to identify authorization and presentment transactions.
         - transfer_from: A debit Transfer. The funds are deducted from this account.
         - transfer_to: A credit Transfer. The funds are added to this account.
-        - transaction_type: The type of transaction. Possible values: authorization, presentment and settlement.
+        - transaction_type: The type of transaction. Possible values: authorization, presentment, settlement and 
+        expired, which is an authorization whose hold was released.
         - created: A timestamp when transaction was created. 
+        - expires_at: A timestamp when the hold of an authorization expires. Null if it doesn't expire.
     """
     transaction_id = models.CharField(max_length=20, blank=True)
     transfer_from = models.ForeignKey(Transfers, on_delete=models.CASCADE, related_name="transfer_from", blank=False)
     transfer_to = models.ForeignKey(Transfers, on_delete=models.CASCADE, related_name="transfer_to", blank=False)
     transaction_type = models.CharField(choices=TRANSACTION_TYPES, max_length=13, blank=False)
     created = models.DateTimeField("time when transaction was created.",default=timezone.now, blank=False)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # presentment matching
+            models.Index(fields=["transaction_id", "transaction_type"]),
+            # get_transactions
+            models.Index(fields=["transaction_type", "created"]),
+            # expire_holds
+            models.Index(fields=["transaction_type", "expires_at"]),
+        ]
 
     @staticmethod
-    def create_transaction(debit_account, credit_account, transaction_type, currency, amount, transaction_id=""):
+    @serialized
+    def create_transaction(debit_account, credit_account, transaction_type, currency, amount, transaction_id="",
+                           expires_at=None):
         """
         Creates a transaction and saves it into database.
         :param debit_account: The account model where the money is taken.
@@ -103,40 +203,484 @@ class Transactions(models.Model):
         :param transaction_type: The type of transaction. Possible values are "authorization", "presentment" or 
         "settlement"
         :param currency: Currency in ISO character format. 
-        :param amount: Transaction amount. The minimum amount is 0.01
+        :param amount: Transaction amount. The minimum amount is one minor unit of currency, e.g. 0.01 EUR.
+        :param transaction_id: Optional parameter for identifying transactions.
+        :param expires_at: Optional expiry time of an authorization hold.
+        :return: Returns the created transaction, or posting if the compact ledger is used.
+        """
+        transaction = Transactions.validate_posting({
+            "debit_account": debit_account, "credit_account": credit_account, "transaction_type": transaction_type,
+            "currency": currency, "amount": amount, "transaction_id": transaction_id, "expires_at": expires_at
+        })
+
+        # transfers, transaction and balances are saved together or not at all.
+        with atomic():
+            if not compact_ledger():
+                transaction.transfer_from.save(clean=False)
+                transaction.transfer_to.save(clean=False)
+                # transaction is saved here because transfers had to be saved before we can reference them.
+                transaction.transfer_from_id = transaction.transfer_from.pk
+                transaction.transfer_to_id = transaction.transfer_to.pk
+            transaction.save(clean=False)
+            Balances.post(transaction)
+            OpenAuthorizations.open([transaction])
+        return transaction
+
+    @staticmethod
+    @serialized
+    def authorize(debit_account, credit_account, currency, amount, transaction_id=""):
+        """
+        Reserves amount from the available balance of debit account if it has enough funds. The balance is locked 
+        while funds are checked and the authorization is saved, so concurrent authorizations can't overdraw it. The 
+        hold expires after ISSUER_HOLD_DAYS.
+        :param debit_account: The account of cardholder.
+        :param credit_account: The account where the amount is reserved.
+        :param currency: Currency in ISO character format.
+        :param amount: Authorization amount.
         :param transaction_id: Optional parameter for identifying transactions.
-        :return: Returns the created transaction.
+        :return: Returns a tuple of the created authorization and available balance after it. If there are not 
+        enough funds, the authorization is None and the balance is unchanged.
+        """
+        units = Transactions.clean_posting("authorization", currency, amount, transaction_id)
+        main_currency = debit_account.main_currency
+        needed = Transactions.funds_needed(debit_account, currency, units)
+        with atomic():
+            available = Transactions.lock_funds(debit_account)
+            if available < needed:
+                return None, from_minor_units(available, main_currency)
+            transaction = Transactions.create_transaction(debit_account, credit_account, "authorization", currency,
+                                                          amount, transaction_id=transaction_id,
+                                                          expires_at=timezone.now() + hold_expiry())
+        return transaction, from_minor_units(available - needed, main_currency)
+
+    @staticmethod
+    @serialized
+    def authorize_many(credit_account, authorizations):
+        """
+        Authorizes a batch of authorizations. Balances of cardholders are locked, funds are checked in the order of 
+        authorizations and approved authorizations are saved with bulk inserts, all in one database transaction. The 
+        holds expire like in authorize.
+        :param credit_account: The account where the amounts are reserved.
+        :param authorizations: List of dictionaries with "debit_account", "currency", "amount" and "transaction_id" 
+        keys.
+        :return: Returns a list of (authorization, available balance after it) tuples in the order of authorizations. 
+        Declined authorizations are None. Raises ValidationError for the whole batch if a currency doesn't have a 
+        rate, so currencies of messages are checked with funds_needed before.
+        """
+        results = []
+        postings = []
+        expires_at = timezone.now() + hold_expiry()
+        with atomic():
+            accounts = {authorization["debit_account"].pk: authorization["debit_account"]
+                        for authorization in authorizations}
+            available_balances = {pk: Transactions.lock_funds(accounts[pk]) for pk in sorted(accounts)}
+            for authorization in authorizations:
+                account = authorization["debit_account"]
+                units = Transactions.clean_posting("authorization", authorization["currency"],
+                                                   authorization["amount"], authorization.get("transaction_id", ""))
+                needed = Transactions.funds_needed(account, authorization["currency"], units)
+                if available_balances[account.pk] < needed:
+                    results.append([None, from_minor_units(available_balances[account.pk], account.main_currency)])
+                    continue
+                # like in authorize, only authorizations in the main currency reduce the checked balance, unless 
+                # they are converted with exchange rates.
+                if fx_rates.enabled() or authorization["currency"] == account.main_currency:
+                    available_balances[account.pk] -= needed
+                postings.append(dict(authorization, credit_account=credit_account, transaction_type="authorization",
+                                     expires_at=expires_at))
+                results.append([len(postings) - 1,
+                                from_minor_units(available_balances[account.pk], account.main_currency)])
+
+            transactions = Transactions.bulk_create_transactions(postings)
+        for result in results:
+            if result[0] is not None:
+                result[0] = transactions[result[0]]
+        return [tuple(result) for result in results]
+
+    @staticmethod
+    def lock_funds(account):
+        """
+        Locks balances of account until the end of the current database transaction and gets its available funds. 
+        With exchange rates, available balances of all currencies are converted to the main currency and added up. 
+        Currencies without a rate are not counted. Must be called inside an atomic block.
+        :param account: The account model.
+        :return: Returns the available funds in minor units of the main currency of account.
         """
-        debit_transfer = Transfers(transfer_type="debit", currency=currency, amount=str(amount), account=debit_account)
-        credit_transfer = Transfers(transfer_type="credit", currency=currency, amount=str(amount), account=credit_account)
+        main_currency = account.main_currency
+        if not fx_rates.enabled():
+            return Balances.lock(account, main_currency).available_balance
+        rates = fx_rates.rates()
+        # balances are rounded down, so converted funds are never more than the account has.
+        return sum(fx_rates.convert(balance.available_balance, balance.currency, main_currency)
+                   for balance in Balances.lock_all(account)
+                   if balance.currency == main_currency or {balance.currency, main_currency} <= rates.keys())
 
-        debit_transfer.save()
+    @staticmethod
+    def funds_needed(account, currency, units):
+        """
+        Gets the amount which an authorization takes from the available funds of account.
+        :param account: The account model.
+        :param currency: Currency of the authorization in ISO character format.
+        :param units: Authorization amount in minor units of currency.
+        :return: Returns the amount in minor units of the main currency of account. Without exchange rates, the 
+        amount keeps its value in major units, e.g. 100 JPY is 100.00 EUR. Raises ValidationError if the currency 
+        doesn't have a rate.
+        """
+        if not fx_rates.enabled():
+            return rescale_units(units, currency, account.main_currency, ROUND_CEILING)
         try:
-            credit_transfer.save()
-        except Exception as e:
-            debit_transfer.delete()
-            raise e
-
-        # create transaction here because transfers had to be saved before we can reference them.
-        transaction = Transactions(transfer_from=debit_transfer, transfer_to=credit_transfer,
-                                   transaction_type=transaction_type, transaction_id=transaction_id)
+            # authorizations are rounded up, so converted funds are never less than the authorization.
+            return fx_rates.convert(units, currency, account.main_currency, ROUND_CEILING)
+        except ValueError as error:
+            raise ValidationError({"currency": [str(error)]})
+
+    @staticmethod
+    @serialized
+    def present_many(presentments):
+        """
+        Presents a batch of authorizations and creates their settlements to the scheme with bulk writes in one 
+        database transaction. Authorizations are found in the book of open authorizations by transaction_id, the 
+        oldest one first if the id repeats. A presentment can clear a part of the held amount. The rest of the hold 
+        is released if the presentment is final, otherwise it is left for later presentments.
+        :param presentments: List of dictionaries with "transaction_id" key and "currency" and "amount" keys of 
+        settlement. Optional "clearing_amount" key is the cleared amount in the currency of authorization, by 
+        default the whole remaining amount, and optional "final" key is False if more presentments will follow.
+        :return: Returns a list of presented transactions in the order of presentments. Presentments without 
+        matching authorization, or which clear more than the remaining amount, are None.
+        """
+        issuer_account = Accounts.get_account(ISSUER_NAME)
+        scheme_account = Accounts.get_account(SCHEME_NAME)
+        with atomic():
+            book = OpenAuthorizations.lock({presentment["transaction_id"] for presentment in presentments})
+            holds = Transactions.ledger_entries()
+            if connection.features.has_select_for_update:
+                holds = holds.select_for_update()
+            holds = holds.in_bulk([row.entry_id for rows in book.values() for row in rows])
+            # authorizations which were changed outside of the book are closed.
+            stale = [row for rows in book.values() for row in rows
+                     if row.entry_id not in holds or holds[row.entry_id].transaction_type != "authorization"]
+            for row in stale:
+                row.remaining_amount = 0
+
+            presented = []
+            entries = []
+            released = []
+            changed = {}
+            resized = set()
+            for presentment in presentments:
+                row = next((row for row in book.get(presentment["transaction_id"], []) if row.remaining_amount),
+                           None)
+                units = None
+                if row is not None:
+                    hold = holds[row.entry_id]
+                    currency = hold.transfer_from.currency
+                    try:
+                        units = row.remaining_amount if presentment.get("clearing_amount") is None else \
+                            to_minor_units(presentment["clearing_amount"], currency)
+                    except ValueError:
+                        pass
+                if units is None or not 1 <= units <= row.remaining_amount:
+                    presented.append(None)
+                    continue
+                entries.append(Transactions.validate_posting({
+                    "debit_account": issuer_account, "credit_account": scheme_account,
+                    "transaction_type": "settlement", "currency": presentment["currency"],
+                    "amount": presentment["amount"]}))
+
+                remaining = row.remaining_amount - units
+                changed[row.entry_id] = row
+                if not remaining:
+                    # the whole hold is presented.
+                    hold.transaction_type = "presentment"
+                    presented.append(hold)
+                    row.remaining_amount = 0
+                    continue
+                # the cleared part is split off the hold as a presentment of its own, and the hold keeps the rest.
+                entries.append(Transactions._hold_part(hold, units, "presentment"))
+                presented.append(entries[-1])
+                final = presentment.get("final", True)
+                released.append(Transactions._hold_part(hold, units + (remaining if final else 0), "expired"))
+                Transactions._set_hold_amount(hold, remaining)
+                resized.add(row.entry_id)
+                if final:
+                    hold.transaction_type = "expired"
+                row.remaining_amount = 0 if final else remaining
+
+            for entry_id in sorted(changed):
+                Transactions._save_hold(holds[entry_id], entry_id in resized)
+            Balances.post_many([holds[entry_id] for entry_id in sorted(changed)
+                                if holds[entry_id].transaction_type == "presentment"], previous_type="authorization")
+            Balances.post_many(released, previous_type="authorization")
+            Transactions._insert_many(entries)
+            OpenAuthorizations.save_book(list(changed.values()) + stale)
+        return presented
+
+    @staticmethod
+    def _hold_part(hold, units, transaction_type):
+        """
+        Makes an unsaved posting of a part of an authorization hold between the same accounts.
+        :param hold: The authorization.
+        :param units: Amount of the part in minor units of the currency of authorization.
+        :param transaction_type: The type of the part.
+        :return: Returns an unsaved transaction with unsaved transfers, or an unsaved posting if the compact ledger 
+        is used.
+        """
+        if isinstance(hold, Postings):
+            return Postings(debit_account_id=hold.debit_account_id, credit_account_id=hold.credit_account_id,
+                            transaction_type=transaction_type, currency=hold.currency, amount=units,
+                            transaction_id=hold.transaction_id)
+        return Transactions(transfer_from=Transfers(transfer_type="debit", currency=hold.transfer_from.currency,
+                                                    amount=units, account_id=hold.transfer_from.account_id),
+                            transfer_to=Transfers(transfer_type="credit", currency=hold.transfer_to.currency,
+                                                  amount=units, account_id=hold.transfer_to.account_id),
+                            transaction_type=transaction_type, transaction_id=hold.transaction_id)
+
+    @staticmethod
+    def _set_hold_amount(hold, units):
+        """
+        Changes the held amount of an unsaved authorization.
+        """
+        if isinstance(hold, Postings):
+            hold.amount = units
+        else:
+            hold.transfer_from.amount = hold.transfer_to.amount = units
+
+    @staticmethod
+    def _save_hold(hold, resized):
+        """
+        Saves the type and, if it was changed, the held amount of an authorization without updating balances.
+        """
+        Transactions.ledger_entries().filter(pk=hold.pk).update(transaction_type=hold.transaction_type)
+        if not resized:
+            return
+        if isinstance(hold, Postings):
+            Postings.objects.filter(pk=hold.pk).update(amount=hold.amount)
+        else:
+            Transfers.objects.filter(pk__in=[hold.transfer_from_id, hold.transfer_to_id])\
+                .update(amount=hold.transfer_from.amount)
+
+    @staticmethod
+    def expire_holds(now, batch_size):
+        """
+        Releases a batch of authorization holds which have expired. Their type is changed to expired, so they are
+        not counted in available balances anymore.
+        :param now: Holds which expire before or at this time are released.
+        :param batch_size: The maximum number of released holds.
+        :return: Returns the number of released holds, or None if there aren't any more expired holds. Holds which 
+        were presented concurrently are not released.
+        """
+        model = Postings if compact_ledger() else Transactions
+        # the expired holds are found with the index of type and expiry before the database transaction, so it
+        # only locks the batch.
+        ids = list(model.objects.filter(transaction_type="authorization", expires_at__lte=now)
+                   .order_by("expires_at").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return None
+        return len(Transactions._release_holds(ids))
+
+    @staticmethod
+    @serialized
+    def _release_holds(ids):
+        """
+        Changes authorizations to expired and removes them from the available balances in one database transaction.
+        Authorizations which were presented in the meantime are skipped.
+        :param ids: Ids of the authorizations.
+        :return: Returns the released authorizations.
+        """
+        with atomic():
+            # the holds are closed in the book first, which locks them against presentments like present_many.
+            OpenAuthorizations.close(ids)
+            holds = Transactions.ledger_entries().filter(id__in=ids, transaction_type="authorization")
+            if connection.features.has_select_for_update:
+                holds = holds.select_for_update()
+            holds = list(holds.order_by("id"))
+            for hold in holds:
+                hold.transaction_type = "expired"
+            Transactions.ledger_entries().filter(id__in=[hold.id for hold in holds])\
+                .update(transaction_type="expired")
+            Balances.post_many(holds, previous_type="authorization")
+        return holds
+
+    @staticmethod
+    @serialized
+    def bulk_create_transactions(postings):
+        """
+        Creates transactions with bulk inserts. Transfers, transactions and balances are saved in one database 
+        transaction.
+        :param postings: List of dictionaries with create_transaction parameters as keys. transaction_id is optional.
+        :return: Returns the created transactions.
+        """
+        transactions = [Transactions.validate_posting(posting) for posting in postings]
+        with atomic():
+            Transactions._insert_many(transactions)
+        return transactions
+
+    @staticmethod
+    def _insert_many(transactions):
+        """
+        Saves validated transactions with bulk inserts, updates balances and adds authorizations to the book of open 
+        authorizations. Must be called inside an atomic block.
+        :param transactions: Unsaved transactions with unsaved transfers, or unsaved postings if the compact ledger 
+        is used.
+        :return: None
+        """
+        Balances.post_many(transactions)
+        if compact_ledger():
+            Transactions._bulk_insert(Postings, transactions)
+        else:
+            transfers = [transfer for transaction in transactions
+                         for transfer in (transaction.transfer_from, transaction.transfer_to)]
+            Transactions._bulk_insert(Transfers, transfers)
+            for transaction in transactions:
+                transaction.transfer_from_id = transaction.transfer_from.pk
+                transaction.transfer_to_id = transaction.transfer_to.pk
+            Transactions._bulk_insert(Transactions, transactions)
+        OpenAuthorizations.open(transactions)
+
+    @staticmethod
+    def validate_posting(posting):
+        """
+        Validates a posting without database queries. Accounts are model instances, so their existence is not
+        queried, and foreign keys are checked by the database when the posting is saved.
+        :param posting: Dictionary with create_transaction parameters as keys. transaction_id and expires_at are 
+        optional.
+        :return: Returns an unsaved transaction with unsaved transfers, or an unsaved posting if the compact ledger 
+        is used.
+        """
+        amount = Transactions.clean_posting(posting["transaction_type"], posting["currency"], posting["amount"],
+                                            posting.get("transaction_id", ""))
+        if compact_ledger():
+            return Postings(debit_account=posting["debit_account"], credit_account=posting["credit_account"],
+                            transaction_type=posting["transaction_type"], currency=posting["currency"],
+                            amount=amount, transaction_id=posting.get("transaction_id", ""),
+                            expires_at=posting.get("expires_at"))
+        debit_transfer = Transfers(transfer_type="debit", currency=posting["currency"], amount=amount,
+                                   account=posting["debit_account"])
+        credit_transfer = Transfers(transfer_type="credit", currency=posting["currency"], amount=amount,
+                                    account=posting["credit_account"])
+        return Transactions(transfer_from=debit_transfer, transfer_to=credit_transfer,
+                            transaction_type=posting["transaction_type"],
+                            transaction_id=posting.get("transaction_id", ""), expires_at=posting.get("expires_at"))
+
+    @staticmethod
+    def clean_posting(transaction_type, currency, amount, transaction_id=""):
+        """
+        Validates the fields of a posting like full_clean, but against precomputed choices.
+        :param transaction_type: The type of transaction.
+        :param currency: Currency in ISO character format.
+        :param amount: Transaction amount. The minimum amount is one minor unit of currency, e.g. 0.01 EUR, and it 
+        can't have more decimal places than the currency.
+        :param transaction_id: Identifier of the transaction.
+        :return: Returns the amount in minor units of currency. Raises ValidationError if any field is invalid.
+        """
+        errors = {}
+        if transaction_type not in TRANSACTION_TYPE_CODES:
+            errors["transaction_type"] = ["Value {!r} is not a valid choice.".format(transaction_type)]
+        if currency not in CURRENCY_CODES:
+            errors["currency"] = ["Value {!r} is not a valid choice.".format(currency)]
+        if len(transaction_id) > 20:
+            errors["transaction_id"] = ["Ensure this value has at most 20 characters."]
+        units = None
         try:
-            transaction.save()
-            return transaction
-        except Exception as e:
-            #if transaction saving fails, delete created transfers
-            credit_transfer.save()
-            debit_transfer.delete()
-            raise e
+            units = to_minor_units(amount, currency)
+        except ValueError as error:
+            errors["amount"] = [str(error)]
+        else:
+            if not 1 <= units <= MAX_UNITS:
+                errors["amount"] = ["Ensure this value is between {} and {}."
+                                    .format(from_minor_units(1, currency), from_minor_units(MAX_UNITS, currency))]
+        if errors:
+            raise ValidationError(errors)
+        return units
 
-    def save(self, *args, **kwargs):
-        self.full_clean()
+    @staticmethod
+    def _bulk_insert(model, objects):
+        """
+        Inserts objects with bulk_create and sets their primary keys.
+        :param model: The model class.
+        :param objects: The unsaved model instances.
+        :return: None
+        """
+        if not objects or connection.features.can_return_ids_from_bulk_insert:
+            model.objects.bulk_create(objects)
+        elif connection.vendor == "sqlite":
+            # the database can't return ids of inserted rows, so they are reserved beforehand.
+            with atomic():
+                next_id = Transactions._reserve_ids(model, len(objects))
+                for index, obj in enumerate(objects):
+                    obj.id = next_id + index
+                model.objects.bulk_create(objects)
+        else:
+            for obj in objects:
+                obj.save(clean=False, force_insert=True)
+
+    @staticmethod
+    def _reserve_ids(model, count):
+        """
+        Reserves primary keys for rows of a SQLite table by advancing its AUTOINCREMENT sequence. Must be called 
+        inside an atomic block.
+        :param model: The model class.
+        :param count: The number of reserved primary keys.
+        :return: Returns the first reserved primary key.
+        """
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            # the write takes the database write lock before the sequence is read, so no one else can reserve the 
+            # same ids. It is taken even if the table doesn't have a sequence yet.
+            cursor.execute("UPDATE sqlite_sequence SET seq = seq WHERE name = %s", [table])
+            has_sequence = cursor.rowcount > 0
+            # ids of archived and deleted rows are not reused, like with inserts of AUTOINCREMENT tables.
+            cursor.execute("SELECT MAX(seq) FROM (SELECT seq FROM sqlite_sequence WHERE name = %s "
+                           "UNION ALL SELECT MAX(id) FROM {0})".format(connection.ops.quote_name(table)), [table])
+            last_id = cursor.fetchone()[0] or 0
+            if has_sequence:
+                cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [last_id + count, table])
+            else:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, last_id + count])
+        return last_id + 1
+
+    def change_transaction_type(self, transaction_type):
+        """
+        Changes the type of transaction, e.g. authorization to presentment, and updates balances of the accounts.
+        :param transaction_type: The new type of transaction.
+        :return: Returns the changed transaction.
+        """
+        if transaction_type not in TRANSACTION_TYPE_CODES:
+            raise ValidationError({"transaction_type": ["Value {!r} is not a valid choice.".format(transaction_type)]})
+        previous_type = self.transaction_type
+
+        # the previous type is taken before, so the writer can run this again if its group commit fails.
+        def save_transaction_type():
+            with atomic():
+                self.transaction_type = transaction_type
+                self.save(clean=False, update_fields=["transaction_type"])
+                Balances.post(self, previous_type=previous_type)
+                if previous_type == "authorization":
+                    OpenAuthorizations.close([self.pk])
+                OpenAuthorizations.open([self])
+        writer.run(save_transaction_type)
+        return self
+
+    def save(self, *args, clean=True, **kwargs):
+        # ledger writes are validated beforehand by Transactions.validate_posting, which doesn't query transfers.
+        if clean:
+            self.full_clean()
         return super(Transactions, self).save(*args, **kwargs)
 
     def __str__(self):
         return "{0} {1} from: {2} to: {3} t_id: {4}"\
             .format(self.created, self.transaction_type, self.transfer_from, self.transfer_to, self.transaction_id)
 
+    @staticmethod
+    def ledger_entries():
+        """
+        :return: Returns a queryset of postings if the compact ledger is used, otherwise a queryset of transactions 
+        with their transfers.
+        """
+        if compact_ledger():
+            return Postings.objects.all()
+        return Transactions.objects.select_related("transfer_from", "transfer_to")
+
     @staticmethod
     def get_transactions(account_name, start_datetime, end_datetime):
         """
@@ -152,70 +696,47 @@ class Transactions(models.Model):
             if start_datetime > end_datetime:
                 raise ValueError("Start datetime is greater than end datetime. Query can't find any results,")
 
-        transactions = Transactions.objects.filter(Q(created__gte=start_datetime), Q(created__lte=end_datetime),
-                                                   Q(transfer_to__account__exact=acc) |
-                                                   Q(transfer_from__account__exact=acc),
-                                                   Q(transaction_type__exact="presentment"))
+        if compact_ledger():
+            accounts = Q(credit_account=acc) | Q(debit_account=acc)
+        else:
+            # transfers of the account are looked up by the index of account, so other accounts are not read.
+            transfers = Transfers.objects.filter(account=acc).values("id")
+            accounts = Q(transfer_to__in=transfers) | Q(transfer_from__in=transfers)
+        entries = Transactions.ledger_entries()
+        matching = entries.model.objects.filter(Q(created__gte=start_datetime), Q(created__lte=end_datetime), accounts,
+                                                Q(transaction_type__exact="presentment")).values("pk")
+        # the entries of the account are found in a subquery by the indexes which start with the account, so the 
+        # transactions of other accounts are not walked through when the result is ordered by created.
+        transactions = entries.filter(pk__in=matching)
         return transactions
 
     @staticmethod
-    def show_balances(account_name, time_threshold=timezone.now()):
+    def show_balances(account_name, time_threshold=None):
         """
         Calculates ledger balance and available balance for given account.
         :param account_name: The name of account to get balance
-        :param time_threshold: Time threshold. Balance before or equal this time threshold is given.
+        :param time_threshold: Time threshold. Balance before or equal this time threshold is given. If it is not 
+        given, the current balance is given.
         :return: ledger balance and available balance in dictionary format. 
         """
-        ledger_balance = Transactions.get_ledger_balance(account_name, time_threshold)
-        available_balance = Transactions.get_available_balance(account_name)
-        #merge dictionaries
-        balances = {**ledger_balance, **available_balance}
-        return balances
+        acc = Accounts.get_account(account_name)
+        balances = Transactions.get_balances(acc, time_threshold)
+        return {key: str(value) for key, value in balances.items()}
 
     @staticmethod
-    def get_ledger_balance(account_name, time_threshold=timezone.now()):
+    def get_ledger_balance(account_name, time_threshold=None):
         """
         Calculates ledger balance for given account.
         :param account_name: The name of account to get ledger balance
-        :param time_threshold: Time threshold. 
+        :param time_threshold: Time threshold. If it is not given, the current balance is given.
         :return: ledger balance as in dictionary format. 
         """
-
         acc = Accounts.get_account(account_name)
-        transactions_from = Transactions.objects.filter(Q(created__lte=time_threshold),
-                                                        Q(transfer_from__account__exact=acc),
-                                                        Q(transaction_type__exact="presentment"),
-                                                        Q(transfer_from__currency__iexact=acc.main_currency))
-        transactions_to = Transactions.objects.filter(Q(created__lte=time_threshold),
-                                                      Q(transfer_to__account__exact=acc),
-                                                      Q(transaction_type__exact="presentment"),
-                                                      Q(transfer_to__currency__iexact=acc.main_currency))
-        ledger_balance = Transactions.calculate_balance(transactions_from, transactions_to)
         balance = {
-            "ledger_balance": str(ledger_balance)
+            "ledger_balance": str(Transactions.get_balances(acc, time_threshold)["ledger_balance"])
         }
         return balance
 
-    @staticmethod
-    def calculate_balance(transactions_from, transactions_to):
-        """
-        Calculates balance between debit and credit transactions.
-        :param transactions_from: Debit transactions of selected account. 
-        :param transactions_to: Credit transactions of selected account.
-        :return: Balance
-        """
-        debit_amount = 0
-        credit_amount = 0
-        # debit transfer
-        for transaction in transactions_from:
-            debit_amount += transaction.transfer_from.amount
-        # credit transfer
-        for transaction in transactions_to:
-            credit_amount += transaction.transfer_to.amount
-
-        balance = credit_amount - debit_amount
-        return balance
-
     @staticmethod
     def get_available_balance(account_name):
         """
@@ -224,16 +745,982 @@ class Transactions(models.Model):
         :return: Returns a dictionary with "available_balance" key.
         """
         acc = Accounts.get_account(account_name)
-        transactions_from = Transactions.objects.filter(Q(transfer_from__account__exact=acc),
-                                                        Q(transaction_type__exact="presentment") |
-                                                        Q(transaction_type__exact="authorization"),
-                                                        Q(transfer_from__currency__iexact=acc.main_currency))
-        transactions_to = Transactions.objects.filter(Q(transfer_to__account__exact=acc),
-                                                      Q(transaction_type__exact="presentment") |
-                                                      Q(transaction_type__exact="authorization"),
-                                                      Q(transfer_to__currency__iexact=acc.main_currency))
-        available_balance = Transactions.calculate_balance(transactions_from, transactions_to)
         balance = {
-            "available_balance": str(available_balance)
+            "available_balance": str(Transactions.get_balances(acc)["available_balance"])
+        }
+        return balance
+
+    @staticmethod
+    def get_balances(account, time_threshold=None):
+        """
+        Gets ledger balance and available balance of account in its main currency. Current balances are read from 
+        Balances and balances at given time are calculated from the ledger.
+        :param account: The account model.
+        :param time_threshold: Time threshold for ledger balance. Available balance is always the current one.
+        :return: Dictionary with "ledger_balance" and "available_balance" keys. The balances are Decimals.
+        """
+        currency = account.main_currency
+        if time_threshold is None:
+            balance = Balances.get_balance(account, currency)
+            return {
+                "ledger_balance": from_minor_units(balance.ledger_balance, currency),
+                "available_balance": from_minor_units(balance.available_balance, currency)
+            }
+        # ledger balance at time threshold is the nearest earlier snapshot and presentments after it.
+        snapshot = BalanceSnapshots.get_snapshot(account, currency, time_threshold)
+        since = snapshot.taken_at if snapshot is not None else None
+        ledger_balance = snapshot.ledger_balance if snapshot is not None else 0
+        totals = Transactions.calculate_balances(account, currency, time_threshold, since)
+        # archived postings are no longer in the ledger.
+        carried = CarriedBalances.get_totals(account, currency, time_threshold, since)
+        ledger_balance += carried["ledger_balance"] + totals["ledger_credit"] - totals["ledger_debit"]
+        available_balance = carried["available_balance"] + totals["available_credit"] - totals["available_debit"]
+        return {
+            "ledger_balance": from_minor_units(ledger_balance, currency),
+            "available_balance": from_minor_units(available_balance, currency)
         }
-        return balance
\ No newline at end of file
+
+    @staticmethod
+    def get_currency_balances(account, time_threshold=None):
+        """
+        Gets ledger balances and available balances of account in every currency. Current balances are read from 
+        Balances and balances at given time are calculated from the ledger with one grouped query.
+        :param account: The account model.
+        :param time_threshold: Time threshold for ledger balances. Available balances are always the current ones.
+        :return: Dictionary of currency keys and dictionaries with "ledger_balance" and "available_balance" 
+        Decimals.
+        """
+        if time_threshold is None:
+            balances = {}
+            for balance in Balances.objects.filter(account=account):
+                ledger_balance, available_balance = balances.get(balance.currency, (0, 0))
+                balances[balance.currency] = (ledger_balance + balance.ledger_balance,
+                                              available_balance + balance.available_balance)
+        else:
+            balances = {currency: (totals["ledger_credit"] - totals["ledger_debit"],
+                                   totals["available_credit"] - totals["available_debit"])
+                        for currency, totals in Transactions.calculate_currency_balances(account, time_threshold)
+                        .items()}
+            for carried in CarriedBalances.objects.filter(account=account):
+                totals = carried.totals(time_threshold)
+                ledger_balance, available_balance = balances.get(carried.currency, (0, 0))
+                balances[carried.currency] = (ledger_balance + totals["ledger_balance"],
+                                              available_balance + totals["available_balance"])
+        return {currency: {"ledger_balance": from_minor_units(ledger_balance, currency),
+                           "available_balance": from_minor_units(available_balance, currency)}
+                for currency, (ledger_balance, available_balance) in sorted(balances.items())}
+
+    @staticmethod
+    def show_currency_balances(account_name, time_threshold=None):
+        """
+        Calculates ledger balance and available balance in every currency for given account.
+        :param account_name: The name of account to get balances
+        :param time_threshold: Time threshold. Ledger balances before or equal this time threshold are given. If it 
+        is not given, the current balances are given.
+        :return: Dictionary of currency keys and ledger balance and available balance in dictionary format.
+        """
+        acc = Accounts.get_account(account_name)
+        balances = Transactions.get_currency_balances(acc, time_threshold)
+        return {currency: {key: str(value) for key, value in currency_balances.items()}
+                for currency, currency_balances in balances.items()}
+
+    @staticmethod
+    def calculate_balances(account, currency, time_threshold=None, since=None):
+        """
+        Calculates debit and credit totals of account from the ledger with a single aggregate query.
+        :param account: The account model.
+        :param currency: Currency in ISO character format. Transfers in other currencies are not counted.
+        :param time_threshold: Time threshold for ledger totals. If it is not given, all presentments are counted.
+        :param since: Optional start time for ledger totals. Only presentments created after it are counted.
+        :return: Dictionary with "ledger_debit", "ledger_credit", "available_debit" and "available_credit" totals in 
+        minor units. Totals without any transfers are 0.
+        """
+        entries, totals = Transactions._balance_totals(account, time_threshold, since)
+        totals = entries.filter(currency=currency.upper()).aggregate(**totals)
+        return {key: value or 0 for key, value in totals.items()}
+
+    @staticmethod
+    def calculate_currency_balances(account, time_threshold=None):
+        """
+        Calculates debit and credit totals of account in every currency from the ledger with a single grouped 
+        aggregate query.
+        :param account: The account model.
+        :param time_threshold: Time threshold for ledger totals. If it is not given, all presentments are counted.
+        :return: Dictionary of currency keys and totals like the ones of calculate_balances.
+        """
+        entries, totals = Transactions._balance_totals(account, time_threshold)
+        return {row.pop("currency"): {key: value or 0 for key, value in row.items()}
+                for row in entries.values("currency").annotate(**totals)}
+
+    @staticmethod
+    def _balance_totals(account, time_threshold=None, since=None):
+        """
+        :return: Returns a tuple of the ledger entries of account and a dictionary of aggregates of its debit and 
+        credit totals.
+        """
+        totals = {}
+        compact = compact_ledger()
+        for total, transaction_types, threshold, start in (("ledger", LEDGER_TYPES, time_threshold, since),
+                                                           ("available", AVAILABLE_TYPES, None, None)):
+            # a debit transfer is referenced by transfer_from of its transaction and a credit one by transfer_to.
+            # in the compact ledger, the account is the debit or credit account of the posting.
+            for transfer_type, related_name in (("debit", "transfer_from"), ("credit", "transfer_to")):
+                prefix = "" if compact else related_name + "__"
+                conditions = Q(**{prefix + "transaction_type__in": transaction_types})
+                if compact:
+                    conditions &= Q(**{transfer_type + "_account": account})
+                if threshold is not None:
+                    conditions &= Q(**{prefix + "created__lte": threshold})
+                if start is not None:
+                    conditions &= Q(**{prefix + "created__gt": start})
+                totals[total + "_" + transfer_type] = Sum(models.Case(models.When(conditions, then="amount")))
+
+        if compact:
+            entries = Postings.objects.filter(Q(debit_account=account) | Q(credit_account=account))
+        else:
+            entries = Transfers.objects.filter(account=account)
+        return entries, totals
+
+class Postings(models.Model):
+    """
+    Postings model is the compact ledger, where a posting is one row instead of two Transfers rows and a 
+    Transactions row. It is used instead of them when ISSUER_COMPACT_LEDGER setting is True.
+        Fields:
+        - transaction_id: It is used to identify authorization and presentment postings.
+        - debit_account: The account where the funds are deducted.
+        - credit_account: The account where the funds are added.
+        - transaction_type: The type of posting. Possible values: authorization, presentment, settlement and 
+        expired.
+        - currency: ISO standard char sequence.
+        - amount: Posting amount in minor units of currency.
+        - created: A timestamp when posting was created.
+        - expires_at: A timestamp when the hold of an authorization expires. Null if it doesn't expire.
+    """
+    transaction_id = models.CharField(max_length=20, blank=True)
+    # the indexes of accounts and currency cover the accounts.
+    debit_account = models.ForeignKey(Accounts, on_delete=models.PROTECT, related_name="debit_postings",
+                                      db_index=False)
+    credit_account = models.ForeignKey(Accounts, on_delete=models.PROTECT, related_name="credit_postings",
+                                       db_index=False)
+    transaction_type = models.CharField(choices=TRANSACTION_TYPES, max_length=13, blank=False)
+    currency = models.CharField(choices=CURRENCIES, max_length=3, blank=False)
+    amount = models.BigIntegerField(blank=False, validators=[MinValueValidator(1), MaxValueValidator(MAX_UNITS)])
+    created = models.DateTimeField("time when posting was created.", default=timezone.now, blank=False)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # presentment matching
+            models.Index(fields=["transaction_id", "transaction_type"]),
+            # get_transactions
+            models.Index(fields=["transaction_type", "created"]),
+            # expire_holds
+            models.Index(fields=["transaction_type", "expires_at"]),
+            # balance calculation
+            models.Index(fields=["debit_account", "currency"]),
+            models.Index(fields=["credit_account", "currency"]),
+            # get_transactions
+            models.Index(fields=["debit_account", "created", "id"]),
+            models.Index(fields=["credit_account", "created", "id"]),
+        ]
+
+    # postings are changed like transactions.
+    change_transaction_type = Transactions.change_transaction_type
+
+    @property
+    def transfer_from(self):
+        """
+        :return: Returns the debit side of the posting as an unsaved transfer, like Transactions.transfer_from.
+        """
+        return Transfers(transfer_type="debit", currency=self.currency, amount=self.amount,
+                         account_id=self.debit_account_id)
+
+    @property
+    def transfer_to(self):
+        """
+        :return: Returns the credit side of the posting as an unsaved transfer, like Transactions.transfer_to.
+        """
+        return Transfers(transfer_type="credit", currency=self.currency, amount=self.amount,
+                         account_id=self.credit_account_id)
+
+    @staticmethod
+    def copy_from_transactions():
+        """
+        Replaces postings with the transactions and transfers of the ledger. Postings keep the ids of transactions.
+        :return: Returns the number of copied postings.
+        """
+        with atomic():
+            Postings.objects.all().delete()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO {postings} (id, transaction_id, debit_account_id, credit_account_id, "
+                    "transaction_type, currency, amount, created, expires_at) "
+                    "SELECT t.id, t.transaction_id, d.account_id, c.account_id, t.transaction_type, d.currency, "
+                    "d.amount, t.created, t.expires_at FROM {transactions} t "
+                    "INNER JOIN {transfers} d ON d.id = t.transfer_from_id "
+                    "INNER JOIN {transfers} c ON c.id = t.transfer_to_id"
+                    .format(postings=Postings._meta.db_table, transactions=Transactions._meta.db_table,
+                            transfers=Transfers._meta.db_table))
+                copied = cursor.rowcount
+                # ids were given explicitly, so the id sequence is moved past them.
+                for sql in connection.ops.sequence_reset_sql(no_style(), [Postings]):
+                    cursor.execute(sql)
+        return copied
+
+    def save(self, *args, clean=True, **kwargs):
+        # ledger writes are validated beforehand by Transactions.validate_posting, which doesn't query accounts.
+        if clean:
+            self.full_clean()
+        return super(Postings, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "{0} {1} {2} {3} from: {4} to: {5} t_id: {6}".format(
+            self.created, self.transaction_type, from_minor_units(self.amount, self.currency), self.currency,
+            self.debit_account_id,
+            self.credit_account_id, self.transaction_id)
+
+
+class OpenAuthorizations(models.Model):
+    """
+    OpenAuthorizations model is the book of authorizations which can still be presented. Presentments find their 
+    authorization here by transaction_id, so matching doesn't depend on the size of the ledger. A row is deleted 
+    when its hold is presented in full, released or expired.
+        Fields:
+        - transaction_id: The transaction_id of the authorization.
+        - entry_id: The id of the authorization transaction, or the posting in the compact ledger.
+        - remaining_amount: The held amount which hasn't been presented yet, in minor units of the currency of 
+        authorization. It is the same as the amount of the authorization, which is reduced by partial presentments.
+    """
+    transaction_id = models.CharField(max_length=20, db_index=True)
+    entry_id = models.IntegerField(unique=True)
+    remaining_amount = models.BigIntegerField(validators=[MinValueValidator(0), MaxValueValidator(MAX_UNITS)])
+
+    @staticmethod
+    def open(transactions):
+        """
+        Adds saved authorizations which have a transaction_id to the book. Must be called inside the database 
+        transaction which saves them.
+        :param transactions: The saved transactions, or postings if the compact ledger is used.
+        :return: None
+        """
+        OpenAuthorizations.objects.bulk_create(
+            OpenAuthorizations(transaction_id=transaction.transaction_id, entry_id=transaction.pk,
+                               remaining_amount=transaction.transfer_from.amount)
+            for transaction in transactions
+            if transaction.transaction_type == "authorization" and transaction.transaction_id)
+
+    @staticmethod
+    def close(entry_ids):
+        """
+        Removes authorizations from the book.
+        :param entry_ids: Ids of the authorizations.
+        :return: None
+        """
+        OpenAuthorizations.objects.filter(entry_id__in=entry_ids).delete()
+
+    @staticmethod
+    def lock(transaction_ids):
+        """
+        Locks the open authorizations of transaction ids until the end of the current database transaction. Must be 
+        called inside an atomic block.
+        :param transaction_ids: The transaction ids.
+        :return: Returns a dictionary of transaction_id keys and lists of open authorizations, the oldest first.
+        """
+        rows = OpenAuthorizations.objects.filter(transaction_id__in=transaction_ids)
+        if connection.features.has_select_for_update:
+            rows = rows.select_for_update()
+        else:
+            # SQLite doesn't have row locks. Any write takes the database write lock, which is held until commit.
+            rows.update(remaining_amount=F("remaining_amount"))
+        book = {}
+        for row in rows.order_by("entry_id"):
+            book.setdefault(row.transaction_id, []).append(row)
+        return book
+
+    @staticmethod
+    def save_book(rows):
+        """
+        Saves the remaining amounts of changed open authorizations. Rows without a remaining amount are deleted.
+        :param rows: The changed open authorizations.
+        :return: None
+        """
+        closed = []
+        for row in rows:
+            if row.remaining_amount:
+                OpenAuthorizations.objects.filter(pk=row.pk).update(remaining_amount=row.remaining_amount)
+            else:
+                closed.append(row.entry_id)
+        if closed:
+            OpenAuthorizations.close(closed)
+
+    def save(self, *args, **kwargs):
+        self.full_clean()
+        return super(OpenAuthorizations, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "{0} t_id: {1} remaining: {2}".format(self.entry_id, self.transaction_id, self.remaining_amount)
+
+
+class Balances(models.Model):
+    """
+    Balances model keeps the ledger and available balance of an account per currency. The balances are updated in 
+    the same database transaction as the postings, so reading them doesn't need to go through the whole ledger.
+        Fields:
+        - account: A reference to the account of balance.
+        - currency: ISO standard char sequence.
+        - ledger_balance: Sum of presentment transfers in minor units of currency.
+        - available_balance: Sum of presentment and authorization transfers in minor units of currency.
+        - shard: Balances of the system accounts are split into several rows per currency, so concurrent postings 
+        update different rows. The balance is the sum of the rows. Other accounts only have shard 0.
+    """
+    account = models.ForeignKey(Accounts, on_delete=models.PROTECT, blank=False)
+    currency = models.CharField(choices=CURRENCIES, max_length=3, blank=False)
+    ledger_balance = models.BigIntegerField(default=0)
+    available_balance = models.BigIntegerField(default=0)
+    shard = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("account", "currency", "shard"),)
+
+    @staticmethod
+    def get_balance(account, currency):
+        """
+        Gets balance of account in given currency.
+        :param account: The account model.
+        :param currency: Currency in ISO character format.
+        :return: Returns the balance. If account doesn't have any postings in the currency, an unsaved zero balance 
+        is returned.
+        """
+        return Balances.total(account, currency, Balances.objects.filter(account=account, currency=currency))
+
+    @staticmethod
+    def lock(account, currency):
+        """
+        Locks balance of account until the end of the current database transaction. Concurrent locks of the balance 
+        wait until the transaction is committed or rolled back. Must be called inside an atomic block.
+        :param account: The account model.
+        :param currency: Currency in ISO character format.
+        :return: Returns the locked balance.
+        """
+        balances = Balances.objects.filter(account=account, currency=currency)
+        if connection.features.has_select_for_update:
+            balances = balances.select_for_update()
+        else:
+            # SQLite doesn't have row locks. Any write takes the database write lock, which is held until commit.
+            balances.update(available_balance=F("available_balance"))
+        return Balances.total(account, currency, balances)
+
+    @staticmethod
+    def lock_all(account):
+        """
+        Locks balances of account in all currencies like lock. Must be called inside an atomic block.
+        :param account: The account model.
+        :return: Returns a list of the locked balances.
+        """
+        balances = Balances.objects.filter(account=account)
+        if connection.features.has_select_for_update:
+            balances = balances.select_for_update()
+        else:
+            balances.update(available_balance=F("available_balance"))
+        totals = {}
+        for balance in balances.order_by("currency", "shard"):
+            total = totals.setdefault(balance.currency, Balances(account=account, currency=balance.currency))
+            total.ledger_balance += balance.ledger_balance
+            total.available_balance += balance.available_balance
+        return list(totals.values())
+
+    @staticmethod
+    def total(account, currency, balances):
+        """
+        Adds up the shards of a balance.
+        :param account: The account model.
+        :param currency: Currency in ISO character format.
+        :param balances: Query of the balance rows of account in currency.
+        :return: Returns an unsaved balance with the sums. Without rows, it is a zero balance.
+        """
+        balance = Balances(account=account, currency=currency, ledger_balance=0, available_balance=0)
+        for row in balances:
+            balance.ledger_balance += row.ledger_balance
+            balance.available_balance += row.available_balance
+        return balance
+
+    @staticmethod
+    def stored_balances():
+        """
+        Gets the stored balances of all accounts with the shards added up.
+        :return: Dictionary of (account_id, currency) keys and (ledger_balance, available_balance) values in minor 
+        units.
+        """
+        balances = {}
+        for account_id, currency, ledger_balance, available_balance in Balances.objects.values_list(
+                "account_id", "currency", "ledger_balance", "available_balance"):
+            balance = balances.get((account_id, currency), (0, 0))
+            balances[account_id, currency] = (balance[0] + ledger_balance, balance[1] + available_balance)
+        return balances
+
+    @staticmethod
+    def get_shard(account_id, counterparty_id):
+        """
+        Picks the balance row of a posting. Postings of a system account are spread over its shards by a hash of the
+        other account, so postings of one card always go to the same shard.
+        :param account_id: The primary key of the posted account.
+        :param counterparty_id: The primary key of the other account of the posting.
+        :return: Returns the shard number.
+        """
+        shards = system_account_shards()
+        if shards == 1 or account_id not in SHARDED_ACCOUNTS:
+            return 0
+        return zlib.crc32(counterparty_id.encode()) % shards
+
+    @staticmethod
+    def post(transaction, previous_type=None):
+        """
+        Updates balances of the debit and credit accounts of transaction. Must be called inside the database 
+        transaction which saves the transaction.
+        :param transaction: The saved transaction.
+        :param previous_type: If the type of transaction was changed, the previous type. Its effect on balances is 
+        removed.
+        :return: None
+        """
+        Balances.post_many([transaction], previous_type)
+
+    @staticmethod
+    def post_many(transactions, previous_type=None):
+        """
+        Updates balances of the accounts of transactions with one update per account and currency. Must be called 
+        inside the database transaction which saves the transactions.
+        :param transactions: The transactions. Their transfers must have account, currency and amount in minor units 
+        set.
+        :param previous_type: If the type of transactions was changed, the previous type. Its effect on balances is 
+        removed.
+        :return: None
+        """
+        changes, ledger_changes = Balances.changes(transactions, previous_type)
+        # balances are always updated in the same order, so concurrent postings can't deadlock. Missing balance 
+        # rows, e.g. of new accounts, are created with one bulk insert.
+        missing = {(account_id, currency, shard): amounts
+                   for (account_id, currency, shard), amounts in sorted(changes.items())
+                   if not Balances._update(account_id, currency, *amounts, shard=shard)}
+        if missing:
+            try:
+                with atomic():
+                    Balances.objects.bulk_create(
+                        Balances(account_id=account_id, currency=currency, shard=shard, ledger_balance=ledger_amount,
+                                 available_balance=available_amount)
+                        for (account_id, currency, shard), (ledger_amount, available_amount) in missing.items())
+            except IntegrityError:
+                # a concurrent posting created some of the rows first.
+                for (account_id, currency, shard), (ledger_amount, available_amount) in missing.items():
+                    Balances.add(account_id, currency, ledger_amount, available_amount, shard)
+        for (account_id, currency), created in sorted(ledger_changes.items()):
+            BalanceSnapshots.invalidate(account_id, currency, created)
+
+    @staticmethod
+    def changes(transactions, previous_type=None):
+        """
+        Sums up the effect of transactions on balances.
+        :param transactions: The transactions. Their transfers must have account, currency and amount in minor units 
+        set.
+        :param previous_type: If the type of transactions was changed, the previous type. Its effect is subtracted.
+        :return: Returns a tuple of two dictionaries. The first one has (account_id, currency, shard) keys and 
+        [ledger amount, available amount] values in minor units and the second one (account_id, currency) keys and 
+        the creation time of the earliest transaction which changed the ledger balance.
+        """
+        changes = {}
+        ledger_changes = {}
+        for transaction in transactions:
+            ledger_sign = (transaction.transaction_type in LEDGER_TYPES) - (previous_type in LEDGER_TYPES)
+            available_sign = (transaction.transaction_type in AVAILABLE_TYPES) - (previous_type in AVAILABLE_TYPES)
+            if not ledger_sign and not available_sign:
+                continue
+            for transfer, counterparty, sign in ((transaction.transfer_from, transaction.transfer_to, -1),
+                                                 (transaction.transfer_to, transaction.transfer_from, 1)):
+                key = (transfer.account_id, transfer.currency)
+                amount = sign * transfer.amount
+                shard = Balances.get_shard(transfer.account_id, counterparty.account_id)
+                change = changes.setdefault(key + (shard,), [0, 0])
+                change[0] += ledger_sign * amount
+                change[1] += available_sign * amount
+                if ledger_sign:
+                    ledger_changes[key] = min(ledger_changes.get(key, transaction.created), transaction.created)
+        return changes, ledger_changes
+
+    @staticmethod
+    def add(account_id, currency, ledger_amount, available_amount, shard=0):
+        """
+        Adds amounts to the balances of account. Balance row is created if it doesn't exist yet.
+        :param account_id: The primary key of account.
+        :param currency: Currency in ISO character format.
+        :param ledger_amount: Minor units added to the ledger balance. Can be negative.
+        :param available_amount: Minor units added to the available balance. Can be negative.
+        :param shard: The shard of the balance row.
+        :return: None
+        """
+        if Balances._update(account_id, currency, ledger_amount, available_amount, shard):
+            return
+        try:
+            with atomic():
+                Balances.objects.create(account_id=account_id, currency=currency, shard=shard,
+                                        ledger_balance=ledger_amount, available_balance=available_amount)
+        except IntegrityError:
+            # a concurrent posting created the row first.
+            Balances._update(account_id, currency, ledger_amount, available_amount, shard)
+
+    @staticmethod
+    def _update(account_id, currency, ledger_amount, available_amount, shard=0):
+        """
+        Adds amounts to an existing balance row.
+        :return: Returns the number of updated rows, 0 if the row doesn't exist.
+        """
+        # batches update thousands of balances, and building the same ORM update for each of them takes longer than 
+        # running it.
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE {0} SET ledger_balance = ledger_balance + %s, "
+                           "available_balance = available_balance + %s WHERE account_id = %s AND currency = %s "
+                           "AND shard = %s".format(Balances._meta.db_table),
+                           [ledger_amount, available_amount, account_id, currency, shard])
+            return cursor.rowcount
+
+    @staticmethod
+    def calculate_from_ledger(time_threshold=None):
+        """
+        Calculates balances of all accounts from the ledger.
+        :param time_threshold: Time threshold for ledger balances. Available balances are always the current ones.
+        :return: Dictionary of (account_id, currency) keys and (ledger_balance, available_balance) values in minor 
+        units.
+        """
+        balances = {}
+        compact = compact_ledger()
+        for transaction_types, index, threshold in ((LEDGER_TYPES, 0, time_threshold), (AVAILABLE_TYPES, 1, None)):
+            for transfer_type, related_name, sign in (("debit", "transfer_from", -1), ("credit", "transfer_to", 1)):
+                if compact:
+                    account_field = transfer_type + "_account_id"
+                    conditions = {"transaction_type__in": transaction_types}
+                    if threshold is not None:
+                        conditions["created__lte"] = threshold
+                    entries = Postings.objects.filter(**conditions)
+                else:
+                    account_field = "account_id"
+                    conditions = {"transfer_type": transfer_type,
+                                  related_name + "__transaction_type__in": transaction_types}
+                    if threshold is not None:
+                        conditions[related_name + "__created__lte"] = threshold
+                    entries = Transfers.objects.filter(**conditions)
+                totals = entries.values(account_field, "currency").annotate(total=Sum("amount"))
+                for row in totals:
+                    key = (row[account_field], row["currency"])
+                    balance = balances.setdefault(key, [0, 0])
+                    balance[index] += sign * row["total"]
+        CarriedBalances.add_to(balances, time_threshold)
+        return {key: tuple(value) for key, value in balances.items()}
+
+    def save(self, *args, **kwargs):
+        self.full_clean()
+        return super(Balances, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "{} {}{} ledger: {} available: {}"\
+            .format(self.account_id, self.currency, " shard {}".format(self.shard) if self.shard else "",
+                    from_minor_units(self.ledger_balance, self.currency),
+                    from_minor_units(self.available_balance, self.currency))
+
+
+class BalanceSnapshots(models.Model):
+    """
+    BalanceSnapshots model keeps ledger balances of accounts at fixed checkpoints, so ledger balance at a given time 
+    only needs the presentments after the nearest earlier snapshot. Snapshots are written by snapshot_balances 
+    command, and snapshots which a back-dated posting would change are deleted.
+        Fields:
+        - account: A reference to the account of snapshot.
+        - currency: ISO standard char sequence.
+        - taken_at: The checkpoint time. Presentments created before or at this time are included.
+        - ledger_balance: Ledger balance at the checkpoint in minor units of currency.
+    """
+    account = models.ForeignKey(Accounts, on_delete=models.PROTECT, blank=False)
+    currency = models.CharField(choices=CURRENCIES, max_length=3, blank=False)
+    taken_at = models.DateTimeField(blank=False)
+    ledger_balance = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("account", "currency", "taken_at"),)
+
+    @staticmethod
+    def get_snapshot(account, currency, time_threshold):
+        """
+        Gets the nearest snapshot before or at time threshold.
+        :param account: The account model.
+        :param currency: Currency in ISO character format.
+        :param time_threshold: Time threshold.
+        :return: Returns the snapshot, or None if there isn't any.
+        """
+        return BalanceSnapshots.objects.filter(account=account, currency=currency, taken_at__lte=time_threshold)\
+            .order_by("-taken_at").first()
+
+    @staticmethod
+    def invalidate(account_id, currency, created):
+        """
+        Deletes snapshots which are changed by a posting.
+        :param account_id: The primary key of account.
+        :param currency: Currency in ISO character format.
+        :param created: Creation time of the posting. Snapshots taken at or after it are deleted.
+        :return: None
+        """
+        BalanceSnapshots.objects.filter(account_id=account_id, currency=currency, taken_at__gte=created).delete()
+
+    def save(self, *args, **kwargs):
+        self.full_clean()
+        return super(BalanceSnapshots, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "{} {} {} ledger: {}".format(self.taken_at, self.account_id, self.currency,
+                                            from_minor_units(self.ledger_balance, self.currency))
+
+
+class CarriedBalances(models.Model):
+    """
+    CarriedBalances model keeps the net effect of archived postings on the balances of an account per currency. 
+    archive_ledger command moves settled postings from the ledger to ArchivedPostings and adds them here in the same 
+    database transaction, so balances calculated from the ledger don't change.
+        Fields:
+        - account: A reference to the account of balance.
+        - currency: ISO standard char sequence.
+        - carried_until: The archival cutoff. Archived postings were created before or at this time.
+        - ledger_balance: Sum of archived presentment transfers in minor units of currency.
+        - available_balance: Sum of archived presentment and authorization transfers in minor units of currency.
+    """
+    account = models.ForeignKey(Accounts, on_delete=models.PROTECT, blank=False)
+    currency = models.CharField(choices=CURRENCIES, max_length=3, blank=False)
+    carried_until = models.DateTimeField(blank=False)
+    ledger_balance = models.BigIntegerField(default=0)
+    available_balance = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("account", "currency"),)
+
+    @staticmethod
+    def get_totals(account, currency, time_threshold=None, since=None):
+        """
+        Gets the effect of archived postings on balances of account, like Transactions.calculate_balances gets it 
+        for the ledger. Ledger balance at a time before the archival cutoff is summed up from the archive.
+        :param account: The account model.
+        :param currency: Currency in ISO character format.
+        :param time_threshold: Time threshold for ledger balance. If it is not given, all presentments are counted.
+        :param since: Optional start time for ledger balance. Only presentments created after it are counted.
+        :return: Dictionary with "ledger_balance" and "available_balance" in minor units.
+        """
+        carried = CarriedBalances.objects.filter(account=account, currency=currency).first()
+        if carried is None:
+            return {"ledger_balance": 0, "available_balance": 0}
+        return carried.totals(time_threshold, since)
+
+    def totals(self, time_threshold=None, since=None):
+        """
+        Gets the effect of archived postings on balances like get_totals, for the account and currency of this row.
+        """
+        if since is not None and since >= self.carried_until:
+            ledger_balance = 0
+        elif since is None and (time_threshold is None or time_threshold >= self.carried_until):
+            ledger_balance = self.ledger_balance
+        else:
+            ledger_balance = ArchivedPostings.calculate_ledger_balance(self.account_id, self.currency,
+                                                                       time_threshold, since)
+        return {"ledger_balance": ledger_balance, "available_balance": self.available_balance}
+
+    @staticmethod
+    def add_to(balances, time_threshold=None):
+        """
+        Adds the effect of archived postings to balances calculated from the ledger.
+        :param balances: Dictionary of (account_id, currency) keys and [ledger_balance, available_balance] values in
+        minor units. It is updated in place.
+        :param time_threshold: Time threshold for ledger balances.
+        :return: None
+        """
+        carried_balances = list(CarriedBalances.objects.all())
+        archived = {}
+        if any(time_threshold is not None and time_threshold < carried.carried_until
+               for carried in carried_balances):
+            archived = ArchivedPostings.calculate_ledger_balances(time_threshold)
+        for carried in carried_balances:
+            key = (carried.account_id, carried.currency)
+            balance = balances.setdefault(key, [0, 0])
+            if time_threshold is None or time_threshold >= carried.carried_until:
+                balance[0] += carried.ledger_balance
+            else:
+                balance[0] += archived.get(key, 0)
+            balance[1] += carried.available_balance
+
+    @staticmethod
+    def carry(transactions, carried_until):
+        """
+        Adds archived transactions to the carried balances of their accounts. Must be called inside the database 
+        transaction which archives them.
+        :param transactions: The archived transactions or postings.
+        :param carried_until: The archival cutoff.
+        :return: None
+        """
+        changes, ledger_changes = Balances.changes(transactions)
+        for (account_id, currency, shard), (ledger_amount, available_amount) in sorted(changes.items()):
+            carried_balances = CarriedBalances.objects.filter(account_id=account_id, currency=currency)
+            if not carried_balances.update(ledger_balance=F("ledger_balance") + ledger_amount,
+                                           available_balance=F("available_balance") + available_amount):
+                CarriedBalances.objects.create(account_id=account_id, currency=currency, carried_until=carried_until,
+                                               ledger_balance=ledger_amount, available_balance=available_amount)
+
+    def save(self, *args, **kwargs):
+        self.full_clean()
+        return super(CarriedBalances, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "{} {} until: {} ledger: {} available: {}"\
+            .format(self.account_id, self.currency, self.carried_until,
+                    from_minor_units(self.ledger_balance, self.currency),
+                    from_minor_units(self.available_balance, self.currency))
+
+
+class ArchivedPostings(models.Model):
+    """
+    ArchivedPostings model keeps settled postings which archive_ledger command has moved out of the ledger. Their 
+    effect on balances is kept in CarriedBalances, and they are only read for ledger balances before the cutoff.
+        Fields:
+        - entry_id: The id of the transaction, or the posting in the compact ledger.
+        - transaction_id: It is used to identify authorization and presentment postings.
+        - debit_account: The account where the funds were deducted.
+        - credit_account: The account where the funds were added.
+        - transaction_type: The type of posting. Possible values: presentment, settlement and expired.
+        - currency: ISO standard char sequence.
+        - amount: Posting amount in minor units of currency.
+        - created: A timestamp when posting was created.
+        - archived: A timestamp when posting was archived.
+    """
+    entry_id = models.IntegerField(blank=False)
+    transaction_id = models.CharField(max_length=20, blank=True)
+    # the indexes of accounts and currency cover the accounts.
+    debit_account = models.ForeignKey(Accounts, on_delete=models.PROTECT, related_name="archived_debit_postings",
+                                      db_index=False)
+    credit_account = models.ForeignKey(Accounts, on_delete=models.PROTECT, related_name="archived_credit_postings",
+                                       db_index=False)
+    transaction_type = models.CharField(choices=TRANSACTION_TYPES, max_length=13, blank=False)
+    currency = models.CharField(choices=CURRENCIES, max_length=3, blank=False)
+    amount = models.BigIntegerField(blank=False, validators=[MinValueValidator(1), MaxValueValidator(MAX_UNITS)])
+    created = models.DateTimeField(blank=False)
+    archived = models.DateTimeField(default=timezone.now, blank=False)
+
+    class Meta:
+        indexes = [
+            # balance calculation
+            models.Index(fields=["debit_account", "currency"]),
+            models.Index(fields=["credit_account", "currency"]),
+        ]
+
+    @staticmethod
+    def archive(carried_until, chunk_size):
+        """
+        Moves a chunk of settled postings created before or at the cutoff from the ledger to the archive and adds
+        them to the carried balances in one database transaction.
+        :param carried_until: The archival cutoff.
+        :param chunk_size: The maximum number of moved postings.
+        :return: Returns the number of moved postings. 0 means that the ledger doesn't have any more of them.
+        """
+        compact = compact_ledger()
+        entries = list(Transactions.ledger_entries()
+                       .filter(transaction_type__in=ARCHIVED_TYPES, created__lte=carried_until)
+                       .order_by("id")[:chunk_size])
+        if not entries:
+            return 0
+        entry_ids = [entry.id for entry in entries]
+        # settled postings don't change anymore, so they can be read before the database transaction. The insert
+        # is its first statement, which takes the SQLite write lock.
+        with atomic():
+            ArchivedPostings.objects.bulk_create(
+                ArchivedPostings(entry_id=entry.id, transaction_id=entry.transaction_id,
+                                 debit_account_id=entry.transfer_from.account_id,
+                                 credit_account_id=entry.transfer_to.account_id,
+                                 transaction_type=entry.transaction_type, currency=entry.transfer_from.currency,
+                                 amount=entry.transfer_from.amount, created=entry.created)
+                for entry in entries)
+            CarriedBalances.objects.filter(carried_until__lt=carried_until).update(carried_until=carried_until)
+            CarriedBalances.carry(entries, carried_until)
+            if compact:
+                deleted, _ = Postings.objects.filter(id__in=entry_ids).delete()
+            else:
+                deleted, _ = Transactions.objects.filter(id__in=entry_ids).delete()
+                Transfers.objects.filter(id__in=[transfer_id for entry in entries for transfer_id in
+                                                 (entry.transfer_from_id, entry.transfer_to_id)]).delete()
+            if deleted != len(entries):
+                raise ValueError("Postings were archived concurrently.")
+        return len(entries)
+
+    @staticmethod
+    def calculate_ledger_balance(account, currency, time_threshold=None, since=None):
+        """
+        Calculates the ledger balance of archived presentments of account.
+        :param account: The account model.
+        :param currency: Currency in ISO character format.
+        :param time_threshold: Optional time threshold. Only presentments created before or at it are counted.
+        :param since: Optional start time. Only presentments created after it are counted.
+        :return: Returns the balance in minor units.
+        """
+        conditions = Q(transaction_type__in=LEDGER_TYPES, currency=currency.upper())
+        if time_threshold is not None:
+            conditions &= Q(created__lte=time_threshold)
+        if since is not None:
+            conditions &= Q(created__gt=since)
+        totals = ArchivedPostings.objects.filter(Q(debit_account=account) | Q(credit_account=account))\
+            .filter(conditions).aggregate(debit=Sum(models.Case(models.When(debit_account=account, then="amount"))),
+                                          credit=Sum(models.Case(models.When(credit_account=account,
+                                                                             then="amount"))))
+        return (totals["credit"] or 0) - (totals["debit"] or 0)
+
+    @staticmethod
+    def calculate_ledger_balances(time_threshold=None):
+        """
+        Calculates ledger balances of archived presentments of all accounts.
+        :param time_threshold: Optional time threshold. Only presentments created before or at it are counted.
+        :return: Dictionary of (account_id, currency) keys and ledger balances in minor units.
+        """
+        conditions = {"transaction_type__in": LEDGER_TYPES}
+        if time_threshold is not None:
+            conditions["created__lte"] = time_threshold
+        balances = {}
+        for account_field, sign in (("debit_account_id", -1), ("credit_account_id", 1)):
+            totals = ArchivedPostings.objects.filter(**conditions).values(account_field, "currency")\
+                .annotate(total=Sum("amount"))
+            for row in totals:
+                key = (row[account_field], row["currency"])
+                balances[key] = balances.get(key, 0) + sign * row["total"]
+        return balances
+
+    def save(self, *args, **kwargs):
+        self.full_clean()
+        return super(ArchivedPostings, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "{0} {1} {2} {3} from: {4} to: {5} t_id: {6}".format(
+            self.created, self.transaction_type, from_minor_units(self.amount, self.currency), self.currency,
+            self.debit_account_id, self.credit_account_id, self.transaction_id)
+
+
+class ClearingFiles(models.Model):
+    """
+    ClearingFiles model keeps track of ingested clearing files, so an interrupted ingestion can be continued.
+        Fields:
+        - file_name: The absolute path of clearing file.
+        - offset: Byte offset in the file after the last committed record.
+        - records: The number of committed records.
+        - updated: A timestamp when the offset was last updated.
+    """
+    file_name = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
+    records = models.BigIntegerField(default=0)
+    updated = models.DateTimeField(default=timezone.now)
+
+    def save(self, *args, **kwargs):
+        self.full_clean()
+        return super(ClearingFiles, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "{} offset: {} records: {}".format(self.file_name, self.offset, self.records)
+
+
+class WebhookResponses(models.Model):
+    """
+    WebhookResponses model stores outcomes of webhook messages, so retried messages get the same response without 
+    touching the ledger.
+        Fields:
+        - message_type: authorization, presentment or presentment_part.
+        - transaction_id: The transaction_id of the message, or presentment_id of a presentment_part.
+        - status: HTTP status of the response. Empty while the message is being processed.
+        - content: The response body.
+        - expires_at: A timestamp after which the response is no longer replayed.
+    """
+    message_type = models.CharField(choices=MESSAGE_TYPES, max_length=16)
+    transaction_id = models.CharField(max_length=20)
+    status = models.PositiveSmallIntegerField(null=True, blank=True)
+    content = models.TextField(blank=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = (("message_type", "transaction_id"),)
+        indexes = [
+            # purge
+            models.Index(fields=["expires_at"]),
+        ]
+
+    @staticmethod
+    def replay(message_type, transaction_id):
+        """
+        Gets the stored response of a message from the cache or the database.
+        :param message_type: authorization, presentment or presentment_part.
+        :param transaction_id: The transaction_id of the message.
+        :return: Returns a tuple of status and content, or None if the message has no unexpired response.
+        """
+        key = (message_type, transaction_id)
+        response = response_cache.get(key)
+        if response is not None:
+            return response
+        now = timezone.now()
+        stored = WebhookResponses.objects.filter(message_type=message_type, transaction_id=transaction_id,
+                                                 status__isnull=False, expires_at__gt=now)\
+            .values_list("status", "content", "expires_at").first()
+        if stored is None:
+            return None
+        # responses read inside an atomic block might still be rolled back.
+        if not connection.in_atomic_block:
+            response_cache.set(key, stored[:2], (stored[2] - now).total_seconds())
+        return stored[:2]
+
+    @staticmethod
+    def claim(message_type, transaction_id):
+        """
+        Saves a pending response of a message before it is processed. Must be called inside the atomic block which
+        processes the message. Until the block ends, a concurrent claim of the same message waits for it and then
+        fails.
+        :param message_type: authorization, presentment or presentment_part.
+        :param transaction_id: The transaction_id of the message.
+        :return: Returns the pending response. Raises IntegrityError if the message already has a response, and the
+        atomic block has to be rolled back.
+        """
+        pending = WebhookResponses(message_type=message_type, transaction_id=transaction_id,
+                                   expires_at=timezone.now() + timezone.timedelta(seconds=response_cache.timeout))
+        pending.save(clean=False)
+        return pending
+
+    @staticmethod
+    def delete_expired(message_type, transaction_id):
+        """
+        Deletes an expired response of a message, so the message can be claimed again.
+        :param message_type: authorization, presentment or presentment_part.
+        :param transaction_id: The transaction_id of the message.
+        :return: Returns True if an expired response was deleted.
+        """
+        return WebhookResponses.objects.filter(message_type=message_type, transaction_id=transaction_id,
+                                               expires_at__lte=timezone.now()).delete()[0] > 0
+
+    def store(self, status, content):
+        """
+        Stores the response of a claimed message. It is cached when the database transaction is committed.
+        :param status: HTTP status of the response.
+        :param content: The response body.
+        :return: None
+        """
+        self.status = status
+        self.content = content
+        WebhookResponses.objects.filter(pk=self.pk).update(status=status, content=content)
+        on_commit(lambda: response_cache.set((self.message_type, self.transaction_id), (status, content)))
+
+    @staticmethod
+    def purge():
+        """
+        Deletes expired responses.
+        :return: Returns the number of deleted responses.
+        """
+        return WebhookResponses.objects.filter(expires_at__lte=timezone.now()).delete()[0]
+
+    def save(self, *args, clean=True, **kwargs):
+        # claims are inserted without validation, because the unique check would read before the first write.
+        if clean:
+            self.full_clean()
+        return super(WebhookResponses, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "{} {} {}".format(self.message_type, self.transaction_id, self.status)
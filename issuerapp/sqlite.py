@@ -0,0 +1,238 @@
+import functools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connection, DatabaseError, OperationalError
+from django.db.transaction import atomic, set_rollback
+
+from .metrics import metrics
+
+def sqlite_settings():
+    """
+    :return: Returns ISSUER_SQLITE setting with "PRAGMAS", "SERIALIZE_WRITES", "TIMEOUT" and "GROUP_COMMIT" keys. 
+    TIMEOUT is in seconds.
+    """
+    options = {"PRAGMAS": {}, "SERIALIZE_WRITES": False, "TIMEOUT": 30, "GROUP_COMMIT": {}}
+    options.update(getattr(settings, "ISSUER_SQLITE", {}))
+    return options
+
+def group_commit_settings():
+    """
+    :return: Returns ISSUER_SQLITE["GROUP_COMMIT"] setting with "ENABLED", "WINDOW" and "SIZE" keys. WINDOW is in 
+    seconds.
+    """
+    options = {"ENABLED": False, "WINDOW": 0.002, "SIZE": 64}
+    options.update(sqlite_settings()["GROUP_COMMIT"])
+    return options
+
+def apply_pragmas(sender, connection, **kwargs):
+    """
+    Receiver of connection_created signal which sets the pragmas of ISSUER_SQLITE setting on new SQLite connections.
+    """
+    if connection.vendor != "sqlite":
+        return
+    # the pragmas are run on the DB-API connection, so they are not counted as queries of requests.
+    for name, value in sqlite_settings()["PRAGMAS"].items():
+        connection.connection.execute("PRAGMA {0} = {1}".format(name, value))
+
+class WriteTask:
+    """
+    A function queued for the writer, and its outcome.
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # execute wrappers of the caller, e.g. query counters of metrics, also see the queries of the writer.
+        self.wrappers = list(connection.execute_wrappers)
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+        self.duration = 0.0
+        self.result = None
+        self.error = None
+
+    def run(self):
+        """
+        Runs the function and keeps its result or exception.
+        :return: None
+        """
+        started = time.perf_counter()
+        self.result, self.error = None, None
+        try:
+            with ExitStack() as stack:
+                for wrapper in self.wrappers:
+                    stack.enter_context(connection.execute_wrapper(wrapper))
+                self.result = self.func(*self.args, **self.kwargs)
+        except BaseException as error:
+            self.error = error
+        self.duration = time.perf_counter() - started
+
+    def release(self):
+        """
+        Records the latency which the writer added to the function and wakes up the caller.
+        :return: None
+        """
+        metrics.observe("issuer_writer_added_latency_seconds", time.perf_counter() - self.queued_at - self.duration)
+        if self.error is not None:
+            self.future.set_exception(self.error)
+        else:
+            self.future.set_result(self.result)
+
+class SerializedWriter:
+    """
+    Runs write transactions one at a time in a dedicated thread, which has its own database connection. SQLite has a
+    single write lock for the whole database, so threads of a process queue up here instead of waiting for the lock
+    with busy timeouts and failing when it runs out. With group commit, functions queued within a short window are
+    run in one database transaction, so they share one commit and its fsync.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    @staticmethod
+    def enabled():
+        """
+        :return: Returns True if writes are serialized. It is set with ISSUER_SQLITE["SERIALIZE_WRITES"] setting and
+        only used with SQLite.
+        """
+        return connection.vendor == "sqlite" and sqlite_settings()["SERIALIZE_WRITES"]
+
+    def run(self, func, *args, **kwargs):
+        """
+        Runs a function in the writer thread and waits until its writes are committed. The function is run in the
+        calling thread if writes are not serialized, or if the caller is already inside an atomic block, whose 
+        connection the function has to use.
+        :param func: The function which makes the writes. It should make them in an atomic block. With group commit,
+        it is run again if the commit of its group fails, so it shouldn't change its arguments before its writes, 
+        and it shouldn't have side effects outside the database, e.g. metrics, which the caller can record after
+        the function returns. on_commit callbacks of a failed group are discarded with its rollback.
+        :param args: Arguments of the function.
+        :param kwargs: Keyword arguments of the function.
+        :return: Returns the return value of the function, or raises its exception. Raises OperationalError if the 
+        writer doesn't finish the function within ISSUER_SQLITE["TIMEOUT"] seconds. The function isn't run if it 
+        hasn't been started by then, but a function which was already running may still commit its writes.
+        """
+        if threading.current_thread() is self._thread or connection.in_atomic_block or not self.enabled():
+            return func(*args, **kwargs)
+        tasks = self._start()
+        task = WriteTask(func, args, kwargs)
+        tasks.put(task)
+        timeout = sqlite_settings()["TIMEOUT"]
+        try:
+            return task.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            task.future.cancel()
+            raise OperationalError("The writer didn't run {0} within {1} seconds.".format(func.__name__, timeout))
+
+    def _start(self):
+        with self._start_lock:
+            # a forked process doesn't have the thread of its parent.
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._work, args=(self._queue,), name="issuer-writer",
+                                                daemon=True)
+                self._thread.start()
+            return self._queue
+
+    def _work(self, tasks):
+        while True:
+            group = []
+            try:
+                self._collect(tasks, group)
+                if group:
+                    self._process(tasks, group)
+            except Exception as error:
+                # the writer thread keeps running, so a failure outside the functions, e.g. in an on_commit callback, 
+                # only fails the callers of its group.
+                for task in group:
+                    if not task.future.done():
+                        task.future.set_exception(error)
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+    def _process(self, tasks, group):
+        """
+        Runs a group of tasks, and releases their callers.
+        :return: None
+        """
+        metrics.observe("issuer_writer_batch_size", len(group))
+        if len(group) == 1:
+            group[0].run()
+        elif not self._commit_group(group):
+            # e.g. a foreign key of one function failed at commit, so the functions are committed one by one.
+            metrics.inc("issuer_writer_group_failures_total")
+            for task in group:
+                task.run()
+        # like at the end of a request, the connection is closed if it is broken or older than CONN_MAX_AGE. It
+        # is kept open while writes are queued.
+        if any(task.error is not None for task in group) or tasks.empty():
+            connection.close_if_unusable_or_obsolete()
+        for task in group:
+            task.release()
+
+    @staticmethod
+    def _collect(tasks, group):
+        """
+        Waits for the next task. With group commit, tasks which are queued within the window after it are added, 
+        until the group has SIZE tasks. Tasks whose callers have stopped waiting are left out.
+        :param tasks: The queue of tasks.
+        :param group: The list where the tasks are added.
+        :return: None
+        """
+        task = tasks.get()
+        if task.future.set_running_or_notify_cancel():
+            group.append(task)
+        options = group_commit_settings()
+        if not options["ENABLED"]:
+            return
+        deadline = task.queued_at + options["WINDOW"]
+        while len(group) < options["SIZE"]:
+            timeout = deadline - time.perf_counter()
+            try:
+                task = tasks.get(timeout=timeout) if timeout > 0 else tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task.future.set_running_or_notify_cancel():
+                group.append(task)
+
+    @staticmethod
+    def _commit_group(group):
+        """
+        Runs tasks in one database transaction. Each task has its own savepoint, so a failed task doesn't roll back 
+        the others.
+        :return: Returns False if the transaction couldn't be committed.
+        """
+        try:
+            with atomic():
+                for task in group:
+                    with atomic():
+                        task.run()
+                        if task.error is not None:
+                            set_rollback(True)
+        except DatabaseError:
+            return False
+        return True
+
+writer = SerializedWriter()
+
+def serialized(func):
+    """
+    Decorator which runs the function with the writer. Like functions of SerializedWriter.run, the function may be 
+    run again if the commit of its group fails, so it must not have side effects outside the database except 
+    on_commit callbacks.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return writer.run(func, *args, **kwargs)
+    return wrapper
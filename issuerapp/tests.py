@@ -1,9 +1,30 @@
-from django.test import TestCase
-from .models import Transactions, Accounts, Transfers
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.conf import settings
+from django.db import connection, connections, IntegrityError, OperationalError
+from django.db.transaction import atomic
+from django.core.management import call_command, CommandError
+from .models import Transactions, Accounts, Transfers, Balances, BalanceSnapshots, ClearingFiles, WebhookResponses, \
+    Postings, CarriedBalances, ArchivedPostings, OpenAuthorizations, account_cache, response_cache, fx_rates, \
+    compact_ledger
+from .cache import AccountCache, ResponseCache, FxRates
+from .currencies import currency_exponent, to_minor_units, from_minor_units, rescale_units
+from .sqlite import writer
+from .metrics import Metrics, metrics
 from django.utils import timezone
 from django.core.exceptions import ValidationError
-from decimal import Decimal
+from decimal import Decimal, ROUND_CEILING
 from pytz import UTC
+from io import StringIO
+import json
+from unittest import skipIf, mock
+import tempfile
+import os
+import multiprocessing
+import asyncio
+import threading
+import time
+from urllib.parse import urlencode
+from . import asgi, webhooks
 
 class AccountsTests(TestCase):
     SCHEME = "scheme"
@@ -21,6 +42,80 @@ class AccountsTests(TestCase):
         self.assertEqual(account.cardholder, self.SCHEME)
         self.assertEqual(account.main_currency, "EUR")
 
+class AccountCacheTests(TransactionTestCase):
+    SCHEME = "scheme"
+    STUDENT = "student"
+
+    def setUp(self):
+        account_cache.clear()
+        self.addCleanup(account_cache.clear)
+
+    def test_get_account_is_cached(self):
+        Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Accounts.get_account(self.STUDENT)
+        with self.assertNumQueries(0):
+            account = Accounts.get_account(self.STUDENT)
+        self.assertEqual(account.main_currency, "EUR")
+        self.assertEqual(account_cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    def test_saved_and_deleted_accounts_are_invalidated(self):
+        account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Accounts.get_account(self.STUDENT)
+        account.main_currency = "USD"
+        account.save()
+        self.assertEqual(Accounts.get_account(self.STUDENT).main_currency, "USD")
+        account.delete()
+        with self.assertRaises(Accounts.DoesNotExist):
+            Accounts.get_account(self.STUDENT)
+
+    def test_accounts_are_not_cached_inside_atomic_block(self):
+        with atomic():
+            Accounts.get_account(self.STUDENT, can_create_new_account=True)
+            Accounts.get_account(self.STUDENT)
+        self.assertEqual(account_cache.stats()["size"], 0)
+
+    def test_least_recently_used_account_is_evicted(self):
+        cache = AccountCache(size=2, pinned=[self.SCHEME])
+        for name in (self.SCHEME, "a", "b"):
+            cache.set(Accounts(cardholder=name))
+        cache.get("a")
+        cache.set(Accounts(cardholder="c"))
+        self.assertIsNone(cache.get("b"))
+        for name in (self.SCHEME, "a", "c"):
+            self.assertEqual(cache.get(name).cardholder, name)
+
+    @override_settings(CACHES=dict(settings.CACHES, shared={
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "account-cache-tests"}))
+    def test_account_changed_by_another_process_is_not_stale(self):
+        cache, other_process_cache = AccountCache(cache_alias="shared"), AccountCache(cache_alias="shared")
+        cache.set(Accounts(cardholder=self.STUDENT, main_currency="EUR"))
+        self.assertEqual(other_process_cache.get(self.STUDENT).main_currency, "EUR")
+        cache.invalidate(self.STUDENT)
+        cache.set(Accounts(cardholder=self.STUDENT, main_currency="USD"))
+        self.assertEqual(other_process_cache.get(self.STUDENT).main_currency, "USD")
+        self.assertEqual(other_process_cache.stats()["size"], 0)
+
+class CurrenciesTests(TestCase):
+
+    def test_minor_units_use_exponent_of_currency(self):
+        self.assertEqual([currency_exponent(code) for code in ("EUR", "JPY", "KWD")], [2, 0, 3])
+        self.assertEqual(to_minor_units("12.34", "EUR"), 1234)
+        self.assertEqual(to_minor_units(0.1, "EUR"), 10)
+        self.assertEqual(to_minor_units("500", "JPY"), 500)
+        self.assertEqual(to_minor_units(Decimal("1.234"), "KWD"), 1234)
+        self.assertEqual(str(from_minor_units(1234, "EUR")), "12.34")
+        self.assertEqual(str(from_minor_units(0, "EUR")), "0.00")
+        self.assertEqual(str(from_minor_units(-500, "JPY")), "-500")
+        self.assertEqual(str(from_minor_units(1234, "KWD")), "1.234")
+        self.assertEqual(rescale_units(100, "JPY", "EUR"), 10000)
+        self.assertEqual(rescale_units(1235, "KWD", "EUR"), 123)
+        self.assertEqual(rescale_units(1235, "KWD", "EUR", ROUND_CEILING), 124)
+
+    def test_amounts_which_are_not_whole_minor_units_are_rejected(self):
+        for amount, currency in (("0.001", "EUR"), ("1.5", "JPY"), ("abc", "EUR"), ("NaN", "EUR")):
+            with self.assertRaises(ValueError):
+                to_minor_units(amount, currency)
+
 class TransactionsTests(TestCase):
     MILLIONAIRE = "millionaire"
     STUDENT = "student"
@@ -69,17 +164,17 @@ class TransactionsTests(TestCase):
         transaction = Transactions.create_transaction(debit_account, credit_account, transaction_type="authorization",
                                                       currency="EUR", amount=0.01, transaction_id="t_id123")
         self.assertIs(type(transaction), Transactions) # right type is returned
-        self.assertIn(transaction, Transactions.objects.all()) # transaction is saved
+        self.assertIn(transaction, Transactions.ledger_entries().all()) # transaction is saved
         self.assertEqual(transaction.transaction_type, "authorization")  # correct transaction_type
         self.assertEqual(transaction.transaction_id, "t_id123")  # correct transaction_id
 
         self.assertIs(transaction.transfer_from.account, debit_account) # transfer object has a right account
-        self.assertEqual(transaction.transfer_from.amount, Decimal('0.01'))  # transfer object has a right amount
+        self.assertEqual(transaction.transfer_from.amount, 1)  # transfer object has a right amount in cents
         self.assertEqual(transaction.transfer_from.currency, "EUR")  # transfer object has a right currency
         self.assertEqual(transaction.transfer_from.transfer_type, "debit") # transfer object has a right transfer type
 
         self.assertIs(transaction.transfer_to.account, credit_account)
-        self.assertEqual(transaction.transfer_to.amount, Decimal('0.01'))
+        self.assertEqual(transaction.transfer_to.amount, 1)
         self.assertEqual(transaction.transfer_to.currency, "EUR")
         self.assertEqual(transaction.transfer_to.transfer_type, "credit")
 
@@ -105,6 +200,33 @@ class TransactionsTests(TestCase):
             Transactions.create_transaction(credit_account, credit_account, transaction_type="authorization",
                                             currency="EUR", amount=0.00)
 
+    def test_amounts_are_stored_in_minor_units(self):
+        debit_account = Accounts.objects.get(cardholder=self.ISSUER)
+        credit_account = Accounts.objects.get(cardholder=self.MILLIONAIRE)
+        for currency, amount in (("EUR", "12.34"), ("JPY", "500"), ("KWD", "1.234")):
+            Transactions.create_transaction(debit_account, credit_account, "settlement", currency, amount)
+        settlements = Transactions.ledger_entries().filter(transaction_type="settlement").order_by("id")
+        self.assertEqual([(entry.transfer_to.currency, entry.transfer_to.amount) for entry in settlements],
+                         [("EUR", 1234), ("JPY", 500), ("KWD", 1234)])
+        with self.assertRaises(ValidationError):
+            Transactions.create_transaction(debit_account, credit_account, "settlement", "JPY", "0.5")
+
+    def test_create_transaction_query_count(self):
+        """
+        Tests that validation of create_transaction doesn't query accounts. The queries are savepoint and its release,
+        inserts of transfers and transaction and updates of both balances.
+        """
+        debit_account = Accounts.objects.get(cardholder=self.MILLIONAIRE)
+        credit_account = Accounts.objects.get(cardholder=self.ISSUER)
+        # balances of both accounts exist after the first transaction.
+        Transactions.create_transaction(debit_account, credit_account, "authorization", "EUR", 100)
+        with self.assertNumQueries(7):
+            Transactions.create_transaction(debit_account, credit_account, "authorization", "EUR", 100)
+        with self.assertNumQueries(0), self.assertRaises(ValidationError):
+            Transactions.create_transaction(debit_account, credit_account, "authorization", "EUR", "0.001")
+        with self.assertNumQueries(0), self.assertRaises(ValidationError):
+            Transactions.create_transaction(debit_account, credit_account, "authorization", "XXY", 100)
+
     def test_ledger_balance_is_successful(self):
         """
         Tests if getting ledger balance is successful.
@@ -115,7 +237,7 @@ class TransactionsTests(TestCase):
         self.assertEqual(balance_dict["ledger_balance"], "-100000.00")
 
         balance_dict = Transactions.get_ledger_balance(self.STUDENT, time_threshold=self.test_datetime)
-        self.assertEqual(balance_dict["ledger_balance"], "0")
+        self.assertEqual(balance_dict["ledger_balance"], "0.00")
 
         balance_dict = Transactions.get_ledger_balance(self.MILLIONAIRE, time_threshold=self.test_datetime)
         self.assertEqual(balance_dict["ledger_balance"], "100000.00")
@@ -159,6 +281,22 @@ class TransactionsTests(TestCase):
         self.assertEqual(balances["available_balance"], "-99800.00")
         self.assertEqual(balances["ledger_balance"], "-100000.00")
 
+    def test_calculate_balances_in_one_query(self):
+        self.__create_test_transactions()
+        account = Accounts.objects.get(cardholder=self.MILLIONAIRE)
+        with self.assertNumQueries(1):
+            totals = Transactions.calculate_balances(account, "EUR", self.test_datetime)
+        self.assertEqual(totals, {"ledger_debit": 0, "ledger_credit": 10000000,
+                                  "available_debit": 10000, "available_credit": 10010000})
+
+        totals = Transactions.calculate_balances(account, "EUR", self.test_datetime - timezone.timedelta(seconds=1))
+        self.assertEqual(totals["ledger_credit"], 0)
+
+    def test_show_balance_at_time_threshold(self):
+        self.__create_test_transactions()
+        balances = Transactions.show_balances(self.STUDENT, self.test_datetime)
+        self.assertEqual(balances, {"ledger_balance": "0.00", "available_balance": "-200.00"})
+
     def test_show_balance_invalid_account(self):
         self.__create_test_transactions()
         with self.assertRaises(Accounts.DoesNotExist):
@@ -196,6 +334,385 @@ class TransactionsTests(TestCase):
         with self.assertRaises(ValueError):
             Transactions.get_transactions(self.ISSUER, self.test_datetime, self.test_datetime - ten_seconds)
 
+class BalancesTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        self.issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        self.student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+
+    def test_balances_are_updated_with_postings(self):
+        Transactions.create_transaction(self.issuer_account, self.student_account, transaction_type="presentment",
+                                        currency="EUR", amount=100)
+        transaction = Transactions.create_transaction(self.student_account, self.issuer_account,
+                                                      transaction_type="authorization", currency="EUR", amount=30)
+        Transactions.create_transaction(self.issuer_account, self.student_account, transaction_type="settlement",
+                                        currency="EUR", amount=1000)
+        balance = Balances.objects.get(account=self.student_account, currency="EUR")
+        self.assertEqual(balance.ledger_balance, 10000)
+        self.assertEqual(balance.available_balance, 7000)
+
+        transaction.change_transaction_type("presentment")
+        balance = Balances.objects.get(account=self.student_account, currency="EUR")
+        self.assertEqual(balance.ledger_balance, 7000)
+        self.assertEqual(balance.available_balance, 7000)
+        balance = Balances.objects.get(account=self.issuer_account, currency="EUR")
+        self.assertEqual(balance.ledger_balance, -7000)
+
+    def test_failed_posting_does_not_change_balances(self):
+        Transactions.create_transaction(self.issuer_account, self.student_account, transaction_type="presentment",
+                                        currency="EUR", amount=100)
+        with self.assertRaises(ValidationError):
+            Transactions.create_transaction(self.student_account, self.issuer_account,
+                                            transaction_type="not_valid_choice", currency="EUR", amount=30)
+        self.assertEqual(Transactions.ledger_entries().count(), 1)
+        self.assertEqual(Transactions.get_available_balance(self.STUDENT)["available_balance"], "100.00")
+
+    def test_rebuild_balances(self):
+        Transactions.create_transaction(self.issuer_account, self.student_account, transaction_type="presentment",
+                                        currency="EUR", amount=100)
+        Transactions.create_transaction(self.student_account, self.issuer_account, transaction_type="authorization",
+                                        currency="EUR", amount=30)
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+        Balances.objects.filter(account=self.student_account).update(available_balance=0)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_balances", verify=True, stdout=StringIO())
+        call_command("rebuild_balances", stdout=StringIO())
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "100.00", "available_balance": "70.00"})
+
+@override_settings(ISSUER_SYSTEM_ACCOUNT_SHARDS=4)
+class ShardedBalancesTests(TestCase):
+    ISSUER = "issuer"
+    CARDS = ["card{0}".format(i) for i in range(8)]
+
+    def setUp(self):
+        self.issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        for card in self.CARDS:
+            account = Accounts.objects.create(cardholder=card, main_currency="EUR")
+            Transactions.create_transaction(self.issuer_account, account, transaction_type="presentment",
+                                            currency="EUR", amount=100)
+            Transactions.authorize(account, self.issuer_account, "EUR", 10)
+
+    def test_system_account_balance_is_sum_of_shards(self):
+        shards = Balances.objects.filter(account=self.issuer_account)
+        self.assertTrue(1 < shards.count() <= 4)
+        self.assertEqual(set(shards.values_list("shard", flat=True)) - {0, 1, 2, 3}, set())
+        self.assertEqual(Balances.objects.filter(account_id=self.CARDS[0]).get().shard, 0)
+        expected = {"ledger_balance": "-800.00", "available_balance": "-720.00"}
+        self.assertEqual(Transactions.show_balances(self.ISSUER), expected)
+        self.assertEqual(Transactions.show_currency_balances(self.ISSUER), {"EUR": expected})
+
+        # shards which were written with another setting are still counted.
+        with override_settings(ISSUER_SYSTEM_ACCOUNT_SHARDS=1):
+            Transactions.authorize(Accounts.get_account(self.CARDS[0]), self.issuer_account, "EUR", 10)
+        self.assertEqual(Transactions.get_available_balance(self.ISSUER)["available_balance"], "-710.00")
+
+    def test_rebuild_and_audit_sharded_balances(self):
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+        call_command("audit_ledger", workers=1, stdout=StringIO())
+        Balances.objects.filter(account=self.issuer_account).update(available_balance=0)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+        call_command("rebuild_balances", stdout=StringIO())
+        self.assertEqual(Balances.objects.filter(account=self.issuer_account).count(), 1)
+        self.assertEqual(Transactions.show_balances(self.ISSUER),
+                         {"ledger_balance": "-800.00", "available_balance": "-720.00"})
+
+class CurrencyBalancesTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        self.issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        self.student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        self.test_datetime = timezone.datetime(2018, 10, 10, tzinfo=UTC)
+        for currency, amount in (("EUR", 10), ("USD", 20), ("JPY", 1000)):
+            transaction = Transactions.create_transaction(self.issuer_account, self.student_account,
+                                                          transaction_type="presentment", currency=currency,
+                                                          amount=amount)
+            Transactions.ledger_entries().filter(pk=transaction.pk).update(created=self.test_datetime)
+        file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        json.dump({"base": "EUR", "rates": {"USD": "2", "JPY": "100"}}, file)
+        file.close()
+        self.addCleanup(os.remove, file.name)
+        self.addCleanup(fx_rates.clear)
+        self.rates_file = file.name
+
+    def test_currency_balances(self):
+        with self.assertNumQueries(1):
+            Transactions.get_currency_balances(self.student_account)
+        self.assertEqual(Transactions.show_currency_balances(self.STUDENT), {
+            "EUR": {"ledger_balance": "10.00", "available_balance": "10.00"},
+            "JPY": {"ledger_balance": "1000", "available_balance": "1000"},
+            "USD": {"ledger_balance": "20.00", "available_balance": "20.00"},
+        })
+        time_threshold = self.test_datetime - timezone.timedelta(days=1)
+        with self.assertNumQueries(2):
+            balances = Transactions.get_currency_balances(self.issuer_account, time_threshold)
+        self.assertEqual({currency: str(value["ledger_balance"]) for currency, value in balances.items()},
+                         {"EUR": "0.00", "JPY": "0", "USD": "0.00"})
+        self.assertEqual(str(balances["USD"]["available_balance"]), "-20.00")
+
+    def test_authorization_with_fx_rates(self):
+        transaction, balance = Transactions.authorize(self.student_account, self.issuer_account, "EUR", 15)
+        self.assertIsNone(transaction)
+        self.assertEqual(balance, Decimal("10.00"))
+
+        with mock.patch.object(fx_rates, "file_name", self.rates_file):
+            # 10 EUR, 20 USD and 1000 JPY are 30 EUR.
+            transaction, balance = Transactions.authorize(self.student_account, self.issuer_account, "EUR", 15)
+            self.assertIsNotNone(transaction)
+            self.assertEqual(balance, Decimal("15.00"))
+            transaction, balance = Transactions.authorize(self.student_account, self.issuer_account, "USD", "30.01")
+            self.assertIsNone(transaction)
+            results = Transactions.authorize_many(self.issuer_account, [
+                {"debit_account": self.student_account, "currency": "JPY", "amount": 1000},
+                {"debit_account": self.student_account, "currency": "USD", "amount": 10},
+                {"debit_account": self.student_account, "currency": "USD", "amount": 1},
+            ])
+            self.assertEqual([balance for _, balance in results], [Decimal("5.00"), Decimal("0.00"),
+                                                                   Decimal("0.00")])
+            self.assertIsNone(results[2][0])
+            with self.assertRaises(ValidationError):
+                Transactions.authorize(self.student_account, self.issuer_account, "GBP", 1)
+
+    def test_authorization_batch_with_currency_without_rate(self):
+        messages = [{"type": "authorization", "card_id": self.STUDENT, "transaction_id": transaction_id,
+                     "billing_amount": "5.00", "billing_currency": currency}
+                    for transaction_id, currency in (("t1", "EUR"), ("t2", "GBP"), ("t3", "USD"))]
+        with mock.patch.object(fx_rates, "file_name", self.rates_file):
+            response = self.client.post("/api/authorization/batch", json.dumps(messages),
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [
+            {"transaction_id": "t1", "result": "approved", "available_balance": "25.00"},
+            {"transaction_id": "t2", "result": "error"},
+            {"transaction_id": "t3", "result": "approved", "available_balance": "22.50"},
+        ])
+
+    def test_rates_are_reloaded_when_file_changes(self):
+        rates = FxRates(self.rates_file, timeout=0)
+        self.assertEqual(rates.convert(1000, "JPY", "USD"), 2000)
+        with open(self.rates_file, "w") as file:
+            json.dump({"base": "USD", "rates": {"EUR": "0.5"}}, file)
+        os.utime(self.rates_file, ns=(0, 0))
+        self.assertEqual(rates.convert(100, "USD", "EUR"), 50)
+        with self.assertRaises(ValueError):
+            rates.convert(100, "JPY", "EUR")
+        with open(self.rates_file, "w") as file:
+            file.write("{")
+        os.utime(self.rates_file, ns=(1, 1))
+        self.assertEqual(rates.rates(), {"USD": Decimal(1), "EUR": Decimal("0.5")})
+
+class BalanceSnapshotsTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        self.issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        self.student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        self.checkpoint = timezone.datetime(2018, 10, 10, tzinfo=UTC)
+        for days, amount in ((-2, 100), (-1, 20), (1, 3)):
+            self.__create_presentment(amount, self.checkpoint + timezone.timedelta(days=days))
+
+    def __create_presentment(self, amount, created):
+        transaction = Transactions.create_transaction(self.issuer_account, self.student_account,
+                                                      transaction_type="presentment", currency="EUR", amount=amount)
+        Transactions.ledger_entries().filter(pk=transaction.pk).update(created=created)
+
+    def test_ledger_balance_from_snapshot(self):
+        call_command("snapshot_balances", at=self.checkpoint.isoformat(), days=2, stdout=StringIO())
+        self.assertEqual(BalanceSnapshots.objects.get(account=self.student_account, taken_at=self.checkpoint)
+                         .ledger_balance, 12000)
+
+        for days, expected in ((-1.5, "100.00"), (0, "120.00"), (2, "123.00")):
+            time_threshold = self.checkpoint + timezone.timedelta(days=days)
+            with self.assertNumQueries(3):
+                balances = Transactions.get_balances(self.student_account, time_threshold)
+            self.assertEqual(str(balances["ledger_balance"]), expected)
+
+    def test_back_dated_posting_invalidates_snapshots(self):
+        call_command("snapshot_balances", at=self.checkpoint.isoformat(), days=3, stdout=StringIO())
+        transaction = Transactions.create_transaction(self.student_account, self.issuer_account,
+                                                      transaction_type="authorization", currency="EUR", amount=50)
+        Transactions.ledger_entries().filter(pk=transaction.pk).update(created=self.checkpoint - timezone.timedelta(hours=1))
+        transaction.refresh_from_db()
+        self.assertEqual(BalanceSnapshots.objects.filter(account=self.student_account).count(), 3)
+
+        transaction.change_transaction_type("presentment")
+        snapshots = BalanceSnapshots.objects.filter(account=self.student_account).order_by("taken_at")
+        self.assertEqual(list(snapshots.values_list("taken_at", flat=True)),
+                         [self.checkpoint - timezone.timedelta(days=2), self.checkpoint - timezone.timedelta(days=1)])
+        balance = Transactions.get_ledger_balance(self.STUDENT, self.checkpoint)["ledger_balance"]
+        self.assertEqual(balance, "70.00")
+
+class ArchiveLedgerTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        self.issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        self.student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        self.checkpoint = timezone.datetime(2018, 10, 10, tzinfo=UTC)
+        for days, transaction_type, amount in ((-3, "presentment", 100), (-2, "settlement", 30),
+                                               (-2, "authorization", 7), (-1, "presentment", 20),
+                                               (1, "presentment", 3)):
+            transaction = Transactions.create_transaction(self.issuer_account, self.student_account,
+                                                          transaction_type=transaction_type, currency="EUR",
+                                                          amount=amount)
+            Transactions.ledger_entries().filter(pk=transaction.pk)\
+                .update(created=self.checkpoint + timezone.timedelta(days=days))
+        call_command("snapshot_balances", at=(self.checkpoint - timezone.timedelta(days=2.5)).isoformat(),
+                     stdout=StringIO())
+
+    def __balances(self):
+        balances = [Balances.calculate_from_ledger()]
+        for days in (-3.5, -2.5, -1.5, 0, 2):
+            time_threshold = self.checkpoint + timezone.timedelta(days=days)
+            balances.append(Balances.calculate_from_ledger(time_threshold))
+            for name in (self.STUDENT, self.ISSUER):
+                balances.append(Transactions.show_balances(name, time_threshold))
+        return balances
+
+    def __archive(self):
+        call_command("archive_ledger", before=self.checkpoint.isoformat(), chunk_size=1, stdout=StringIO())
+
+    def test_archived_postings_keep_balances(self):
+        expected = self.__balances()
+        self.__archive()
+
+        self.assertEqual(ArchivedPostings.objects.count(), 3)
+        self.assertEqual(sorted(Transactions.ledger_entries().values_list("transaction_type", flat=True)),
+                         ["authorization", "presentment"])
+        self.assertEqual(CarriedBalances.objects.get(account=self.student_account).ledger_balance, 12000)
+        self.assertEqual(self.__balances(), expected)
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "123.00", "available_balance": "130.00"})
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_authorization_presented_after_archival(self):
+        self.__archive()
+        authorization = Transactions.ledger_entries().get(transaction_type="authorization")
+        authorization.change_transaction_type("presentment")
+        expected = self.__balances()
+        self.__archive()
+
+        self.assertEqual(ArchivedPostings.objects.count(), 4)
+        self.assertEqual(self.__balances(), expected)
+        self.assertEqual(Transactions.get_ledger_balance(self.STUDENT, self.checkpoint)["ledger_balance"], "127.00")
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_bulk_inserts_dont_reuse_ids_of_deleted_entries(self):
+        self.__archive()
+        last = Transactions.ledger_entries().latest("pk")
+        Transactions.ledger_entries().filter(pk=last.pk).delete()
+        transaction, = Transactions.bulk_create_transactions([{
+            "debit_account": self.issuer_account, "credit_account": self.student_account,
+            "transaction_type": "presentment", "currency": "EUR", "amount": 5}])
+
+        self.assertGreater(transaction.pk, last.pk)
+        self.assertEqual(Transactions.ledger_entries().get(pk=transaction.pk).transaction_type, "presentment")
+        later = Transactions.create_transaction(self.issuer_account, self.student_account,
+                                                transaction_type="presentment", currency="EUR", amount=1)
+        self.assertEqual(later.pk, transaction.pk + 1)
+
+class HoldExpiryTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        self.issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        self.student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        call_command("load_money", self.STUDENT, "100", "EUR", stdout=StringIO())
+        self.holds = [Transactions.authorize(self.student_account, self.issuer_account, "EUR", 10, "T{0}".format(i))[0]
+                      for i in range(5)]
+
+    def __expire(self, holds):
+        Transactions.ledger_entries().filter(pk__in=[hold.pk for hold in holds])\
+            .update(expires_at=timezone.now() - timezone.timedelta(minutes=1))
+
+    def test_expired_holds_are_released(self):
+        hold = Transactions.ledger_entries().get(pk=self.holds[0].pk)
+        self.assertAlmostEqual(hold.expires_at, timezone.now() + timezone.timedelta(days=7),
+                               delta=timezone.timedelta(minutes=1))
+        self.assertEqual(Transactions.ledger_entries().filter(expires_at__isnull=True).count(), 1)
+        self.__expire(self.holds[:3])
+
+        stdout = StringIO()
+        call_command("expire_holds", batch_size=2, stdout=stdout)
+        self.assertIn("Released 3 expired holds", stdout.getvalue())
+        self.assertEqual(sorted(Transactions.ledger_entries().values_list("transaction_type", flat=True)),
+                         ["authorization"] * 3 + ["expired"] * 3)
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "0.00", "available_balance": "80.00"})
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+        self.assertIsNone(Transactions.expire_holds(timezone.now(), 10))
+
+    def test_presented_holds_are_not_released(self):
+        Transactions.ledger_entries().get(pk=self.holds[0].pk).change_transaction_type("presentment")
+        self.__expire(self.holds[:2])
+
+        # the first hold was presented after the sweeper had found it.
+        self.assertEqual(len(Transactions._release_holds([hold.pk for hold in self.holds[:2]])), 1)
+        self.assertEqual(Transactions.ledger_entries().get(pk=self.holds[0].pk).transaction_type, "presentment")
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "-10.00", "available_balance": "60.00"})
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+class AuditLedgerTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        self.issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        self.student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        for transaction_type, currency, amount in (("presentment", "EUR", 100), ("authorization", "EUR", "12.34"),
+                                                   ("settlement", "USD", 5), ("presentment", "JPY", 700)):
+            Transactions.create_transaction(self.issuer_account, self.student_account, transaction_type, currency,
+                                            amount)
+
+    def __audit(self, **options):
+        stdout = StringIO()
+        call_command("audit_ledger", stdout=stdout, **dict({"workers": 1, "shard_size": 2}, **options))
+        return stdout.getvalue()
+
+    def test_consistent_ledger(self):
+        self.assertIn("Audited 4 ledger rows", self.__audit())
+
+    def test_broken_ledger(self):
+        if compact_ledger():
+            self.skipTest("The compact ledger doesn't have transfers.")
+        transaction = Transactions.objects.order_by("id").first()
+        Transfers.objects.filter(pk=transaction.transfer_to_id).update(amount=9000)
+        Transfers.objects.create(transfer_type="debit", currency="EUR", amount=1, account=self.student_account)
+        stdout = StringIO()
+        with self.assertRaises(CommandError):
+            call_command("audit_ledger", workers=1, stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn("1 transfers without a transaction", output)
+        self.assertIn("1 transactions with missing or mismatching transfers: {}".format(transaction.pk), output)
+        self.assertIn("Transfers in EUR sum to -10.00 instead of zero.", output)
+        self.assertIn("student EUR: stored ledger 100.00 available 112.34, ledger has 90.00 available 102.34.",
+                      output)
+
+class AuditLedgerWorkersTests(TransactionTestCase):
+
+    @skipIf(connection.creation.is_in_memory_db(connection.settings_dict["TEST"]["NAME"] or ":memory:"),
+            "Worker processes can't share an in-memory database.")
+    def test_audit_with_workers(self):
+        issuer_account = Accounts.objects.create(cardholder="issuer", main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder="student", main_currency="EUR")
+        Transactions.bulk_create_transactions([
+            {"debit_account": issuer_account, "credit_account": student_account, "transaction_type": "presentment",
+             "currency": "EUR", "amount": amount} for amount in range(1, 101)])
+        stdout = StringIO()
+        call_command("audit_ledger", workers=4, shard_size=10, stdout=stdout)
+        self.assertIn("Audited 100 ledger rows in 30 shards with 4 workers", stdout.getvalue())
+
 class AuthorizationWebhookTests(TestCase):
 
     STUDENT = "student"
@@ -253,6 +770,127 @@ class AuthorizationWebhookTests(TestCase):
         response = self.client.post("/api/authorization")
         self.assertEqual(response.status_code, 400)
 
+    def test_authorization_in_currency_with_other_exponent_is_compared_in_major_units(self):
+        # 2000 JPY are more than 1081.52 EUR without exchange rates, although 2000 yen are less than 108152 cents.
+        response = self.client.post("/api/authorization", dict(self.AUTH_DATA_OK, billing_amount="2000",
+                                                               billing_currency="JPY"))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post("/api/authorization/batch", json.dumps([dict(
+            self.AUTH_DATA_OK, transaction_id="1235ZORRO", billing_amount="2000", billing_currency="JPY")]),
+                                    content_type="application/json")
+        self.assertEqual(response.json()[0]["result"], "declined")
+        response = self.client.post("/api/authorization", dict(self.AUTH_DATA_OK, transaction_id="1236ZORRO",
+                                                               billing_amount="1000", billing_currency="JPY"))
+        self.assertEqual((response.status_code, response.content.decode()), (200, "balance after transaction: 81.52"))
+
+class AuthorizationBatchWebhookTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Transactions.create_transaction(issuer_account, student_account, transaction_type="presentment",
+                                        currency="EUR", amount=1081.52)
+
+    def __message(self, transaction_id, billing_amount, card_id=STUDENT):
+        return {"type": "authorization", "card_id": card_id, "transaction_id": transaction_id,
+                "billing_amount": billing_amount, "billing_currency": "EUR"}
+
+    def test_authorization_batch_webhook_successful(self):
+        messages = [self.__message("t1", "1000.00"), self.__message("t2", "90.00"), self.__message("t3", "unknown"),
+                    self.__message("t4", "50.00", card_id="unknown"), self.__message("t5", "50.00")]
+        response = self.client.post("/api/authorization/batch", json.dumps(messages),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [
+            {"transaction_id": "t1", "result": "approved", "available_balance": "81.52"},
+            {"transaction_id": "t2", "result": "declined", "available_balance": "81.52"},
+            {"transaction_id": "t3", "result": "error"},
+            {"transaction_id": "t4", "result": "error"},
+            {"transaction_id": "t5", "result": "approved", "available_balance": "31.52"},
+        ])
+        self.assertEqual(set(Transactions.ledger_entries().filter(transaction_type="authorization")
+                             .values_list("transaction_id", flat=True)), {"t1", "t5"})
+        self.assertEqual(Transactions.get_available_balance(self.STUDENT)["available_balance"], "31.52")
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_retried_authorization_batch_is_replayed(self):
+        messages = [self.__message("t1", "1000.00"), self.__message("t2", "90.00"), self.__message("t3", "50.00")]
+        first = self.client.post("/api/authorization/batch", json.dumps(messages), content_type="application/json")
+        response_cache.clear()
+        retried = self.client.post("/api/authorization/batch", json.dumps(messages), content_type="application/json")
+
+        self.assertEqual(retried.status_code, 200)
+        self.assertEqual(retried.json(), [
+            {"transaction_id": "t1", "result": "approved", "available_balance": "81.52"},
+            {"transaction_id": "t2", "result": "declined"},
+            {"transaction_id": "t3", "result": "approved", "available_balance": "31.52"},
+        ])
+        self.assertEqual([result["result"] for result in first.json()], ["approved", "declined", "approved"])
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="authorization").count(), 2)
+        self.assertEqual(Transactions.get_available_balance(self.STUDENT)["available_balance"], "31.52")
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_authorization_batch_replays_single_messages_and_repeated_ids(self):
+        single = self.client.post("/api/authorization", self.__message("t1", "1000.00"))
+        messages = [self.__message("t1", "1000.00"), self.__message("t2", "50.00"), self.__message("t2", "50.00")]
+        response = self.client.post("/api/authorization/batch", json.dumps(messages),
+                                    content_type="application/json")
+
+        self.assertEqual(single.status_code, 200)
+        self.assertEqual(response.json(), [
+            {"transaction_id": "t1", "result": "approved", "available_balance": "81.52"},
+            {"transaction_id": "t2", "result": "approved", "available_balance": "31.52"},
+            {"transaction_id": "t2", "result": "approved", "available_balance": "31.52"},
+        ])
+        self.assertEqual(Transactions.get_available_balance(self.STUDENT)["available_balance"], "31.52")
+        retried = self.client.post("/api/authorization", self.__message("t2", "50.00"))
+        self.assertEqual((retried.status_code, retried.content.decode()), (200, "balance after transaction: 31.52"))
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="authorization").count(), 2)
+
+    def test_authorization_batch_webhook_invalid_request(self):
+        response = self.client.post("/api/authorization/batch", json.dumps({"card_id": self.STUDENT}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+def post_authorization(data):
+    """
+    Posts an authorization message in a worker process of AuthorizationConcurrencyTests.
+    """
+    return Client().post("/api/authorization", data).status_code
+
+class AuthorizationConcurrencyTests(TransactionTestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+    WORKERS = 8
+    AUTHORIZATIONS = 40
+
+    def setUp(self):
+        issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Transactions.create_transaction(issuer_account, student_account, transaction_type="presentment",
+                                        currency="EUR", amount=100)
+        # accounts and responses cached outside of test transactions would outlive the test database flush.
+        self.addCleanup(account_cache.clear)
+        self.addCleanup(response_cache.clear)
+
+    @skipIf(connection.creation.is_in_memory_db(connection.settings_dict["TEST"]["NAME"] or ":memory:"),
+            "Worker processes can't share an in-memory database.")
+    def test_parallel_authorizations_do_not_overdraw(self):
+        messages = [{"card_id": self.STUDENT, "transaction_id": "t{}".format(i), "billing_amount": "10.00",
+                     "billing_currency": "EUR"} for i in range(self.AUTHORIZATIONS)]
+        # worker processes open their own connections.
+        connections.close_all()
+        with multiprocessing.get_context("fork").Pool(self.WORKERS) as pool:
+            statuses = pool.map(post_authorization, messages, chunksize=1)
+
+        self.assertEqual(statuses.count(200), 10)
+        self.assertEqual(statuses.count(403), self.AUTHORIZATIONS - 10)
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="authorization").count(), 10)
+        self.assertEqual(Transactions.get_available_balance(self.STUDENT)["available_balance"], "0.00")
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
 class PresentmentWebhookTests(TestCase):
     STUDENT = "student"
     ISSUER = "issuer"
@@ -308,7 +946,669 @@ class PresentmentWebhookTests(TestCase):
     def test_presentment_webhook_successful(self):
         response = self.client.post("/api/presentment", self.PRESENT_DATA_OK)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "1081.52", "available_balance": "1081.52"})
 
     def test_presentment_webhook_invalid_transaction_id(self):
         response = self.client.post("/api/presentment", self.PRESENT_DATA_NOK)
         self.assertEqual(response.status_code, 400)
+
+class OpenAuthorizationsTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+    SCHEME_NAME = "scheme"
+
+    PRESENT_DATA = {"transaction_id": "1234ZORRO", "settlement_amount": "9.50", "settlement_currency": "EUR"}
+
+    def setUp(self):
+        issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Accounts.objects.create(cardholder=self.SCHEME_NAME, main_currency="EUR")
+        Transactions.create_transaction(issuer_account, student_account, transaction_type="presentment",
+                                        currency="EUR", amount=100)
+        # the scheme repeats the transaction_id of the first authorization.
+        for amount in (30, 10):
+            Transactions.authorize(student_account, issuer_account, "EUR", amount, "1234ZORRO")
+
+    def __present(self, **fields):
+        return self.client.post("/api/presentment", dict(self.PRESENT_DATA, **fields)).status_code
+
+    def __remaining(self):
+        return list(OpenAuthorizations.objects.order_by("entry_id").values_list("remaining_amount", flat=True))
+
+    def test_split_presentments(self):
+        self.assertEqual(self.__remaining(), [3000, 1000])
+        self.assertEqual(self.__present(clearing_amount="12.00", final_clearing="false", presentment_id="P1"), 200)
+        self.assertEqual(self.__remaining(), [1800, 1000])
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "88.00", "available_balance": "60.00"})
+
+        # the retried presentment is replayed, and the last part releases the rest of the authorization.
+        self.assertEqual(self.__present(clearing_amount="12.00", final_clearing="false", presentment_id="P1"), 200)
+        self.assertEqual(self.__present(clearing_amount="8.00", presentment_id="P2"), 200)
+        self.assertEqual(self.__remaining(), [1000])
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "80.00", "available_balance": "70.00"})
+
+        # the next presentment clears the authorization with the repeated id in full.
+        self.assertEqual(self.__present(presentment_id="P3"), 200)
+        self.assertEqual(self.__remaining(), [])
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "70.00", "available_balance": "70.00"})
+        self.assertEqual(sorted(Transactions.ledger_entries().values_list("transaction_type", flat=True)),
+                         ["expired", "presentment", "presentment", "presentment", "presentment", "settlement",
+                          "settlement", "settlement"])
+        self.assertEqual(self.__present(presentment_id="P4"), 400)
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+        call_command("audit_ledger", workers=1, stdout=StringIO())
+
+    def test_presentment_cannot_clear_more_than_remaining_amount(self):
+        self.assertEqual(self.__present(clearing_amount="30.01", presentment_id="P1"), 400)
+        self.assertEqual(self.__present(clearing_amount="0.001", presentment_id="P1"), 400)
+        self.assertEqual(self.__remaining(), [3000, 1000])
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "100.00", "available_balance": "60.00"})
+
+    def test_partial_clearings_need_presentment_id(self):
+        self.assertEqual(self.__present(clearing_amount="12.00", final_clearing="false"), 400)
+        self.assertEqual(self.__present(final_clearing="false"), 400)
+        self.assertEqual(self.__present(clearing_amount="5.00"), 400)
+        self.assertEqual(self.__remaining(), [3000, 1000])
+
+        # two partial clearings of the same authorization are both applied.
+        self.assertEqual(self.__present(clearing_amount="12.00", final_clearing="false", presentment_id="P1"), 200)
+        self.assertEqual(self.__present(clearing_amount="10.00", final_clearing="false", presentment_id="P2"), 200)
+        self.assertEqual(self.__remaining(), [800, 1000])
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "78.00", "available_balance": "60.00"})
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_presentment_id_equal_to_transaction_id_of_other_presentment_is_not_replayed(self):
+        self.assertEqual(self.__present(), 200)
+        self.assertEqual(self.__remaining(), [1000])
+        self.assertEqual(self.__present(clearing_amount="5.00", final_clearing="false", presentment_id="1234ZORRO"),
+                         200)
+        self.assertEqual(self.__remaining(), [500])
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="settlement").count(), 2)
+        # retries of both are still replayed.
+        self.assertEqual(self.__present(), 200)
+        self.assertEqual(self.__present(clearing_amount="5.00", final_clearing="false", presentment_id="1234ZORRO"),
+                         200)
+        self.assertEqual(self.__remaining(), [500])
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="settlement").count(), 2)
+
+    def test_present_many_in_one_batch(self):
+        presented = Transactions.present_many([
+            {"transaction_id": "1234ZORRO", "currency": "EUR", "amount": "1.00", "clearing_amount": "10.00",
+             "final": False},
+            {"transaction_id": "1234ZORRO", "currency": "EUR", "amount": "2.00"},
+            {"transaction_id": "UNKNOWN", "currency": "EUR", "amount": "3.00"},
+        ])
+        self.assertEqual([transaction is not None for transaction in presented], [True, True, False])
+        self.assertEqual(self.__remaining(), [1000])
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "70.00", "available_balance": "60.00"})
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_closed_authorizations_leave_the_book(self):
+        first, second = Transactions.ledger_entries().filter(transaction_type="authorization").order_by("id")
+        first.change_transaction_type("presentment")
+        self.assertEqual(self.__remaining(), [1000])
+        Transactions.ledger_entries().filter(pk=second.pk).update(expires_at=timezone.now())
+        call_command("expire_holds", stdout=StringIO())
+        self.assertEqual(self.__remaining(), [])
+
+
+class AsgiWebhookTests(TransactionTestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+    SCHEME_NAME = "scheme"
+
+    def setUp(self):
+        issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Accounts.objects.create(cardholder=self.SCHEME_NAME, main_currency="EUR")
+        Transactions.create_transaction(issuer_account, student_account, transaction_type="presentment",
+                                        currency="EUR", amount=100)
+        self.addCleanup(account_cache.clear)
+        self.addCleanup(response_cache.clear)
+
+    @staticmethod
+    async def request(path, data, method="POST"):
+        """
+        Sends a form encoded request to the ASGI application.
+        :return: Tuple of response status and body.
+        """
+        scope = {"type": "http", "method": method, "path": path, "query_string": b"", "headers": []}
+        response = {}
+
+        async def receive():
+            return {"type": "http.request", "body": urlencode(data).encode(), "more_body": False}
+
+        async def send(message):
+            response.update(message)
+
+        await asgi.application(scope, receive, send)
+        return response["status"], response["body"]
+
+    def test_authorization_and_presentment(self):
+        status, body = asyncio.run(self.request("/api/authorization", {
+            "card_id": self.STUDENT, "transaction_id": "1234ZORRO", "billing_amount": "90.00",
+            "billing_currency": "EUR"}))
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"balance after transaction: 10.00")
+        status, body = asyncio.run(self.request("/api/authorization", {
+            "card_id": self.STUDENT, "transaction_id": "1234ZORRO2", "billing_amount": "90.00",
+            "billing_currency": "EUR"}))
+        self.assertEqual(status, 403)
+
+        status, body = asyncio.run(self.request("/api/presentment", {
+            "transaction_id": "1234ZORRO", "settlement_amount": "89.50", "settlement_currency": "EUR"}))
+        self.assertEqual(status, 200)
+        self.assertEqual(Transactions.get_ledger_balance(self.STUDENT)["ledger_balance"], "10.00")
+
+    @skipIf(connection.creation.is_in_memory_db(connection.settings_dict["TEST"]["NAME"] or ":memory:"),
+            "Threads of the ASGI application need a database file to wait for each other's write locks.")
+    def test_concurrent_presentments(self):
+        for i in range(10):
+            Transactions.authorize(Accounts.get_account(self.STUDENT), Accounts.get_account(self.ISSUER), "EUR",
+                                   Decimal(5), transaction_id="t{}".format(i))
+
+        async def present_all():
+            return await asyncio.gather(*(self.request("/api/presentment", {
+                "transaction_id": "t{}".format(i), "settlement_amount": "4.50", "settlement_currency": "EUR"})
+                for i in range(10)))
+        statuses = [status for status, body in asyncio.run(present_all())]
+
+        self.assertEqual(statuses, [200] * 10)
+        self.assertEqual(Transactions.get_ledger_balance(self.STUDENT)["ledger_balance"], "50.00")
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_unknown_requests(self):
+        self.assertEqual(asyncio.run(self.request("/api/unknown", {}))[0], 404)
+        self.assertEqual(asyncio.run(self.request("/api/authorization", {}, method="GET"))[0], 405)
+        self.assertEqual(asyncio.run(self.request("/api/presentment", {"transaction_id": "unknown"}))[0], 400)
+
+class WebhookIdempotencyTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+    SCHEME_NAME = "scheme"
+
+    AUTH_DATA = {"card_id": STUDENT, "transaction_id": "1234ZORRO", "billing_amount": "90.00",
+                 "billing_currency": "EUR"}
+    PRESENT_DATA = {"transaction_id": "1234ZORRO", "settlement_amount": "89.50", "settlement_currency": "EUR"}
+
+    def setUp(self):
+        issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Accounts.objects.create(cardholder=self.SCHEME_NAME, main_currency="EUR")
+        Transactions.create_transaction(issuer_account, student_account, transaction_type="presentment",
+                                        currency="EUR", amount=100)
+
+    def test_retried_authorization_is_replayed(self):
+        first = self.client.post("/api/authorization", self.AUTH_DATA)
+        # the stored response is returned without touching the ledger.
+        with self.assertNumQueries(1):
+            retry = self.client.post("/api/authorization", self.AUTH_DATA)
+        self.assertEqual((retry.status_code, retry.content), (200, b"balance after transaction: 10.00"))
+        self.assertEqual((first.status_code, first.content), (retry.status_code, retry.content))
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="authorization").count(), 1)
+        self.assertEqual(Transactions.get_available_balance(self.STUDENT)["available_balance"], "10.00")
+
+    def test_retried_presentment_is_replayed(self):
+        self.client.post("/api/authorization", self.AUTH_DATA)
+        for _ in range(2):
+            response = self.client.post("/api/presentment", self.PRESENT_DATA)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="settlement").count(), 1)
+        self.assertEqual(Transactions.get_ledger_balance(self.STUDENT)["ledger_balance"], "10.00")
+
+    def test_errors_are_not_stored(self):
+        response = self.client.post("/api/authorization", dict(self.AUTH_DATA, billing_amount="invalid"))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/api/authorization", self.AUTH_DATA)
+        self.assertEqual(response.status_code, 200)
+
+    def test_expired_response_is_replaced(self):
+        WebhookResponses.objects.create(message_type="authorization", transaction_id="1234ZORRO", status=403,
+                                        content="The payment is declined.",
+                                        expires_at=timezone.now() - timezone.timedelta(seconds=1))
+        response = self.client.post("/api/authorization", self.AUTH_DATA)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(WebhookResponses.objects.get(transaction_id="1234ZORRO").status, 200)
+        self.assertEqual(WebhookResponses.purge(), 0)
+
+    def test_response_cache(self):
+        cache = ResponseCache(size=2, timeout=60)
+        cache.set(("authorization", "a"), (200, "a"))
+        cache.set(("authorization", "b"), (200, "b"), timeout=0)
+        cache.set(("authorization", "c"), (403, "c"))
+        cache.set(("authorization", "d"), (200, "d"))
+        self.assertIsNone(cache.get(("authorization", "a")))
+        self.assertIsNone(cache.get(("authorization", "b")))
+        self.assertEqual(cache.get(("authorization", "c")), (403, "c"))
+
+class IngestClearingTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+    SCHEME_NAME = "scheme"
+
+    def setUp(self):
+        issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Accounts.objects.create(cardholder=self.SCHEME_NAME, main_currency="EUR")
+        Transactions.create_transaction(issuer_account, student_account, transaction_type="presentment",
+                                        currency="EUR", amount=1000)
+        for transaction_id in ("a1", "a2", "a3"):
+            Transactions.create_transaction(student_account, issuer_account, transaction_type="authorization",
+                                            currency="EUR", amount=100, transaction_id=transaction_id)
+        file = tempfile.NamedTemporaryFile("w", suffix=".ndjson", delete=False)
+        file.close()
+        self.file_name = file.name
+        self.addCleanup(os.remove, self.file_name)
+
+    def __append(self, *lines):
+        with open(self.file_name, "a") as file:
+            file.writelines(line + "\n" for line in lines)
+
+    def __record(self, transaction_id):
+        return json.dumps({"type": "presentment", "transaction_id": transaction_id,
+                           "settlement_amount": "90.50", "settlement_currency": "EUR"})
+
+    def test_ingest_clearing_successful(self):
+        self.__append(self.__record("a1"), self.__record("unknown"), "not json", self.__record("a2"))
+        call_command("ingest_clearing", self.file_name, chunk_size=2, stdout=StringIO(), stderr=StringIO())
+
+        presented = Transactions.ledger_entries().filter(transaction_type="presentment").exclude(transaction_id="")
+        self.assertEqual(set(presented.values_list("transaction_id", flat=True)), {"a1", "a2"})
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="settlement").count(), 2)
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "800.00", "available_balance": "700.00"})
+        self.assertEqual(Transactions.show_balances(self.SCHEME_NAME),
+                         {"ledger_balance": "0.00", "available_balance": "0.00"})
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_ingest_clearing_continues_from_offset(self):
+        self.__append(self.__record("a1"))
+        call_command("ingest_clearing", self.file_name, stdout=StringIO())
+        self.__append(self.__record("a1"), self.__record("a3"))
+        call_command("ingest_clearing", self.file_name, stdout=StringIO())
+
+        self.assertEqual(Transactions.ledger_entries().filter(transaction_type="settlement").count(), 2)
+        self.assertEqual(Transactions.ledger_entries().get(transaction_id="a3").transaction_type, "presentment")
+        self.assertEqual(ClearingFiles.objects.get(file_name=os.path.abspath(self.file_name)).records, 3)
+
+
+class LoadMoneyFileTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file_name = os.path.join(directory.name, "loads.csv")
+        with open(self.file_name, "w") as file:
+            file.write("cardholder,amount,currency\n{0},10.50,EUR\nnew1,20,EUR\nnew2,1.234,EUR\n"
+                       "new2,5,EUR\nnew3,-1,EUR\n,1,EUR\n".format(self.STUDENT))
+
+    def test_load_money_from_file(self):
+        call_command("load_money", file=self.file_name, chunk_size=2, stdout=StringIO())
+
+        self.assertEqual(Transactions.show_balances(self.STUDENT),
+                         {"ledger_balance": "0.00", "available_balance": "10.50"})
+        self.assertEqual(Transactions.show_balances("new1")["available_balance"], "20.00")
+        self.assertEqual(Transactions.show_balances("new2")["available_balance"], "5.00")
+        self.assertFalse(Accounts.objects.filter(cardholder="new3").exists())
+        self.assertEqual(Transactions.ledger_entries().count(), 3)
+        with open(os.path.join(os.path.dirname(self.file_name), "loads.rejects.ndjson")) as file:
+            rejects = [json.loads(line) for line in file]
+        self.assertEqual([reject["record"]["cardholder"] for reject in rejects], ["new2", "new3", ""])
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_refused_chunk_is_loaded_record_by_record(self):
+        bulk_create_transactions = Transactions.bulk_create_transactions
+
+        def refuse_new2(postings):
+            if any(posting["credit_account"].pk == "new2" for posting in postings):
+                raise IntegrityError("UNIQUE constraint failed")
+            return bulk_create_transactions(postings)
+        with mock.patch.object(Transactions, "bulk_create_transactions", side_effect=refuse_new2):
+            call_command("load_money", file=self.file_name, chunk_size=4, stdout=StringIO())
+
+        self.assertEqual(Transactions.show_balances(self.STUDENT)["available_balance"], "10.50")
+        self.assertEqual(Transactions.show_balances("new1")["available_balance"], "20.00")
+        # the account of the refused record is rolled back with it.
+        self.assertFalse(Accounts.objects.filter(cardholder="new2").exists())
+        self.assertEqual(Transactions.ledger_entries().count(), 2)
+        with open(os.path.join(os.path.dirname(self.file_name), "loads.rejects.ndjson")) as file:
+            rejects = [json.loads(line) for line in file]
+        self.assertEqual([(reject["record"]["cardholder"], reject["record"]["amount"]) for reject in rejects],
+                         [("new2", "1.234"), ("new2", "5"), ("new3", "-1"), ("", "1")])
+        self.assertEqual(rejects[1]["error"], "UNIQUE constraint failed")
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_load_money_needs_one_source(self):
+        with self.assertRaises(CommandError):
+            call_command("load_money", self.STUDENT, "1", "EUR", file=self.file_name, stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command("load_money", stdout=StringIO())
+
+class AccountTransactionsViewTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        created = timezone.datetime(2018, 10, 10, tzinfo=UTC)
+        for amount in (1, 2, 3, 4, 5):
+            transaction = Transactions.create_transaction(issuer_account, student_account,
+                                                          transaction_type="presentment", currency="EUR",
+                                                          amount=amount)
+            Transactions.ledger_entries().filter(pk=transaction.pk).update(created=created)
+        transaction = Transactions.create_transaction(student_account, issuer_account, transaction_type="presentment",
+                                                      currency="EUR", amount=6)
+        Transactions.create_transaction(student_account, issuer_account, transaction_type="authorization",
+                                        currency="EUR", amount=7)
+        self.url = "/api/accounts/{}/transactions".format(self.STUDENT)
+
+    def test_transactions_are_paginated_with_cursor(self):
+        amounts = []
+        cursor = ""
+        while cursor is not None:
+            with self.assertNumQueries(2):
+                response = self.client.get(self.url, {"limit": 2, "cursor": cursor})
+            self.assertEqual(response.status_code, 200)
+            amounts += [transaction["amount"] for transaction in response.json()["transactions"]]
+            cursor = response.json()["next_cursor"]
+        self.assertEqual(amounts, ["1.00", "2.00", "3.00", "4.00", "5.00", "-6.00"])
+
+    def test_transactions_are_streamed(self):
+        response = self.client.get(self.url, {"format": "ndjson"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)["amount"] for line in lines], ["1.00", "2.00", "3.00", "4.00", "5.00",
+                                                                          "-6.00"])
+
+        response = self.client.get(self.url, {"format": "csv", "end": "2018-10-11T00:00:00+00:00"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "id,transaction_id,transaction_type,created,currency,amount,debit_account,"
+                                   "credit_account")
+        self.assertEqual(len(lines), 6)
+
+    def test_transactions_invalid_parameters(self):
+        self.assertEqual(self.client.get("/api/accounts/unknown/transactions").status_code, 404)
+        self.assertEqual(self.client.get(self.url, {"cursor": "invalid"}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {"start": "invalid"}).status_code, 400)
+
+
+@override_settings(ISSUER_SQLITE=settings.ISSUER_SQLITE_PRODUCTION)
+class SqliteProfileTests(TransactionTestCase):
+
+    def test_pragmas_are_set_on_new_connections(self):
+        connection.close()
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(cursor.fetchone()[0], "wal")
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+
+    def test_writes_are_run_in_writer_thread(self):
+        current_thread = lambda: threading.current_thread().name
+        self.assertEqual(writer.run(current_thread), "issuer-writer")
+        # writes of an atomic block have to use its connection.
+        with atomic():
+            self.assertEqual(writer.run(current_thread), threading.current_thread().name)
+        with override_settings(ISSUER_SQLITE={"SERIALIZE_WRITES": False}):
+            self.assertEqual(writer.run(current_thread), threading.current_thread().name)
+        with self.assertRaises(ValidationError):
+            writer.run(Transactions.clean_posting, "authorization", "EUR", "0.001")
+
+    def create_concurrently(self, accounts):
+        """
+        Creates a settlement from the issuer to each account from its own thread.
+        :return: List of created transactions, or exceptions of failed ones.
+        """
+        issuer_account = Accounts.objects.create(cardholder="issuer", main_currency="EUR")
+        results = [None] * len(accounts)
+
+        def create(index):
+            try:
+                results[index] = Transactions.create_transaction(issuer_account, accounts[index], "settlement",
+                                                                 "EUR", "1.00")
+            except Exception as error:
+                results[index] = error
+        threads = [threading.Thread(target=create, args=(index,)) for index in range(len(accounts))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @override_settings(ISSUER_SQLITE={"SERIALIZE_WRITES": True,
+                                      "GROUP_COMMIT": {"ENABLED": True, "WINDOW": 0.5, "SIZE": 4}})
+    def test_concurrent_writes_are_committed_in_groups(self):
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+        accounts = [Accounts.objects.create(cardholder="card{}".format(i)) for i in range(8)]
+        results = self.create_concurrently(accounts)
+        self.assertTrue(all(isinstance(result, Transactions) for result in results))
+        self.assertEqual(Transactions.objects.filter(transaction_type="settlement").count(), 8)
+        lines = metrics.render().splitlines()
+        self.assertIn("issuer_writer_batch_size_sum 8", lines)
+        self.assertIn('issuer_writer_batch_size_bucket{le="2"} 0', lines)
+        self.assertIn("issuer_writer_added_latency_seconds_count 8", lines)
+
+    @override_settings(ISSUER_SQLITE={"SERIALIZE_WRITES": True,
+                                      "GROUP_COMMIT": {"ENABLED": True, "WINDOW": 0.5, "SIZE": 3}})
+    def test_failed_group_is_committed_one_by_one(self):
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+        # the missing account fails the foreign key check at commit.
+        accounts = [Accounts.objects.create(cardholder="card1"), Accounts(cardholder="missing"),
+                    Accounts.objects.create(cardholder="card2")]
+        results = self.create_concurrently(accounts)
+        self.assertIsInstance(results[0], Transactions)
+        self.assertIsInstance(results[1], IntegrityError)
+        self.assertIsInstance(results[2], Transactions)
+        self.assertEqual(Transactions.objects.count(), 2)
+        self.assertIn("issuer_writer_group_failures_total 1", metrics.render().splitlines())
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+
+    def test_profile_is_opt_in(self):
+        current_thread = lambda: threading.current_thread().name
+        with override_settings(ISSUER_SQLITE={}):
+            self.assertEqual(writer.run(current_thread), threading.current_thread().name)
+
+    def test_writer_keeps_running_after_failure_outside_functions(self):
+        current_thread = lambda: threading.current_thread().name
+        with mock.patch.object(metrics, "observe", side_effect=RuntimeError("metrics failed")):
+            with self.assertRaises(RuntimeError):
+                writer.run(current_thread)
+        self.assertEqual(writer.run(current_thread), "issuer-writer")
+
+    @override_settings(ISSUER_SQLITE=dict(settings.ISSUER_SQLITE_PRODUCTION, TIMEOUT=0.2))
+    def test_callers_stop_waiting_after_timeout(self):
+        started = []
+        with self.assertRaises(OperationalError):
+            writer.run(lambda: started.append("slow") or time.sleep(1))
+        # the writer is still running the slow function, so this one is cancelled before it starts.
+        with self.assertRaises(OperationalError):
+            writer.run(lambda: started.append("queued"))
+        time.sleep(1)
+        self.assertEqual(writer.run(lambda: started.append("next") or len(started)), 2)
+        self.assertEqual(started, ["slow", "next"])
+
+    @override_settings(ISSUER_SQLITE=dict(settings.ISSUER_SQLITE_PRODUCTION,
+                                          GROUP_COMMIT={"ENABLED": True, "WINDOW": 0.5, "SIZE": 2}))
+    def test_failed_group_counts_results_once(self):
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+        issuer_account = Accounts.objects.create(cardholder="issuer", main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder="student", main_currency="EUR")
+        Transactions.create_transaction(issuer_account, student_account, "presentment", "EUR", "100.00")
+        responses = []
+        message = {"card_id": "student", "transaction_id": "T1", "billing_amount": "10.00",
+                   "billing_currency": "EUR"}
+        # the missing account fails the foreign key check at the commit of the group, so the authorization is run
+        # again.
+        def settle_to_missing_account():
+            with self.assertRaises(IntegrityError):
+                Transactions.create_transaction(issuer_account, Accounts(cardholder="missing"), "settlement", "EUR",
+                                                "1.00")
+        threads = [threading.Thread(target=lambda: responses.append(webhooks.authorize_message(message))),
+                   threading.Thread(target=settle_to_missing_account)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(responses[0].status_code, 200)
+        lines = metrics.render().splitlines()
+        self.assertIn("issuer_writer_group_failures_total 1", lines)
+        self.assertIn('issuer_authorizations_total{result="approved"} 1', lines)
+        self.assertEqual(Transactions.objects.filter(transaction_type="authorization").count(), 1)
+
+    def test_execute_wrappers_see_queries_of_writer(self):
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, params, many, context:
+                                        queries.append(sql) or execute(sql, params, many, context)):
+            writer.run(lambda: Accounts.objects.count())
+        self.assertEqual(len(queries), 1)
+
+class MetricsTests(TestCase):
+    STUDENT = "student"
+    ISSUER = "issuer"
+
+    def setUp(self):
+        issuer_account = Accounts.objects.create(cardholder=self.ISSUER, main_currency="EUR")
+        student_account = Accounts.objects.create(cardholder=self.STUDENT, main_currency="EUR")
+        Transactions.create_transaction(issuer_account, student_account, transaction_type="presentment",
+                                        currency="EUR", amount=100)
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+
+    def test_histogram_buckets(self):
+        registry = Metrics()
+        registry.histogram("latency", "Latency.", buckets=(1, 2))
+        for value in (0.5, 1.5, 1.5, 3):
+            registry.observe("latency", value, endpoint="test")
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP latency Latency.",
+            "# TYPE latency histogram",
+            'latency_bucket{endpoint="test",le="1"} 1',
+            'latency_bucket{endpoint="test",le="2"} 3',
+            'latency_bucket{endpoint="test",le="+Inf"} 4',
+            'latency_sum{endpoint="test"} 6.5',
+            'latency_count{endpoint="test"} 4',
+        ])
+
+    def test_webhook_metrics(self):
+        for transaction_id, amount in (("1234ZORRO", "60.00"), ("1234ZORRO2", "60.00"), ("1234ZORRO3", "invalid")):
+            self.client.post("/api/authorization", {"card_id": self.STUDENT, "transaction_id": transaction_id,
+                                                    "billing_amount": amount, "billing_currency": "EUR"})
+        response = self.client.get("/api/metrics")
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        self.assertIn('issuer_authorizations_total{result="approved"} 1', lines)
+        self.assertIn('issuer_authorizations_total{result="declined"} 1', lines)
+        self.assertIn('issuer_authorizations_total{result="error"} 1', lines)
+        self.assertIn('issuer_request_duration_seconds_count{endpoint="authorization"} 3', lines)
+        self.assertIn('issuer_request_db_queries_count{endpoint="authorization"} 3', lines)
+        # requests to the metrics endpoint itself are not recorded.
+        self.assertNotIn('endpoint="metrics"', response.content.decode())
+
+
+# the compact ledger has to give the same results, so the ledger tests are run with it too.
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactTransactionsTests(TransactionsTests):
+
+    def test_create_transaction_is_successful(self):
+        debit_account = Accounts.objects.get(cardholder=self.ISSUER)
+        credit_account = Accounts.objects.get(cardholder=self.MILLIONAIRE)
+        posting = Transactions.create_transaction(debit_account, credit_account, transaction_type="authorization",
+                                                  currency="EUR", amount=0.01, transaction_id="t_id123")
+        self.assertIs(type(posting), Postings)
+        self.assertIn(posting, Postings.objects.all())
+        self.assertEqual(Transactions.objects.count(), 0)
+        self.assertEqual((posting.debit_account, posting.credit_account), (debit_account, credit_account))
+        self.assertEqual((posting.transaction_type, posting.transaction_id), ("authorization", "t_id123"))
+        # transfers of postings are read compatible with transfers of transactions.
+        self.assertEqual((posting.transfer_from.account_id, posting.transfer_from.amount,
+                          posting.transfer_from.transfer_type), (self.ISSUER, 1, "debit"))
+        self.assertEqual((posting.transfer_to.account_id, posting.transfer_to.currency,
+                          posting.transfer_to.transfer_type), (self.MILLIONAIRE, "EUR", "credit"))
+
+    def test_create_transaction_query_count(self):
+        debit_account = Accounts.objects.get(cardholder=self.MILLIONAIRE)
+        credit_account = Accounts.objects.get(cardholder=self.ISSUER)
+        Transactions.create_transaction(debit_account, credit_account, "authorization", "EUR", 100)
+        # a posting is a single insert.
+        with self.assertNumQueries(5):
+            Transactions.create_transaction(debit_account, credit_account, "authorization", "EUR", 100)
+
+    def test_copy_from_transactions(self):
+        with self.settings(ISSUER_COMPACT_LEDGER=False):
+            self._TransactionsTests__create_test_transactions()
+            expected = [Transactions.show_balances(name, self.test_datetime)
+                        for name in (self.ISSUER, self.STUDENT, self.MILLIONAIRE)]
+        self.assertEqual(Postings.copy_from_transactions(), Transactions.objects.count())
+        self.assertEqual([Transactions.show_balances(name, self.test_datetime)
+                          for name in (self.ISSUER, self.STUDENT, self.MILLIONAIRE)], expected)
+        call_command("rebuild_balances", verify=True, stdout=StringIO())
+        # new postings get ids after the copied ones.
+        posting = self._TransactionsTests__create_test_transaction(self.STUDENT, self.ISSUER)
+        self.assertGreater(posting.pk, Transactions.objects.order_by("pk").last().pk)
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactBalancesTests(BalancesTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactShardedBalancesTests(ShardedBalancesTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactBalanceSnapshotsTests(BalanceSnapshotsTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactArchiveLedgerTests(ArchiveLedgerTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactHoldExpiryTests(HoldExpiryTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactAuditLedgerTests(AuditLedgerTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactAuthorizationBatchWebhookTests(AuthorizationBatchWebhookTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactPresentmentWebhookTests(PresentmentWebhookTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactOpenAuthorizationsTests(OpenAuthorizationsTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactWebhookIdempotencyTests(WebhookIdempotencyTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactIngestClearingTests(IngestClearingTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactLoadMoneyFileTests(LoadMoneyFileTests):
+    pass
+
+@override_settings(ISSUER_COMPACT_LEDGER=True)
+class CompactAccountTransactionsViewTests(AccountTransactionsViewTests):
+    pass
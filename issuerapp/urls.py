@@ -14,9 +14,13 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.urls import path
-from issuerapp.webhooks import authorization, presentment
+from issuerapp.webhooks import authorization, authorization_batch, presentment
+from issuerapp.views import account_transactions, metrics_view
 
 urlpatterns = [
     path('authorization', authorization, name='authorization'),
+    path('authorization/batch', authorization_batch, name='authorization_batch'),
     path('presentment', presentment, name='presentment'),
+    path('accounts/<str:cardholder>/transactions', account_transactions, name='account_transactions'),
+    path('metrics', metrics_view, name='metrics'),
 ]
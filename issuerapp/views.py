@@ -1,3 +1,125 @@
-from django.shortcuts import render
+import base64
+import csv
+import json
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_GET
 
-# Create your views here.
+from .models import Transactions, Accounts
+from .currencies import from_minor_units
+from .metrics import metrics
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FIELDS = ["id", "transaction_id", "transaction_type", "created", "currency", "amount", "debit_account",
+                 "credit_account"]
+
+class Echo:
+    """
+    File-like object which returns written lines instead of buffering them. Used for streaming CSV.
+    """
+    def write(self, value):
+        return value
+
+def encode_cursor(transaction):
+    """
+    Encodes the position of transaction in (created, id) order into a cursor string.
+    """
+    position = "{}|{}".format(transaction.created.isoformat(), transaction.pk)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor string into (created, id) tuple. Raises ValueError if the cursor is not valid.
+    """
+    created, pk = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+    created = parse_datetime(created)
+    if created is None:
+        raise ValueError("Invalid cursor.")
+    return created, int(pk)
+
+def serialize_transaction(transaction, account_name):
+    """
+    Serializes a transaction. Amount is negative if the funds were taken from the account.
+    """
+    amount = transaction.transfer_to.amount
+    if transaction.transfer_from.account_id == account_name:
+        amount = -amount
+    return {
+        "id": transaction.pk,
+        "transaction_id": transaction.transaction_id,
+        "transaction_type": transaction.transaction_type,
+        "created": transaction.created.isoformat(),
+        "currency": transaction.transfer_to.currency,
+        "amount": str(from_minor_units(amount, transaction.transfer_to.currency)),
+        "debit_account": transaction.transfer_from.account_id,
+        "credit_account": transaction.transfer_to.account_id,
+    }
+
+# plain Django view, because DRF reserves the format query parameter for content negotiation.
+@require_GET
+def account_transactions(request, cardholder):
+    """
+    Lists presented transactions of an account in (created, id) order.
+    Query parameters:
+        - start, end: Optional ISO datetimes of the timeframe.
+        - cursor: The next_cursor of the previous page.
+        - limit: Page size, at most 1000.
+        - format: "json" for pages, "ndjson" or "csv" for streaming the whole timeframe.
+    :param request: The request.
+    :param cardholder: The name of the account owner.
+    :return: JsonResponse with "transactions" and "next_cursor" keys, or StreamingHttpResponse.
+    """
+    try:
+        start = request.GET.get("start")
+        end = request.GET.get("end")
+        start = parse_datetime(start) if start else timezone.make_aware(timezone.datetime(1970, 1, 1), timezone.utc)
+        end = parse_datetime(end) if end else timezone.now()
+        transactions = Transactions.get_transactions(cardholder, start, end).order_by("created", "id")
+        export_format = request.GET.get("format", "json")
+
+        if export_format == "ndjson":
+            lines = (json.dumps(serialize_transaction(transaction, cardholder)) + "\n"
+                     for transaction in transactions.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+            return StreamingHttpResponse(lines, content_type="application/x-ndjson")
+        if export_format == "csv":
+            writer = csv.DictWriter(Echo(), fieldnames=EXPORT_FIELDS)
+            rows = (writer.writerow(serialize_transaction(transaction, cardholder))
+                    for transaction in transactions.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+            header = ",".join(EXPORT_FIELDS) + "\r\n"
+            response = StreamingHttpResponse((line for part in ([header], rows) for line in part),
+                                             content_type="text/csv")
+            response["Content-Disposition"] = 'attachment; filename="{}.csv"'.format(cardholder)
+            return response
+        if export_format != "json":
+            raise ValueError("Unknown format.")
+
+        limit = min(int(request.GET.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("Limit must be positive.")
+        if request.GET.get("cursor"):
+            created, pk = decode_cursor(request.GET["cursor"])
+            transactions = transactions.filter(Q(created__gt=created) | Q(created=created, id__gt=pk))
+        # one extra row tells if there is a next page.
+        page = list(transactions[:limit + 1])
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return JsonResponse({
+            "transactions": [serialize_transaction(transaction, cardholder) for transaction in page[:limit]],
+            "next_cursor": next_cursor
+        })
+    except Accounts.DoesNotExist:
+        return HttpResponse('Account not found', status=404) # Not Found
+    except:
+        return HttpResponse('Unknown error', status=400) # Bad Request
+
+@require_GET
+def metrics_view(request):
+    """
+    Exposes the request and webhook metrics of this process in Prometheus text format.
+    :param request: The request.
+    :return: HttpResponse
+    """
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,9 +1,26 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+from django.db import DatabaseError, IntegrityError
+from django.db.transaction import atomic, set_rollback
 from rest_framework.decorators import api_view
 
-from .models import Transactions, Accounts, ISSUER_NAME, SCHEME_NAME
+from .models import Transactions, Accounts, WebhookResponses, ISSUER_NAME
+from .metrics import metrics
+from .sqlite import writer
+from .currencies import to_minor_units
 from decimal import Decimal
 
+# statuses of final outcomes which are replayed to retried messages. Errors are not stored, so they can be retried.
+FINAL_STATUSES = (200, 403)
+# responses of authorizations, which are shared by single and batch messages of the same transaction_id.
+APPROVED_CONTENT = 'balance after transaction: {}'
+DECLINED_CONTENT = 'The payment is declined.'
+# counters and results of processed messages by response status. Other statuses are errors.
+RESULT_METRICS = {
+    "authorization": ("issuer_authorizations_total", {200: "approved", 403: "declined"}),
+    "presentment": ("issuer_presentments_total", {200: "presented"}),
+    "presentment_part": ("issuer_presentments_total", {200: "presented"}),
+}
+
 @api_view(('POST',))
 def authorization(request):
     """
@@ -11,37 +28,292 @@ def authorization(request):
     :param request: WSGIRequest which contains request data.
     :return: HttpResponse
     """
+    return authorize_message(request.POST)
+
+def respond_once(message_type, message, process, key="transaction_id"):
+    """
+    Processes a webhook message once. A retried message gets the stored response of the first one without touching 
+    the ledger. The response is stored in the same database transaction as the changes of the message.
+    :param message_type: authorization, presentment or presentment_part.
+    :param message: Dictionary of the message fields.
+    :param process: Function which processes the message and returns HttpResponse. The writer may run it again, so 
+    it shouldn't have side effects outside the database, and the result of the message is counted here.
+    :param key: The field which identifies the message.
+    :return: HttpResponse
+    """
+    transaction_id = message.get(key)
+    if not transaction_id:
+        return count_result(message_type, process(message))
+    try:
+        replayed = WebhookResponses.replay(message_type, transaction_id)
+        # an expired response of the message is replaced once.
+        for attempt in range(2):
+            if replayed is not None:
+                break
+            try:
+                return count_result(message_type, writer.run(process_once, message_type, message, process, key))
+            except IntegrityError:
+                # a concurrent retry was processed first, or the stored response has expired.
+                replayed = WebhookResponses.replay(message_type, transaction_id)
+                if replayed is None and not WebhookResponses.delete_expired(message_type, transaction_id):
+                    break
+    except DatabaseError:
+        replayed = None
+    if replayed is None:
+        return HttpResponse('Unknown error', status=400) # Bad Request
+    metrics.inc("issuer_webhook_replays_total", message_type=message_type)
+    return HttpResponse(replayed[1], status=replayed[0])
+
+def count_result(message_type, response):
+    """
+    Counts the result of a processed message in the metrics.
+    :param message_type: authorization, presentment or presentment_part.
+    :param response: HttpResponse of the message.
+    :return: Returns the response.
+    """
+    name, results = RESULT_METRICS[message_type]
+    metrics.inc(name, result=results.get(response.status_code, "error"))
+    return response
+
+def process_once(message_type, message, process, key="transaction_id"):
+    """
+    Claims a webhook message and processes it in one database transaction.
+    :param message_type: authorization, presentment or presentment_part.
+    :param message: Dictionary of the message fields.
+    :param process: Function which processes the message and returns HttpResponse.
+    :param key: The field which identifies the message.
+    :return: HttpResponse. Raises IntegrityError if the message already has a response.
+    """
+    with atomic():
+        # the claim is the first write, so a concurrent retry waits until this message is processed.
+        pending = WebhookResponses.claim(message_type, message[key])
+        response = process(message)
+        if response.status_code in FINAL_STATUSES:
+            pending.store(response.status_code, response.content.decode())
+        else:
+            set_rollback(True)
+    return response
+
+def authorize_message(message):
+    """
+    Authorizes a payment once. Shared by the WSGI and ASGI webhooks.
+    :param message: Dictionary of the authorization message fields.
+    :return: HttpResponse
+    """
+    return respond_once("authorization", message, process_authorization)
+
+def process_authorization(message):
+    """
+    Authorizes a payment.
+    :param message: Dictionary of the authorization message fields.
+    :return: HttpResponse
+    """
     try:
-        cardholder = request.POST["card_id"]  # use GET request for demo purposes.
-        balances = Transactions.get_available_balance(cardholder)
-        balance_amount = Decimal(balances["available_balance"])
-        billing_amount = Decimal(request.POST["billing_amount"])
-        currency = request.POST["billing_currency"]
-        if balance_amount >= billing_amount:  # authorization is possible
-            balance_amount_after = balance_amount - billing_amount
-            #reserve amount.
-            cardholder_account = Accounts.get_account(cardholder)
-            issuer_account =  Accounts.get_account(ISSUER_NAME)
-            Transactions.create_transaction(cardholder_account, issuer_account, "authorization", currency,
-                                            billing_amount, transaction_id=request.POST["transaction_id"])
-            return HttpResponse('balance after transaction: {}'.format(balance_amount_after), status=200)  # OK
+        cardholder_account = Accounts.get_account(message["card_id"])  # use GET request for demo purposes.
+        issuer_account = Accounts.get_account(ISSUER_NAME)
+        billing_amount = Decimal(message["billing_amount"])
+        currency = message["billing_currency"]
+        # funds are checked and reserved in one database transaction.
+        transaction, balance_amount_after = Transactions.authorize(cardholder_account, issuer_account, currency,
+                                                                   billing_amount,
+                                                                   transaction_id=message["transaction_id"])
+        if transaction is not None:  # authorization is possible
+            return HttpResponse(APPROVED_CONTENT.format(balance_amount_after), status=200)  # OK
         else:
-            return HttpResponse('The payment is declined.', status=403)  # Forbidden
+            return HttpResponse(DECLINED_CONTENT, status=403)  # Forbidden
     except:
         return HttpResponse('Unknown error', status=400) # Bad Request
 
 @api_view(('POST',))
-def presentment(request):
+def authorization_batch(request):
+    """
+    Handles a batch of authorization messages. Funds of each card are checked in the order of messages and all 
+    approved authorizations are saved in one database transaction. Like single messages, each transaction_id is 
+    authorized once, and messages which were already processed get the stored result.
+    :param request: Request with a JSON array of authorization messages.
+    :return: JsonResponse with a result for each message in the same order.
+    """
     try:
-        transaction = Transactions.objects.get(transaction_id=request.POST["transaction_id"])
-        transaction.transaction_type = "presentment"
-        transaction.save()
-        #create debt to the scheme
+        messages = request.data
+        if not isinstance(messages, list):
+            raise ValueError("Expected a list of authorization messages.")
         issuer_account = Accounts.get_account(ISSUER_NAME)
-        scheme_account = Accounts.get_account(SCHEME_NAME)
-        currency = request.POST["settlement_currency"]
-        amount = request.POST["settlement_amount"]
-        Transactions.create_transaction(issuer_account, scheme_account, "settlement", currency, amount)
+        accounts = Accounts.objects.in_bulk([message.get("card_id") for message in messages])
+    except:
+        return HttpResponse('Unknown error', status=400) # Bad Request
+
+    results = []
+    authorizations = []
+    for message in messages:
+        try:
+            authorization = {
+                "debit_account": accounts[message["card_id"]],
+                "credit_account": issuer_account,
+                "transaction_type": "authorization",
+                "currency": message["billing_currency"],
+                "amount": Decimal(message["billing_amount"]),
+                "transaction_id": message["transaction_id"]
+            }
+            Transactions.validate_posting(authorization)
+            # a currency without exchange rate is an error of this message, not of the whole batch.
+            Transactions.funds_needed(authorization["debit_account"], authorization["currency"],
+                                      to_minor_units(authorization["amount"], authorization["currency"]))
+            authorizations.append(authorization)
+            results.append({"transaction_id": message["transaction_id"]})
+        except:
+            results.append({"transaction_id": message.get("transaction_id"), "result": "error"})
+
+    try:
+        outcomes = iter(writer.run(authorize_batch_once, issuer_account, authorizations))
+    except:
+        return HttpResponse('Unknown error', status=400) # Bad Request
+    for result in results:
+        if "result" not in result:
+            outcome, replayed = next(outcomes)
+            result.update(outcome)
+            if replayed:
+                metrics.inc("issuer_webhook_replays_total", message_type="authorization")
+                continue
+        metrics.inc("issuer_authorizations_total", result=result["result"])
+    return JsonResponse(results, safe=False, status=200)
+
+def authorize_batch_once(issuer_account, authorizations):
+    """
+    Claims the transaction_ids of batch authorizations and authorizes the ones which were not processed before, in 
+    one database transaction. Authorizations whose transaction_id already has a stored response, or repeats in the 
+    batch, are not authorized again.
+    :param issuer_account: The account where the amounts are reserved.
+    :param authorizations: List of validated authorizations for Transactions.authorize_many.
+    :return: Returns a list of (result, replayed) tuples in the order of authorizations. result is a dictionary with 
+    "result" and "available_balance" keys, and replayed results of declined authorizations don't have a balance.
+    """
+    with atomic():
+        claims = {}
+        stored = {}
+        # indexes of the authorizations which are authorized, and of the first message of each transaction_id.
+        new = []
+        first = {}
+        for index, authorization in enumerate(authorizations):
+            transaction_id = authorization["transaction_id"]
+            if transaction_id:
+                if transaction_id in first:
+                    continue
+                first[transaction_id] = index
+                pending, replayed = claim_in_batch("authorization", transaction_id)
+                if pending is None:
+                    stored[transaction_id] = replayed
+                    continue
+                claims[transaction_id] = pending
+            new.append(index)
+
+        results = {}
+        authorized = Transactions.authorize_many(issuer_account, [authorizations[index] for index in new])
+        for index, (transaction, balance_amount_after) in zip(new, authorized):
+            if transaction is not None:
+                status, content = 200, APPROVED_CONTENT.format(balance_amount_after)
+            else:
+                status, content = 403, DECLINED_CONTENT
+            if authorizations[index]["transaction_id"]:
+                claims[authorizations[index]["transaction_id"]].store(status, content)
+            results[index] = {"result": "approved" if transaction is not None else "declined",
+                              "available_balance": str(balance_amount_after)}
+
+    outcomes = []
+    for index, authorization in enumerate(authorizations):
+        transaction_id = authorization["transaction_id"]
+        if index in results:
+            outcomes.append((results[index], False))
+        elif transaction_id in stored:
+            outcomes.append((batch_result(*stored[transaction_id]), True))
+        else:
+            # the transaction_id repeats in the batch, so the result of its first message is replayed.
+            outcomes.append((results[first[transaction_id]], True))
+    return outcomes
+
+def claim_in_batch(message_type, transaction_id):
+    """
+    Claims a message of a batch in its own savepoint, so a message which already has a response doesn't roll back 
+    the batch. Must be called inside an atomic block.
+    :param message_type: authorization, presentment or presentment_part.
+    :param transaction_id: The transaction_id of the message.
+    :return: Returns a tuple of the pending response and None, or None and the stored status and content. Raises 
+    IntegrityError if the message is claimed but its response isn't stored.
+    """
+    for attempt in range(2):
+        try:
+            with atomic():
+                return WebhookResponses.claim(message_type, transaction_id), None
+        except IntegrityError:
+            replayed = WebhookResponses.replay(message_type, transaction_id)
+            if replayed is not None:
+                return None, replayed
+            # the stored response has expired, so the message is claimed again.
+            if not WebhookResponses.delete_expired(message_type, transaction_id):
+                raise
+    raise IntegrityError("The message {0} {1} couldn't be claimed.".format(message_type, transaction_id))
+
+def batch_result(status, content):
+    """
+    :param status: The stored status of an authorization.
+    :param content: The stored content of an authorization.
+    :return: Returns the result of the authorization for the batch response.
+    """
+    if status == 200:
+        return {"result": "approved", "available_balance": content[len(APPROVED_CONTENT.format("")):]}
+    return {"result": "declined"}
+
+@api_view(('POST',))
+def presentment(request):
+    return present_message(request.POST)
+
+def present_message(message):
+    """
+    Presents an authorized payment once. Shared by the WSGI and ASGI webhooks. Presentments which clear the same 
+    authorization in parts are told apart by presentment_id field, so a partial or non-final clearing without it is
+    refused. Otherwise the next part would be replayed the response of the first one. Responses of presentments 
+    with presentment_id are stored as presentment_part messages, so a presentment_id which equals the 
+    transaction_id of another presentment doesn't replay its response.
+    :param message: Dictionary of the presentment message fields.
+    :return: HttpResponse
+    """
+    if message.get("presentment_id"):
+        return respond_once("presentment_part", message, process_presentment, "presentment_id")
+    if message.get("clearing_amount") or not is_final(message):
+        return count_result("presentment", HttpResponse('Unknown error', status=400)) # Bad Request
+    return respond_once("presentment", message, process_presentment)
+
+def is_final(message):
+    """
+    :param message: Dictionary of the presentment message or clearing record fields.
+    :return: Returns False if final_clearing field keeps the rest of the authorization for later presentments.
+    """
+    return str(message.get("final_clearing", "true")).lower() not in ("false", "0")
+
+def presentment_of(message):
+    """
+    :param message: Dictionary of the presentment message or clearing record fields.
+    :return: Returns the presentment for Transactions.present_many.
+    """
+    return {
+        "transaction_id": message["transaction_id"],
+        "currency": message["settlement_currency"],
+        "amount": message["settlement_amount"],
+        "clearing_amount": message.get("clearing_amount") or None,
+        "final": is_final(message),
+    }
+
+def process_presentment(message):
+    """
+    Presents an authorized payment and creates its settlement. Optional clearing_amount field clears a part of the 
+    authorization, and with final_clearing=false the rest of it is kept for later presentments.
+    :param message: Dictionary of the presentment message fields.
+    :return: HttpResponse
+    """
+    try:
+        # the presentment and its settlement are saved together.
+        transaction, = Transactions.present_many([presentment_of(message)])
+        if transaction is None:
+            raise ValueError("There is no open authorization for the presentment.")
         return HttpResponse('Presentment successful', status=200)  # OK
     except:
         return HttpResponse('Unknown error', status=400) # Bad Request
\ No newline at end of file